@@ -0,0 +1,117 @@
+import custom_errors
+import graph_helpers
+import result
+import tree_creator
+from async_persistence import chain, default_executor
+
+
+class AsyncGraphMap:
+    def __init__(self, persistence, executor=None):
+        """
+        Non blocking version of graphmap_main.GraphMap. Every method returns right away a Future of the same
+        Result that GraphMap returns. Rendering runs on the thread pool.
+
+        :type persistence: async_persistence.AsyncPersistenceInterface
+        :type executor: concurrent.futures.ThreadPoolExecutor
+        """
+        self.persistence = persistence
+        self.executor = executor if executor is not None else default_executor()
+
+    def create_node(self, root_node_link, image_value_link=None, children_links=()):
+        """
+        Creates a node with given name.
+
+        :type root_node_link: graph_helpers.NodeLink
+        :type image_value_link: str
+        :type children_links: tuple of str
+        :return: Future of Result whose value is the created node's name.
+        :rtype: concurrent.futures.Future
+        """
+
+        def create_if_new(exists):
+            if exists:
+                return result.fail(result.NAME_ALREADY_EXISTS, 'Node {0} is already present'.format(root_node_link))
+            try:
+                created_tree = tree_creator.create_tree(node_link=root_node_link, children_links=children_links,
+                                                        persistence=self.persistence.get_serializer(),
+                                                        image_value_link=image_value_link)
+            except custom_errors.CreationFailedError as e:
+                return result.fail(result.WRONG_CHILDREN_COUNT, e.message)
+            return chain(self.persistence.put_tree(created_tree),
+                         lambda put_result: put_result if put_result.is_fail()
+                         else result.good(created_tree.get_link()))
+
+        return chain(self.persistence.exists(root_node_link), create_if_new)
+
+    def connect_child(self, root_node_link, quad_key, child_node_link, new_root_name=None):
+        """
+        Adds a node with given name at given quad key.
+
+        :type root_node_link: graph_helpers.NodeLink
+        :type quad_key: str
+        :type child_node_link: graph_helpers.NodeLink
+        :type new_root_name: graph_helpers.NodeLink
+        :return: Future of Result whose value is the created root name.
+        :rtype: concurrent.futures.Future
+        """
+        if new_root_name is None:
+            new_root_name = graph_helpers.random_node_link()
+
+        def insert(root_tree_result):
+            if root_tree_result.is_fail():
+                return root_tree_result
+            return self.executor.submit(tree_creator.create_new_from_old_insert_node_link,
+                                        old_tree=root_tree_result.value, link_to_insert=child_node_link.__str__(),
+                                        quad_key=quad_key, filename=new_root_name.filename,
+                                        new_tree_name=new_root_name.node_name)
+
+        def save(create_tree_result):
+            if create_tree_result.is_fail():
+                return create_tree_result
+            return chain(self.persistence.put_tree(create_tree_result.value),
+                         lambda put_result: put_result if put_result.is_fail()
+                         else result.good(create_tree_result.value.get_node_link()))
+
+        return chain(chain(self.persistence.get_tree(root_node_link), insert), save)
+
+    def node_exists(self, name):
+        """
+        :rtype: concurrent.futures.Future of bool
+        """
+        return self.persistence.exists(name)
+
+    def get_child_name(self, root_node_link, quad_key):
+        """
+        Gets the name of the node at the location given by quad key wrt root.
+
+        :return: Future of Result whose value is a str name of node.
+        :rtype: concurrent.futures.Future
+        """
+
+        def descend(image_tree_result):
+            if image_tree_result.is_fail():
+                return image_tree_result
+            try:
+                return result.good(image_tree_result.value.get_descendant(quad_key=quad_key))
+            except custom_errors.NodeNotFoundException as e:
+                return result.fail(message=e.message, code=result.NODE_LINK_NOT_FOUND_ERROR_CODE)
+
+        return chain(self.persistence.get_tree(root_node_link),
+                     lambda image_tree_result: self.executor.submit(descend, image_tree_result))
+
+    def get_image_at_quad_key(self, root_node_link, resolution, quad_key):
+        """
+        Gets the pil image at quad key.
+
+        :return: Future of Result whose value is a PIL Image.
+        :rtype: concurrent.futures.Future
+        """
+
+        def render(image_tree_result):
+            if image_tree_result.is_fail():
+                return image_tree_result
+            return result.good(image_tree_result.value.get_pil_image_at_quadkey(resolution=resolution,
+                                                                                quad_key=quad_key))
+
+        return chain(self.persistence.get_tree(root_node_link),
+                     lambda image_tree_result: self.executor.submit(render, image_tree_result))
@@ -0,0 +1,199 @@
+"""
+Non blocking persistence. Every call returns a concurrent.futures.Future right away, so that one thread, or an event
+loop through asyncio.wrap_future, can keep many tree loads in flight. Blocking I/O runs on a shared thread pool.
+"""
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import constants
+import memory_persistence
+import result
+import serializer
+import standard_nodes
+import utilities
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+def default_executor():
+    """
+    The thread pool used for blocking I/O when none is given.
+
+    :rtype: ThreadPoolExecutor
+    """
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = ThreadPoolExecutor(max_workers=constants.async_io_worker_count)
+        return _default_executor
+
+
+def completed(value):
+    """
+    A future that already has the given value.
+
+    :rtype: Future
+    """
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def chain(future, function):
+    """
+    Calls function with the value of future once it is done, without blocking the caller.
+
+    :param function: Takes the value of future and returns a value or another Future.
+    :return: Future of the value returned by function.
+    :rtype: Future
+    """
+    chained_future = Future()
+
+    def copy_result(done_future):
+        if done_future.exception() is not None:
+            chained_future.set_exception(done_future.exception())
+        else:
+            chained_future.set_result(done_future.result())
+
+    def on_done(done_future):
+        try:
+            if done_future.exception() is not None:
+                chained_future.set_exception(done_future.exception())
+                return
+            next_value = function(done_future.result())
+        except Exception as e:
+            chained_future.set_exception(e)
+            return
+        if isinstance(next_value, Future):
+            next_value.add_done_callback(copy_result)
+        else:
+            chained_future.set_result(next_value)
+
+    future.add_done_callback(on_done)
+    return chained_future
+
+
+class AsyncPersistenceInterface:
+    """
+    Non blocking version of persistence_interface.PersistenceInterface. All methods return a Future.
+    """
+
+    def exists(self, node_link):
+        """
+        :rtype: Future of bool
+        """
+        raise NotImplementedError('This is an interface, subclass this')
+
+    def get_tree(self, node_link):
+        """
+        :rtype: Future of result.Result wrapping imagetree.ImageTree
+        """
+        raise NotImplementedError('This is an interface, subclass this')
+
+    def put_tree(self, image_tree):
+        """
+        :type image_tree: imagetree.ImageTree
+        :rtype: Future of result.Result
+        """
+        raise NotImplementedError('This is an interface, subclass this')
+
+    def get_serializer(self):
+        """
+        The blocking persistence that nodes created for this persistence use to load their children.
+        """
+        raise NotImplementedError('This is an interface, subclass this')
+
+
+class AsyncMemoryPersistence(AsyncPersistenceInterface):
+    def __init__(self, persistence=None, executor=None):
+        """
+        Trees already in memory are returned as completed futures. Misses go to the disk fallback of
+        MemoryPersistence on the thread pool.
+
+        :type persistence: memory_persistence.MemoryPersistence
+        :type executor: ThreadPoolExecutor
+        """
+        self.persistence = persistence if persistence is not None else memory_persistence.MemoryPersistence()
+        self.executor = executor if executor is not None else default_executor()
+
+    def exists(self, node_link):
+        return completed(self.persistence.exists(node_link))
+
+    def get_tree(self, node_link):
+        image_tree = self.persistence.get_loaded_tree(node_link)
+        if image_tree is not None:
+            return completed(result.good(image_tree))
+        return self.executor.submit(self.persistence.get_tree, node_link)
+
+    def put_tree(self, image_tree):
+        self.persistence.put_tree(image_tree)
+        return completed(result.good(image_tree.get_link()))
+
+    def get_serializer(self):
+        return self.persistence
+
+
+class AsyncFilePersistence(AsyncPersistenceInterface):
+    def __init__(self, file_serializer=None, executor=None):
+        """
+        Trees stored in files. Nodes of files already loaded are returned as completed futures, file reads,
+        downloads and writes run on the thread pool.
+
+        :type file_serializer: serializer.Serializer
+        :type executor: ThreadPoolExecutor
+        """
+        self.serializer = file_serializer if file_serializer is not None else serializer.Serializer()
+        self.executor = executor if executor is not None else default_executor()
+
+    def resolve(self, node_link):
+        """
+        Gets the node link string that the serializer can load.
+
+        :rtype: str
+        """
+        return memory_persistence.to_key(node_link)
+
+    def get_tree(self, node_link):
+        link = self.resolve(node_link)
+        _, filename = utilities.resolve_link(link)
+        if filename in self.serializer.filename_treemap_map:
+            return completed(self._load(link))
+        return self.executor.submit(self._load, link)
+
+    def _load(self, link):
+        image_tree = self.serializer.load_node(link)
+        if image_tree.name == standard_nodes.node_not_found_name:
+            return result.fail(result.NODE_LINK_NOT_FOUND_ERROR_CODE, link + ' not found')
+        return result.good(image_tree)
+
+    def exists(self, node_link):
+        return chain(self.get_tree(node_link), lambda tree_result: tree_result.is_success())
+
+    def put_tree(self, image_tree):
+        def save():
+            self.serializer.put_tree(image_tree)
+            return result.good(image_tree.get_link())
+
+        return self.executor.submit(save)
+
+    def get_serializer(self):
+        return self.serializer
+
+
+class AsyncHttpPersistence(AsyncFilePersistence):
+    def __init__(self, base_url, file_serializer=None, executor=None):
+        """
+        Trees stored in files under a base url. Files given without a url are looked up under base_url.
+
+        :type base_url: str
+        """
+        AsyncFilePersistence.__init__(self, file_serializer=file_serializer, executor=executor)
+        self.base_url = base_url.rstrip('/')
+
+    def resolve(self, node_link):
+        node_name, filename = utilities.resolve_link(memory_persistence.to_key(node_link))
+        if filename and not utilities.is_web_link(filename):
+            filename = self.base_url + '/' + filename.lstrip('/')
+        return utilities.format_node_address(filename=filename, node_name=node_name)
@@ -0,0 +1,203 @@
+"""
+Index of the node links of a store, sorted by filename and node name, so that the nodes of a file or the nodes whose
+name starts with a prefix are a contiguous range that can be counted and iterated without loading any tree.
+"""
+import bisect
+import os
+import threading
+
+import utilities
+
+# Number of keys copied under the lock at a time while streaming.
+stream_chunk_size = 1000
+
+
+def to_catalog_key(node_link):
+    """
+    :type node_link: graph_helpers.NodeLink or str
+    :rtype: str, str
+    """
+    node_name, filename = utilities.resolve_link(str(node_link))
+    return filename or '', node_name
+
+
+def prefix_end(prefix):
+    """
+    Smallest string greater than all the strings starting with prefix, None if there is none.
+
+    :type prefix: str
+    :rtype: str or None
+    """
+    stripped = prefix.rstrip('\xff')
+    if not stripped:
+        return None
+    return stripped[:-1] + chr(ord(stripped[-1]) + 1)
+
+
+def to_node_link_string(key):
+    filename, node_name = key
+    return utilities.format_node_address(filename=filename, node_name=node_name)
+
+
+class CatalogInterface:
+    """
+    Catalog of the node links of a store.
+    """
+
+    def add_many(self, keys):
+        """
+        Adds node links given as (filename, node name) keys. Nodes without a file have filename ''.
+
+        :type keys: iterable of (str, str)
+        """
+        raise NotImplementedError('This is an interface, subclass this')
+
+    def iter_node_links(self, filename=None, prefix='', start_after=None):
+        """
+        Streams the node links in order of filename and node name.
+
+        :param filename: Only the nodes of this file, '' for the nodes without a file.
+        :param prefix: Only the nodes whose name starts with prefix.
+        :param start_after: Node link after which to start, the last link of the previous page.
+        :rtype: generator of str
+        """
+        raise NotImplementedError('This is an interface, subclass this')
+
+    def count(self, filename=None, prefix=''):
+        """
+        Number of node links matching, see iter_node_links.
+
+        :rtype: int
+        """
+        raise NotImplementedError('This is an interface, subclass this')
+
+    def add(self, node_link):
+        self.add_many([to_catalog_key(node_link)])
+
+    def get_page(self, page_size, filename=None, prefix='', start_after=None):
+        """
+        Gets at most page_size node links.
+
+        :return: The node links and the start_after of the next page, None on the last page.
+        :rtype: list of str, str
+        """
+        page = []
+        for node_link in self.iter_node_links(filename=filename, prefix=prefix, start_after=start_after):
+            if len(page) == page_size:
+                return page, page[-1]
+            page.append(node_link)
+        return page, None
+
+
+class MemoryCatalog(CatalogInterface):
+    def __init__(self):
+        """
+        Sorted list of keys, searched with bisect. Safe to use from many threads.
+        """
+        self._keys = []
+        self._key_set = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, node_link):
+        return to_catalog_key(node_link) in self._key_set
+
+    def add_many(self, keys):
+        """
+        :return: The keys that were not in the catalog yet.
+        :rtype: list of (str, str)
+        """
+        with self._lock:
+            new_keys = [key for key in set(keys) if key not in self._key_set]
+            if len(new_keys) > len(self._keys) / 8:
+                self._keys.extend(new_keys)
+                self._keys.sort()
+            else:
+                for key in new_keys:
+                    bisect.insort(self._keys, key)
+            self._key_set.update(new_keys)
+        return new_keys
+
+    def _range(self, filename, prefix):
+        """
+        Start key and end check of the keys that can match.
+        """
+        if filename is None:
+            return ('', ''), lambda key: True
+        start_key = (filename, prefix)
+        return start_key, lambda key: key[0] == filename and key[1].startswith(prefix)
+
+    def iter_node_links(self, filename=None, prefix='', start_after=None):
+        start_key, in_range = self._range(filename, prefix)
+        position_key, skip_position_key = start_key, False
+        if start_after is not None and to_catalog_key(start_after) >= start_key:
+            position_key, skip_position_key = to_catalog_key(start_after), True
+        while True:
+            with self._lock:
+                position = (bisect.bisect_right if skip_position_key else bisect.bisect_left)(self._keys, position_key)
+                chunk = self._keys[position:position + stream_chunk_size]
+            for key in chunk:
+                if not in_range(key):
+                    return
+                if filename is not None or key[1].startswith(prefix):
+                    yield to_node_link_string(key)
+            if len(chunk) < stream_chunk_size:
+                return
+            position_key, skip_position_key = chunk[-1], True
+
+    def count(self, filename=None, prefix=''):
+        if filename is None:
+            if not prefix:
+                return len(self._keys)
+            return sum(1 for _ in self.iter_node_links(prefix=prefix))
+        end_prefix = prefix_end(prefix) if prefix else None
+        end_key = (filename, end_prefix) if end_prefix is not None else (filename + '\0', '')
+        with self._lock:
+            return bisect.bisect_left(self._keys, end_key) - bisect.bisect_left(self._keys, (filename, prefix))
+
+    def remove_file(self, filename):
+        """
+        Removes the keys of the nodes of a file.
+
+        :type filename: str
+        :return: Number of keys removed.
+        :rtype: int
+        """
+        with self._lock:
+            start = bisect.bisect_left(self._keys, (filename, ''))
+            end = bisect.bisect_left(self._keys, (filename + '\0', ''))
+            self._key_set.difference_update(self._keys[start:end])
+            del self._keys[start:end]
+        return end - start
+
+    def filenames(self):
+        """
+        :rtype: list of str
+        """
+        with self._lock:
+            return sorted(set(filename for filename, _ in self._keys))
+
+
+class FileCatalog(MemoryCatalog):
+    def __init__(self, catalog_filename):
+        """
+        A MemoryCatalog that is also appended to a file of tab separated filename and node name, and read back
+        from it when created.
+
+        :type catalog_filename: str
+        """
+        MemoryCatalog.__init__(self)
+        self.catalog_filename = catalog_filename
+        if os.path.isfile(catalog_filename):
+            with open(catalog_filename) as f:
+                MemoryCatalog.add_many(self, [tuple(line.rstrip('\n').split('\t', 1)) for line in f if '\t' in line])
+
+    def add_many(self, keys):
+        new_keys = MemoryCatalog.add_many(self, keys)
+        if new_keys:
+            with self._lock:
+                with open(self.catalog_filename, 'a') as f:
+                    f.writelines('{}\t{}\n'.format(filename, node_name) for filename, node_name in new_keys)
+        return new_keys
@@ -8,6 +8,36 @@ z_limit_caching = 20
 cache_limit = 10 ** 6
 cache_populate_limit = 10 ** 5
 default_tile_resolution = 256
+treemap_cache_bytes = 512 * 2 ** 20
+file_cache_raw_bytes = 256 * 2 ** 20
+file_cache_revalidate_seconds = 60
+file_mirror_dir_name = 'graphmap_file_mirror'
+prefetch_worker_count = 4
+prefetch_max_queued = 1000
+prefetch_max_depth = 3
+async_io_worker_count = 32
+http_timeout_seconds = 30
+http_max_idle_connections_per_host = 8
+http_max_redirects = 5
+tile_warmer_process_count = 4
+tile_warmer_progress_interval = 100
+log_max_segment_bytes = 64 * 2 ** 20
+log_initial_index_capacity = 2 ** 16
+memory_persistence_stripe_count = 64
+negative_cache_ttl_seconds = 30
+negative_cache_max_entries = 10 ** 5
+tile_index_save_interval = 1000
+tile_cache_max_bytes = 4 * 2 ** 30
+tile_cache_high_watermark = 0.95
+tile_cache_low_watermark = 0.8
+tile_eviction_batch_size = 256
+tile_memory_cache_bytes = 64 * 2 ** 20
+image_cache_bytes = 2 * 2 ** 30
+decoded_image_cache_max_bytes = 8 * 2 ** 30
+decoded_image_temporary_file_grace_seconds = 600
+tile_access_flush_interval = 1000
+write_behind_worker_count = 2
+write_behind_max_pending = 1000
 LINE_LINK = 'line@https://artmapstore.blob.core.windows.net/firstnodes/line.tsv.gz'
 RED_GALLERY_LINK = 'red_gallery@https://artmapstore.blob.core.windows.net/firstnodes/red_gallery.tsv.gz'
 color_channels_used = 3
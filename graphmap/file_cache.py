@@ -0,0 +1,192 @@
+"""
+Process wide cache of tree files, shared by all the Serializer instances.
+
+Raw contents are cached by local path or url and remote files are also mirrored on disk. Every serializer parses the
+contents itself, so that the nodes it loads refer to it and load their children through it.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+import constants
+import lru_cache
+import utilities
+from single_flight import SingleFlight
+
+FileEntry = namedtuple('FileEntry', ['version', 'contents', 'checked_time'])
+
+immutable_version_pattern = re.compile(r'\.' + constants.version_string + r'\d+\.')
+
+
+def is_immutable_filename(filename):
+    """
+    Files with a version in the name, e.g. start.ver_10.tsv, are never modified. A new version gets a new name.
+
+    :type filename: str
+    :rtype: bool
+    """
+    return immutable_version_pattern.search(filename.rsplit('/', 1)[-1]) is not None
+
+
+def local_file_version(filename):
+    """
+    Version of a local file. Changes when the file is written again.
+
+    :type filename: str
+    :rtype: tuple
+    """
+    stat = os.stat(filename)
+    return stat.st_mtime, stat.st_size
+
+
+def raw_entry_bytes(file_entry):
+    return len(file_entry.contents)
+
+
+class FileCache:
+    def __init__(self, max_raw_bytes=constants.file_cache_raw_bytes, mirror_dir=None,
+                 revalidate_seconds=constants.file_cache_revalidate_seconds):
+        """
+        Cache of raw tree files.
+
+        :param mirror_dir: Directory where remote files are mirrored. None disables the mirror.
+        :param revalidate_seconds: How long a remote file that can change is used before asking the server again.
+        """
+        self.raw_cache = lru_cache.ByteLruCache(max_bytes=max_raw_bytes, size_function=raw_entry_bytes)
+        self.mirror_dir = mirror_dir
+        self.revalidate_seconds = revalidate_seconds
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight()
+        self.downloads = 0
+        self.mirror_hits = 0
+
+    def get_tree_map(self, filename, serializer):
+        """
+        Parses the file for the serializer. Nodes of a TreeMap refer to the serializer that parsed it, and load their
+        children through it, so TreeMaps are not shared between serializers, only the raw contents are. Concurrent
+        parses of one file by one serializer are coalesced, the serializer caches the TreeMap it gets.
+
+        :type filename: str
+        :type serializer: serializer.Serializer
+        :rtype: treemap.TreeMap
+        """
+        file_entry = self.get_file_entry(filename)
+        return self._single_flight.do(('parsed', filename, id(serializer)),
+                                      lambda: serializer.deserialize_string_to_tree_map(filename, file_entry.contents))
+
+    def get_contents(self, filename):
+        """
+        Gets the contents of a local file or url.
+
+        :type filename: str
+        :rtype: str
+        """
+        return self.get_file_entry(filename).contents
+
+    def get_file_entry(self, filename):
+        """
+        :type filename: str
+        :rtype: FileEntry
+        """
+        with self._lock:
+            file_entry = self.raw_cache.get(filename)
+        if file_entry is not None and self.is_fresh(filename, file_entry):
+            return file_entry
+        return self._single_flight.do(('raw', filename), lambda: self._load_file_entry(filename, file_entry))
+
+    def is_fresh(self, filename, file_entry):
+        """
+        Whether the cached entry can be used without reading the file or asking the server again.
+
+        :type filename: str
+        :type file_entry: FileEntry
+        :rtype: bool
+        """
+        if not utilities.is_web_link(filename):
+            try:
+                return local_file_version(filename) == file_entry.version
+            except OSError:
+                return False
+        if is_immutable_filename(filename):
+            return True
+        return time.time() - file_entry.checked_time < self.revalidate_seconds
+
+    def _load_file_entry(self, filename, previous_entry):
+        if utilities.is_web_link(filename):
+            version, contents = self._fetch_remote(filename, previous_entry)
+        else:
+            version = local_file_version(filename)
+            contents = utilities.get_contents_of_file(filename)
+        file_entry = FileEntry(version=version, contents=contents, checked_time=time.time())
+        with self._lock:
+            self.raw_cache[filename] = file_entry
+        return file_entry
+
+    def _fetch_remote(self, url, previous_entry):
+        """
+        Gets a remote file, from the disk mirror when it is known to be unchanged.
+
+        :rtype: tuple, str
+        """
+        mirror_metadata = self._read_mirror_metadata(url)
+        if mirror_metadata is not None and is_immutable_filename(url):
+            self.mirror_hits += 1
+            return mirror_metadata['version'], self._read_mirror_contents(url)
+        etag = mirror_metadata['etag'] if mirror_metadata else None
+        last_modified = mirror_metadata['last_modified'] if mirror_metadata else None
+        contents, etag, last_modified = utilities.get_contents_of_url_if_modified(url, etag=etag,
+                                                                               last_modified=last_modified)
+        if contents is None:
+            self.mirror_hits += 1
+            if previous_entry is not None and previous_entry.version == mirror_metadata['version']:
+                return previous_entry.version, previous_entry.contents
+            return mirror_metadata['version'], self._read_mirror_contents(url)
+        self.downloads += 1
+        version = etag or last_modified or hashlib.sha1(contents).hexdigest()
+        self._write_mirror(url, contents, {'url': url, 'version': version, 'etag': etag,
+                                           'last_modified': last_modified})
+        return version, contents
+
+    def mirror_path(self, url):
+        return os.path.join(self.mirror_dir, hashlib.sha1(url).hexdigest())
+
+    def _read_mirror_metadata(self, url):
+        if self.mirror_dir is None:
+            return None
+        metadata_path = self.mirror_path(url) + '.json'
+        if not os.path.isfile(metadata_path) or not os.path.isfile(self.mirror_path(url)):
+            return None
+        with open(metadata_path) as f:
+            return json.load(f)
+
+    def _read_mirror_contents(self, url):
+        with open(self.mirror_path(url), 'rb') as f:
+            return f.read()
+
+    def _write_mirror(self, url, contents, metadata):
+        if self.mirror_dir is None:
+            return
+        utilities.mkdir_p(self.mirror_dir)
+        mirror_path = self.mirror_path(url)
+        # Contents first, metadata last, each renamed into place so that readers never see a partial file. The mirror
+        # directory is shared by all the processes.
+        utilities.write_file_atomically(mirror_path, contents)
+        utilities.write_file_atomically(mirror_path + '.json', json.dumps(metadata))
+
+    def stats_dict(self):
+        return {'raw': self.raw_cache.stats_dict(),
+                'downloads': str(self.downloads),
+                'mirror hits': str(self.mirror_hits),
+                'coalesced loads': str(self._single_flight.coalesced_count)}
+
+    def clear(self):
+        with self._lock:
+            self.raw_cache.clear()
+
+
+shared_file_cache = FileCache(mirror_dir=os.path.join(tempfile.gettempdir(), constants.file_mirror_dir_name))
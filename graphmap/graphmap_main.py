@@ -1,3 +1,4 @@
+import constants
 import custom_errors
 import graph_helpers
 import result
@@ -98,5 +99,48 @@ class GraphMap:
             lambda prev_value: result.good(prev_value.get_pil_image_at_quadkey(
                 resolution=resolution, quad_key=quad_key))))
 
+    def get_encoded_tile(self, root_node_link, x, y, z, resolution=constants.default_tile_resolution,
+                         tile_format='JPEG'):
+        """
+        Gets the tile at x, y, z as encoded bytes, served from the tile cache without decoding when it is there.
+
+        :type root_node_link: graph_helpers.NodeLink
+        :param tile_format: A PIL format name, JPEG or PNG.
+        :return: Result whose value is the encoded bytes.
+        :rtype: result.Result
+        """
+        return result.combine((
+            lambda prev_value: self.persistence.get_tree(root_node_link),
+            lambda prev_value: result.good(prev_value.get_encoded_tile(x=x, y=y, z=z, resolution=resolution,
+                                                                       tile_format=tile_format))))
+
     def get_all_node_links(self):
         return self.persistence.get_all_node_links()
+
+    def iter_node_links(self, filename=None, prefix='', start_after=None):
+        """
+        Streams the stored node links in order, without loading the trees.
+
+        :param filename: Only the nodes of this file.
+        :param prefix: Only the nodes whose name starts with prefix.
+        :param start_after: Node link after which to start.
+        :rtype: generator of str
+        """
+        return self.persistence.get_catalog().iter_node_links(filename=filename, prefix=prefix,
+                                                              start_after=start_after)
+
+    def get_node_links_page(self, page_size, filename=None, prefix='', start_after=None):
+        """
+        Gets a page of the stored node links.
+
+        :return: The node links and the start_after of the next page, None on the last page.
+        :rtype: list of str, str
+        """
+        return self.persistence.get_catalog().get_page(page_size, filename=filename, prefix=prefix,
+                                                       start_after=start_after)
+
+    def count_nodes(self, filename=None, prefix=''):
+        """
+        :rtype: int
+        """
+        return self.persistence.get_catalog().count(filename=filename, prefix=prefix)
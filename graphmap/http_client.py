@@ -0,0 +1,195 @@
+"""
+HTTP client shared by everything that fetches images, tree files and tiles. Connections are kept alive and reused per
+host, so a fetch is one request on an open connection.
+"""
+import httplib
+import socket
+import threading
+import urllib2
+import urlparse
+
+import constants
+
+redirect_statuses = (301, 302, 303, 307, 308)
+
+
+class HttpResponse:
+    def __init__(self, url, status, reason, headers, body):
+        """
+        :param url: The url that answered, after redirects.
+        :type status: int
+        :param headers: Header names are lower case.
+        :type headers: dict
+        :type body: str
+        """
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def is_success(self):
+        return 200 <= self.status < 300
+
+    def __repr__(self):
+        return 'HttpResponse({}, {} {}, {} bytes)'.format(self.url, self.status, self.reason, len(self.body))
+
+
+class HttpClient:
+    def __init__(self, timeout=constants.http_timeout_seconds,
+                 max_idle_per_host=constants.http_max_idle_connections_per_host,
+                 max_redirects=constants.http_max_redirects):
+        """
+        Keeps up to max_idle_per_host idle connections to each host. A connection is used by one request at a time,
+        so the client is safe to use from many threads.
+
+        :param timeout: Seconds to wait to connect and for each read.
+        """
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self.max_redirects = max_redirects
+        self._lock = threading.Lock()
+        self._idle_connections = {}  # (scheme, host, port) -> list of idle connections
+        self.request_count = 0
+        self.connection_count = 0
+
+    def _new_connection(self, host_key):
+        scheme, host, port = host_key
+        connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        with self._lock:
+            self.connection_count += 1
+        return connection_class(host, port, timeout=self.timeout)
+
+    def _take_connection(self, host_key):
+        """
+        :return: An idle connection and whether it was reused.
+        :rtype: httplib.HTTPConnection, bool
+        """
+        with self._lock:
+            idle_connections = self._idle_connections.get(host_key)
+            if idle_connections:
+                return idle_connections.pop(), True
+        return self._new_connection(host_key), False
+
+    def _release_connection(self, host_key, connection):
+        with self._lock:
+            idle_connections = self._idle_connections.setdefault(host_key, [])
+            if len(idle_connections) < self.max_idle_per_host:
+                idle_connections.append(connection)
+                return
+        connection.close()
+
+    def _request_once(self, method, url, headers):
+        parsed_url = urlparse.urlsplit(url)
+        if parsed_url.scheme not in ('http', 'https'):
+            raise urllib2.URLError('Unsupported url ' + url)
+        host_key = (parsed_url.scheme, parsed_url.hostname, parsed_url.port)
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+        connection, is_reused = self._take_connection(host_key)
+        try:
+            connection.request(method, path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error) as e:
+            connection.close()
+            if is_reused:
+                # The server closed the idle connection, retry once on a new one.
+                return self._request_once(method, url, headers)
+            raise urllib2.URLError(e)
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(host_key, connection)
+        with self._lock:
+            self.request_count += 1
+        return HttpResponse(url, response.status, response.reason,
+                            dict((name.lower(), value) for name, value in response.getheaders()), body)
+
+    def request(self, method, url, headers=None):
+        """
+        Sends one request, following redirects.
+
+        :type method: str
+        :type url: str
+        :type headers: dict
+        :rtype: HttpResponse
+        :raises urllib2.URLError: If the host cannot be reached.
+        """
+        response = self._request_once(method, url, headers or {})
+        for _ in xrange(self.max_redirects):
+            if response.status not in redirect_statuses or 'location' not in response.headers:
+                break
+            response = self._request_once('GET' if response.status == 303 else method,
+                                          urlparse.urljoin(response.url, response.headers['location']),
+                                          headers or {})
+        return response
+
+    def get(self, url, headers=None):
+        """
+        :rtype: HttpResponse
+        :raises urllib2.HTTPError: If the status is an error.
+        """
+        response = self.request('GET', url, headers=headers)
+        if response.status >= 400:
+            raise urllib2.HTTPError(response.url, response.status, response.reason, response.headers, None)
+        return response
+
+    def head(self, url):
+        """
+        :rtype: HttpResponse
+        """
+        return self.request('HEAD', url)
+
+    def exists(self, url):
+        """
+        Checks existence with a HEAD request, or a GET where the server does not allow HEAD.
+
+        :rtype: bool
+        """
+        try:
+            response = self.head(url)
+            if response.status in (405, 501):
+                response = self.request('GET', url)
+        except urllib2.URLError:
+            return False
+        return response.status < 400
+
+    def get_if_modified(self, url, etag=None, last_modified=None, headers=None):
+        """
+        Conditional GET.
+
+        :param etag: ETag header of the previously downloaded contents.
+        :param last_modified: Last-Modified header of the previously downloaded contents.
+        :return: The response, None if not modified.
+        :rtype: HttpResponse
+        :raises urllib2.HTTPError: If the status is an error.
+        """
+        request_headers = dict(headers or {})
+        if etag:
+            request_headers['If-None-Match'] = etag
+        if last_modified:
+            request_headers['If-Modified-Since'] = last_modified
+        response = self.request('GET', url, headers=request_headers)
+        if response.status == 304:
+            return None
+        if response.status >= 400:
+            raise urllib2.HTTPError(response.url, response.status, response.reason, response.headers, None)
+        return response
+
+    def close(self):
+        with self._lock:
+            idle_connections, self._idle_connections = self._idle_connections, {}
+        for connections in idle_connections.itervalues():
+            for connection in connections:
+                connection.close()
+
+    def stats_dict(self):
+        with self._lock:
+            return {'requests': str(self.request_count),
+                    'connections opened': str(self.connection_count),
+                    'idle connections': str(sum(len(c) for c in self._idle_connections.itervalues()))}
+
+
+shared_http_client = HttpClient()
@@ -0,0 +1,246 @@
+"""
+Disk cache of decoded, proper shaped images, shared by all the processes of a server through the page cache.
+"""
+import hashlib
+import os
+import threading
+import time
+
+import constants
+import numpy as np
+import utilities
+
+image_extension = '.npy'
+temporary_extension = '.tmp'
+
+
+def image_key(url, resolution=None):
+    """
+    :param resolution: Resolution of a mip level, None for the full resolution proper shaped image.
+    :return: Hex digest.
+    :rtype: str
+    """
+    return hashlib.sha1('{}\t{}'.format(url, resolution if resolution is not None else 'full')).hexdigest()
+
+
+def image_key_to_relative_path(key):
+    """
+    Two levels of 256 directories, like the tile caches.
+
+    :type key: str
+    :rtype: str
+    """
+    return os.path.join(key[0:2], key[2:4], key + image_extension)
+
+
+class DecodedImageCache:
+    def __init__(self, cache_dir, max_bytes=constants.decoded_image_cache_max_bytes,
+                 high_watermark=constants.tile_cache_high_watermark, low_watermark=constants.tile_cache_low_watermark,
+                 temporary_file_grace_seconds=constants.decoded_image_temporary_file_grace_seconds,
+                 background_eviction=True):
+        """
+        Stores uint8 arrays as .npy files, read back memory mapped, so that processes sharing cache_dir decode each
+        image once and share its pages. Files are written to a temporary file renamed into place.
+
+        The modification time of a file is its last access, so the least recently used order is the same for all
+        the processes. When the bytes this process knows of go over high_watermark of max_bytes, a background thread
+        walks the directory and removes least recently used files till the bytes are under low_watermark of
+        max_bytes. Arrays already mapped by a process stay valid after their file is removed. Temporary files left by
+        writers that died are removed by eviction once they are older than temporary_file_grace_seconds.
+
+        :param max_bytes: Capacity in bytes of the cached files.
+        :param high_watermark: Fraction of max_bytes above which eviction starts.
+        :param low_watermark: Fraction of max_bytes down to which eviction goes.
+        :param temporary_file_grace_seconds: Age after which a temporary file is taken as abandoned.
+        :param background_eviction: Whether eviction runs on a background thread, or inline in put_array.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.temporary_file_grace_seconds = temporary_file_grace_seconds
+        self.background_eviction = background_eviction
+        self._lock = threading.Lock()
+        self._eviction_requested = threading.Event()
+        self._eviction_thread = None
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.evictions = 0
+        if not os.path.isdir(self.cache_dir):
+            utilities.mkdir_p(self.cache_dir)
+        self.used_bytes = sum(file_size for _, file_size, _ in self._cached_files())
+
+    def _path(self, url, resolution):
+        return os.path.join(self.cache_dir, image_key_to_relative_path(image_key(url, resolution)))
+
+    def _cache_dir_files(self):
+        """
+        :return: Path, size and last modification of every file in the cache directory, temporary files too.
+        :rtype: list of (str, int, float)
+        """
+        cache_dir_files = []
+        for directory, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                file_path = os.path.join(directory, filename)
+                try:
+                    file_stat = os.stat(file_path)
+                except OSError:
+                    continue
+                cache_dir_files.append((file_path, file_stat.st_size, file_stat.st_mtime))
+        return cache_dir_files
+
+    def _cached_files(self):
+        """
+        :return: Path, size and last access of every cached file.
+        :rtype: list of (str, int, float)
+        """
+        return [cached_file for cached_file in self._cache_dir_files() if cached_file[0].endswith(image_extension)]
+
+    def has_array(self, url, resolution=None):
+        """
+        :rtype: bool
+        """
+        return os.path.isfile(self._path(url, resolution))
+
+    def get_array(self, url, resolution=None):
+        """
+        Maps the cached array and marks it as most recently used.
+
+        :type url: str
+        :param resolution: Resolution of a mip level, None for the full resolution proper shaped image.
+        :return: Read only array, None if it is not cached.
+        :rtype: np.ndarray
+        """
+        file_path = self._path(url, resolution)
+        try:
+            im_array = np.load(file_path, mmap_mode='r')
+        except (IOError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(file_path, None)
+        except OSError:
+            # Evicted by another process, the mapping stays valid.
+            pass
+        with self._lock:
+            self.hits += 1
+        return im_array
+
+    def put_array(self, url, im_array, resolution=None):
+        """
+        Saves the array and requests eviction if the cache is over the high watermark.
+
+        :type url: str
+        :type im_array: np.ndarray
+        :param resolution: Resolution of a mip level, None for the full resolution proper shaped image.
+        """
+        file_path = self._path(url, resolution)
+        directory_to_save = os.path.dirname(file_path)
+        if not os.path.isdir(directory_to_save):
+            utilities.mkdir_p(directory_to_save)
+        temporary_path = '{}.{}.{}{}'.format(file_path, os.getpid(), threading.current_thread().ident,
+                                             temporary_extension)
+        with open(temporary_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(im_array, dtype=np.uint8))
+        file_size = os.path.getsize(temporary_path)
+        try:
+            replaced_file_size = os.path.getsize(file_path)
+        except OSError:
+            replaced_file_size = 0
+        os.rename(temporary_path, file_path)
+        with self._lock:
+            self.puts += 1
+            self.used_bytes += file_size - replaced_file_size
+            is_over_budget = self.max_bytes is not None and self.used_bytes > self.max_bytes * self.high_watermark
+        if is_over_budget:
+            self._request_eviction()
+
+    def _request_eviction(self):
+        if not self.background_eviction:
+            self.evict()
+            return
+        with self._lock:
+            if self._eviction_thread is None:
+                self._eviction_thread = threading.Thread(target=self._eviction_loop,
+                                                         name='DecodedImageCacheEviction')
+                self._eviction_thread.daemon = True
+                self._eviction_thread.start()
+        self._eviction_requested.set()
+
+    def _eviction_loop(self):
+        while True:
+            self._eviction_requested.wait()
+            self._eviction_requested.clear()
+            if self._closed:
+                return
+            self.evict()
+
+    def close(self):
+        """
+        Stops the eviction thread.
+        """
+        eviction_thread = self._eviction_thread
+        if eviction_thread is not None:
+            self._closed = True
+            self._eviction_requested.set()
+            eviction_thread.join()
+            self._eviction_thread = None
+            self._closed = False
+
+    def evict(self):
+        """
+        Removes least recently used files, those of other processes too, till the cached bytes are under the low
+        watermark, and the abandoned temporary files.
+        """
+        stale_before = time.time() - self.temporary_file_grace_seconds
+        cached_files = []
+        for file_path, file_size, modification_time in self._cache_dir_files():
+            if file_path.endswith(image_extension):
+                cached_files.append((file_path, file_size, modification_time))
+            elif file_path.endswith(temporary_extension) and modification_time < stale_before:
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+        cached_files.sort(key=lambda cached_file: cached_file[2])
+        used_bytes = sum(file_size for _, file_size, _ in cached_files)
+        evictions = 0
+        for file_path, file_size, _ in cached_files:
+            if used_bytes <= self.max_bytes * self.low_watermark:
+                break
+            try:
+                os.remove(file_path)
+                evictions += 1
+            except OSError:
+                # Removed by another process.
+                pass
+            used_bytes -= file_size
+        with self._lock:
+            self.used_bytes = used_bytes
+            self.evictions += evictions
+
+    def clear(self):
+        for file_path, _, _ in self._cached_files():
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        with self._lock:
+            self.used_bytes = 0
+
+    def stats_dict(self):
+        with self._lock:
+            return {'decoded image cache dir': self.cache_dir,
+                    'decoded image used bytes': str(self.used_bytes),
+                    'decoded image max bytes': str(self.max_bytes),
+                    'decoded image hits': str(self.hits),
+                    'decoded image misses': str(self.misses),
+                    'decoded image puts': str(self.puts),
+                    'decoded image evictions': str(self.evictions)}
+
+    def __repr__(self):
+        return 'DecodedImageCache(cache_dir={}, max_bytes={}). Used bytes {}, hits {}, misses {}, evictions {}' \
+            .format(self.cache_dir, self.max_bytes, self.used_bytes, self.hits, self.misses, self.evictions)
@@ -6,6 +6,8 @@ import numpy as np
 import pixel_approximator
 import serializer
 import standard_pixel
+import tile_disk_cache
+import tree_operator
 import utilities
 from PIL import Image
 from custom_errors import NodeNotFoundException
@@ -42,6 +44,23 @@ def get_child_array(im_array, child_index):
     raise ('Invalid index for child ' + str(child_index))
 
 
+def permute_quadrants(im_array, transform):
+    """
+    Copies the quadrants of an image array into the positions transform_tree moves the children to, quadrant i of
+    the result being quadrant transform[i] of im_array.
+
+    :type im_array: np.array
+    :type transform: list of int
+    :rtype: np.array
+    """
+    if im_array.shape[0] <= 1:
+        return im_array.copy()
+    permuted_array = np.empty_like(im_array)
+    for child_index, source_index in enumerate(transform):
+        get_child_array(permuted_array, child_index)[...] = get_child_array(im_array, source_index)
+    return permuted_array
+
+
 def image_at_quad_key(input_image, resolution, quad_key):
     """
     Renders input image at given quadkey at given resolution.
@@ -198,16 +217,21 @@ class ImageTree:
         return len(self._children) is 0
 
     def get_pil_image(self, resolution):
+        untransformed_tree, transform = tree_operator.untransformed_tree(self)
+        if untransformed_tree is not None:
+            return Image.fromarray(permute_quadrants(np.array(untransformed_tree.get_pil_image(resolution)), transform))
         if self.serializer.image_cache is not None:
-            if self.serializer.image_cache.has_image(image_tree=self, resolution=resolution):
-                return self.serializer.image_cache.get_image(image_tree=self, resolution=resolution)
-            else:
+            pil_image = self.serializer.image_cache.get_image(image_tree=self, resolution=resolution)
+            if pil_image is None:
                 pil_image = Image.fromarray(self.get_np_array(resolution))
                 self.serializer.image_cache.put_image(pil_image=pil_image, image_tree=self, resolution=resolution)
-                return pil_image
+            return pil_image
         return Image.fromarray(self.get_np_array(resolution))
 
     def get_np_array(self, resolution):
+        untransformed_tree, transform = tree_operator.untransformed_tree(self)
+        if untransformed_tree is not None:
+            return permute_quadrants(untransformed_tree.get_np_array(resolution), transform)
         im = np.zeros((resolution, resolution, 3), dtype=np.uint8)
         return self.render(resolution, im_array=im)
 
@@ -323,6 +347,10 @@ class ImageTree:
                 return self.name + '\t\t\t\t' + '\t'.join(
                     ['' for _ in range(4)]) + '\t' + self._image_value.get_link() + '\n'
             return self.name + '\t\t\t\t' + '\t'.join(self._children_links) + '\t' + self._image_value.get_link() + '\n'
+        if isinstance(self._image_value, imagevalue.NodeLinkImage):
+            if self.is_leaf():
+                return self.name + '\t\t\t\t' + '\t'.join(['' for _ in range(4)]) + '\t' + self._image_value.link + '\n'
+            return self.name + '\t\t\t\t' + '\t'.join(self._children_links) + '\t' + self._image_value.link + '\n'
         raise Exception('Unknown type of _image_value ' + str(self._image_value))
 
     def remove_similar_children(self):
@@ -469,11 +497,51 @@ class ImageTree:
         quad_key = utilities.xyz_to_quadkey(x, y, z)
         return self.get_pil_image_at_quadkey(resolution=resolution, quad_key=quad_key)
 
-    def get_pil_image_at_quadkey(self, resolution, quad_key):
+    def get_encoded_tile(self, x, y, z, resolution=constants.default_tile_resolution, tile_format='JPEG'):
+        """
+        Gets the tile at x, y, z as encoded bytes, ready to send. When the serializer has an image cache the bytes
+        come straight from it, a miss is encoded once and the same bytes are stored.
+
+        :param tile_format: A PIL format name, JPEG or PNG.
+        :rtype: str
+        """
+        quad_key = utilities.xyz_to_quadkey(x, y, z)
+        image_cache = self.serializer.image_cache
+        if image_cache is None:
+            return tile_disk_cache.encode_image(self.get_pil_image_at_quadkey(resolution, quad_key), tile_format)
+        source_node, relative_quad_key = self.tile_source(quad_key)
+        source_link = tile_disk_cache.canonical_node_link(source_node.get_link())
+        key = tile_disk_cache.encoded_tile_key(source_link, relative_quad_key, resolution, tile_format)
+        encoded_tile = image_cache.get_encoded(key, node_link=self.get_link(), zoom=z)
+        if encoded_tile is None:
+            encoded_tile = tile_disk_cache.encode_image(Image.fromarray(source_node.get_np_array_at_quad_key(
+                resolution=resolution, quad_key=relative_quad_key)), tile_format)
+            image_cache.put_encoded(key, encoded_tile, node_link=source_link, resolution=resolution)
+        return encoded_tile
+
+    def tile_source(self, quad_key):
+        """
+        The node that renders the tile at quad key, which is the lowest set node, and the quad key relative to it.
+        Tiles are cached by this node, so roots and versions sharing a subtree share its tiles.
+
+        A tree made by an operator chain that has no image of its own renders its tiles like the untransformed tree
+        at the quad key remapped through the transform, so that tree and quad key are returned.
+
+        :type quad_key: str
+        :rtype: tuple of ImageTree and str
+        """
         lowest_node, relative_quad_key = self.lowest_set_node(quad_key)
         if lowest_node is None:
             lowest_node, relative_quad_key = self, quad_key
-        return Image.fromarray(lowest_node.get_np_array_at_quad_key(resolution=resolution, quad_key=relative_quad_key))
+        if relative_quad_key:
+            untransformed_tree, transform = tree_operator.untransformed_tree(lowest_node)
+            if untransformed_tree is not None:
+                return untransformed_tree, str(transform[int(relative_quad_key[0])]) + relative_quad_key[1:]
+        return lowest_node, relative_quad_key
+
+    def get_pil_image_at_quadkey(self, resolution, quad_key):
+        source_node, relative_quad_key = self.tile_source(quad_key)
+        return Image.fromarray(source_node.get_np_array_at_quad_key(resolution=resolution, quad_key=relative_quad_key))
 
     def get_np_array_at_quad_key(self, resolution, quad_key, input_im_array=None):
         if len(quad_key) <= 0:
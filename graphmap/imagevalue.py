@@ -1,22 +1,41 @@
 import cStringIO
-import urllib
+import collections
+import threading
+import urllib2
 
+import constants
+import http_client
+import image_disk_cache
+import lru_cache
 import numpy as np
-import pylru
+import single_flight
 import utilities
 from PIL import Image
 
 
+image_fetch_flight = single_flight.SingleFlight()
+
+
 def fetch_image_from_url(url):
     """
-    Returns a pil image from given url
+    Returns a pil image from given url. Concurrent fetches of the same url share one download.
     :rtype Image.Image:
     """
-    if utilities.url_exists(url):
-        img_stream = cStringIO.StringIO(urllib.urlopen(url).read())
-        pil_image = Image.open(img_stream)
-        return pil_image
-    return Image.new("RGB", size=(256, 266), color='black')
+    return image_fetch_flight.do(url, lambda: _fetch_image_from_url(url))
+
+
+def _fetch_image_from_url(url):
+    """
+    One GET, a missing or unreachable image is black.
+    """
+    try:
+        response = http_client.shared_http_client.get(url)
+    except urllib2.URLError:
+        return Image.new("RGB", size=(256, 266), color='black')
+    pil_image = Image.open(cStringIO.StringIO(response.body))
+    # Decode now, the image is shared by all the waiting callers.
+    pil_image.load()
+    return pil_image
 
 
 class ImageValue:
@@ -45,9 +64,90 @@ class ImageValue:
         pass
 
 
-image_cache_size = 1000
-pil_image_cache = pylru.lrucache(image_cache_size)
-proper_shape_image_cache = pylru.lrucache(image_cache_size)
+def decoded_image_bytes(value):
+    """
+    :param value: A pil image, a numpy array or same_as_full_image.
+    :return: Bytes of the decoded pixels.
+    :rtype: int
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, Image.Image):
+        return value.size[0] * value.size[1] * len(value.getbands())
+    return 0
+
+
+# Decoded web images of this process, weighed by their decoded bytes under one budget. Keys are ('full', url) for
+# downloaded images, ('proper', url) for their proper shaped images and ('array', url, resolution) for arrays.
+image_cache = lru_cache.ByteLruCache(max_bytes=constants.image_cache_bytes,
+                                     size_function=decoded_image_bytes)
+# Cached as the proper shaped image of a downloaded image that already has the proper shape, so it is not held twice.
+same_as_full_image = 'same as full image'
+proper_shape_flight = single_flight.SingleFlight()
+image_cache_lookups = collections.Counter()  # (kind of key, 'hits' or 'misses') -> count
+image_cache_lookups_lock = threading.Lock()
+
+
+def is_proper_shape(pil_image):
+    """
+    Whether reshaping the image would give the same pixels: a square RGB image with a power of 2 side.
+
+    :type pil_image: Image.Image
+    :rtype: bool
+    """
+    width, height = pil_image.size
+    return pil_image.mode == 'RGB' and width == height and width & (width - 1) == 0
+
+
+def get_cached_image(key):
+    """
+    :type key: tuple
+    :rtype: Image.Image or np.ndarray or None
+    """
+    value = image_cache.get(key)
+    with image_cache_lookups_lock:
+        image_cache_lookups[(key[0], 'misses' if value is None else 'hits')] += 1
+    return value
+
+
+def put_cached_image(key, value):
+    image_cache[key] = value
+
+
+def clear_image_cache():
+    image_cache.clear()
+    with image_cache_lookups_lock:
+        image_cache_lookups.clear()
+
+
+def image_cache_stats_dict():
+    """
+    :rtype: dict
+    """
+    stats = dict(('image cache ' + name, value) for name, value in image_cache.stats_dict().iteritems())
+    with image_cache_lookups_lock:
+        for (kind, outcome), count in image_cache_lookups.iteritems():
+            stats['image cache {} {}'.format(kind, outcome)] = str(count)
+    disk_cache = decoded_image_disk_cache
+    if disk_cache is not None:
+        stats.update(disk_cache.stats_dict())
+    return stats
+
+
+# Shared by the processes of a server, so that after a restart images are neither downloaded nor decoded again.
+decoded_image_disk_cache = None
+
+
+def use_decoded_image_disk_cache(cache_dir, max_bytes=constants.decoded_image_cache_max_bytes):
+    """
+    Makes the web images of this process read and store their decoded images in cache_dir.
+
+    :type cache_dir: str
+    :rtype: image_disk_cache.DecodedImageCache
+    """
+    global decoded_image_disk_cache
+    decoded_image_disk_cache = image_disk_cache.DecodedImageCache(cache_dir, max_bytes=max_bytes)
+    return decoded_image_disk_cache
 
 
 class JpgWebImage(ImageValue):
@@ -57,36 +157,52 @@ class JpgWebImage(ImageValue):
 
     def __init__(self, url):
         """
-        Given url is stored. When asked to render it fetches the image.
-
-        :type _pil_image: Image.Image
+        Given url is stored. When asked to render it fetches the image. The images are held by image_cache, not by
+        the instance, so that they count against its budget.
         """
         self.url = url
-        if url in pil_image_cache:
-            self._pil_image = pil_image_cache[url]
-        else:
-            self._pil_image = None
-        if url in proper_shape_image_cache:
-            self._proper_shape_image = proper_shape_image_cache[url]
-        else:
-            self._proper_shape_image = None
-        self.cache = pylru.lrucache(10)
 
     @property
     def pil_image(self):
-        if self._pil_image is None:
-            self._pil_image = fetch_image_from_url(self.url)
-            pil_image_cache[self.url] = self._pil_image
-        return self._pil_image
+        pil_image = get_cached_image(('full', self.url))
+        if pil_image is None:
+            pil_image = fetch_image_from_url(self.url)
+            put_cached_image(('full', self.url), pil_image)
+        return pil_image
 
     def get_pil_image_at_full_resolution(self):
         return self.pil_image
 
     def get_pil_image_at_full_resolution_proper_shape(self):
-        if self._proper_shape_image is None:
-            self._proper_shape_image = utilities.reshape_proper_pil_image(self.get_pil_image_at_full_resolution())
-            proper_shape_image_cache[self.url] = self._proper_shape_image
-        return self._proper_shape_image
+        proper_shape_image = get_cached_image(('proper', self.url))
+        if proper_shape_image is same_as_full_image:
+            proper_shape_image = get_cached_image(('full', self.url))
+        if proper_shape_image is None:
+            proper_shape_image = proper_shape_flight.do(self.url, self._load_proper_shape_image)
+        return proper_shape_image
+
+    def _load_proper_shape_image(self):
+        """
+        From the decoded image disk cache if it has the image, else derived from the downloaded image and stored in
+        it.
+        """
+        disk_cache = decoded_image_disk_cache
+        if disk_cache is not None:
+            im_array = disk_cache.get_array(self.url)
+            if im_array is not None:
+                proper_shape_image = Image.fromarray(np.array(im_array))
+                put_cached_image(('proper', self.url), proper_shape_image)
+                return proper_shape_image
+        pil_image = self.get_pil_image_at_full_resolution()
+        if is_proper_shape(pil_image):
+            proper_shape_image = pil_image
+            put_cached_image(('proper', self.url), same_as_full_image)
+        else:
+            proper_shape_image = utilities.reshape_proper_pil_image(pil_image)
+            put_cached_image(('proper', self.url), proper_shape_image)
+        if disk_cache is not None:
+            disk_cache.put_array(self.url, np.array(proper_shape_image, dtype=np.uint8))
+        return proper_shape_image
 
     def get_pil_image(self, resolution):
         """
@@ -100,15 +216,23 @@ class JpgWebImage(ImageValue):
         """Convert to numpy array.
 
         Drop alpha"""
-        cache_key = str(resolution)
-        if cache_key in self.cache:
-            return self.cache[cache_key]
-        pil_image = self.get_pil_image_at_full_resolution()
-        im_array = np.array(pil_image, dtype=np.uint8)
-        square_image = utilities.reshape_proper(im_array)
-        return_value = np.array(Image.fromarray(square_image).resize((resolution, resolution)), dtype=np.uint8)
-        self.cache[cache_key] = return_value
-        return return_value
+        cache_key = ('array', self.url, resolution)
+        cached_array = get_cached_image(cache_key)
+        if cached_array is not None:
+            # The cached array is shared by every node of the url, rendering draws the children over a private copy.
+            return cached_array.copy()
+        disk_cache = decoded_image_disk_cache
+        mip_level = disk_cache.get_array(self.url, resolution) if disk_cache is not None else None
+        if mip_level is not None:
+            cached_array = np.array(mip_level)
+        else:
+            proper_shape_image = self.get_pil_image_at_full_resolution_proper_shape()
+            cached_array = np.array(proper_shape_image.resize((resolution, resolution)), dtype=np.uint8)
+            if disk_cache is not None:
+                disk_cache.put_array(self.url, cached_array, resolution)
+        cached_array.setflags(write=False)
+        put_cached_image(cache_key, cached_array)
+        return cached_array.copy()
 
     def is_set(self):
         return True
@@ -121,3 +245,50 @@ class JpgWebImage(ImageValue):
 
     def __repr__(self):
         return 'JpegWebImage({})'.format(self.url)
+
+
+class NodeLinkImage(ImageValue):
+    """
+    An image value that is another node, referred by its link. The node is loaded only when it is first rendered.
+    """
+
+    def __init__(self, link, serializer):
+        """
+        Given link is stored. When asked to render it resolves the node through the serializer.
+
+        :type link: str
+        :type serializer: serializer.Serializer
+        """
+        self.link = link
+        self.serializer = serializer
+
+    @property
+    def image_tree(self):
+        """
+        :rtype: imagetree.ImageTree
+        """
+        return self.serializer.load_linked_image(self.link)
+
+    def get_pil_image(self, resolution):
+        return self.image_tree.get_pil_image(resolution)
+
+    def get_np_array(self, resolution):
+        return self.image_tree.get_np_array(resolution)
+
+    def get_pil_image_at_full_resolution(self):
+        return self.image_tree.get_pil_image_at_full_resolution()
+
+    def get_pil_image_at_full_resolution_proper_shape(self):
+        return self.image_tree.get_pil_image_at_full_resolution()
+
+    def is_set(self):
+        return True
+
+    def __eq__(self, other):
+        return isinstance(other, NodeLinkImage) and self.link == other.link
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'NodeLinkImage({})'.format(self.link)
@@ -0,0 +1,105 @@
+"""
+Background loading of the files that a loaded file links to.
+"""
+import itertools
+import threading
+from Queue import PriorityQueue, Full
+
+import constants
+
+
+class LinkPrefetcher:
+    def __init__(self, worker_count=constants.prefetch_worker_count, max_queued=constants.prefetch_max_queued,
+                 max_depth=constants.prefetch_max_depth):
+        """
+        Loads linked files into the serializer's loaded files on a bounded pool of threads, so that the synchronous
+        load at first access is a cache hit or waits for the load already in flight.
+
+        Files closer to the file that was asked for are loaded first.
+
+        :param worker_count: Number of loading threads.
+        :param max_queued: Requests beyond this many pending ones are dropped.
+        :param max_depth: Links are followed this many files away from a file loaded on request.
+        """
+        self.worker_count = worker_count
+        self.max_depth = max_depth
+        self._queue = PriorityQueue(maxsize=max_queued)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._pending_filenames = set()
+        self._workers = []
+        self.scheduled_count = 0
+        self.loaded_count = 0
+        self.dropped_count = 0
+        self.failed_count = 0
+
+    def prefetch_linked_files(self, tree_map, filename, serializer, depth=0):
+        """
+        Schedules loading of the files that the nodes of tree_map link to.
+
+        :type tree_map: treemap.TreeMap
+        :param filename: The file tree_map was loaded from.
+        :type serializer: serializer.Serializer
+        :param depth: Distance of filename from the file that was asked for.
+        """
+        if depth >= self.max_depth:
+            return
+        for linked_filename in tree_map.get_linked_filenames(filename):
+            self.schedule(linked_filename, serializer=serializer, depth=depth + 1)
+
+    def schedule(self, filename, serializer, depth):
+        """
+        Schedules loading of a file unless it is already pending or cached.
+
+        :rtype: bool
+        """
+        with self._lock:
+            if filename in self._pending_filenames or filename in serializer.filename_treemap_map:
+                return False
+            try:
+                self._queue.put_nowait((depth, next(self._sequence), filename, serializer))
+            except Full:
+                self.dropped_count += 1
+                return False
+            self._pending_filenames.add(filename)
+            self.scheduled_count += 1
+            if len(self._workers) < self.worker_count:
+                worker = threading.Thread(target=self._work, name='link_prefetcher_' + str(len(self._workers)))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        return True
+
+    def _work(self):
+        while True:
+            depth, _, filename, serializer = self._queue.get()
+            try:
+                if filename in serializer.filename_treemap_map:
+                    # Loaded on request since it was scheduled.
+                    continue
+                tree_map = serializer.load_tree_map(filename)
+                with self._lock:
+                    self.loaded_count += 1
+                self.prefetch_linked_files(tree_map, filename, serializer=serializer, depth=depth)
+            except Exception as e:
+                with self._lock:
+                    self.failed_count += 1
+                print('Prefetch of {} failed with {}'.format(filename, e))
+            finally:
+                with self._lock:
+                    self._pending_filenames.discard(filename)
+                self._queue.task_done()
+
+    def wait(self):
+        """
+        Blocks till all scheduled files, and the files they link to, are loaded.
+        """
+        self._queue.join()
+
+    def stats_dict(self):
+        with self._lock:
+            return {'scheduled': str(self.scheduled_count),
+                    'loaded': str(self.loaded_count),
+                    'dropped': str(self.dropped_count),
+                    'failed': str(self.failed_count),
+                    'pending': str(len(self._pending_filenames))}
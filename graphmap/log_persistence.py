@@ -0,0 +1,335 @@
+"""
+Log structured persistence. Nodes are immutable, so they are only ever appended to segment files. A memory mapped
+open addressing hash table maps each node link to the segment and offset of its record.
+
+Record layout: key length, value length and crc32 of key and value as big endian uint32, then the key, which is the
+node link, then the value, which is the tsv line of the node.
+
+Index layout: a header followed by slots. The header records the log position up to which the index is complete, so
+that after a crash only the records after it are replayed. A slot is the 64 bit hash of the key, 0 for an empty slot,
+followed by the segment number and the offset as uint32.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import constants
+import node_store
+import utilities
+
+record_header = struct.Struct('>III')
+index_header = struct.Struct('>8sQQIQ')
+index_slot = struct.Struct('>QII')
+index_magic = 'GMLOGIX1'
+index_filename = 'index.bin'
+segment_filename_format = 'segment_{:06d}.log'
+max_load_factor = 0.5
+
+
+def key_hash(key):
+    """
+    64 bit hash of a key, stable across processes. Never 0, which marks an empty slot.
+
+    :type key: str
+    :rtype: int
+    """
+    return struct.unpack('>Q', hashlib.md5(key).digest()[:8])[0] or 1
+
+
+def to_log_key(filename, node_name):
+    return utilities.format_node_address(filename=filename, node_name=node_name)
+
+
+class HashIndex:
+    def __init__(self, index_path, capacity):
+        """
+        Open addressing hash table with linear probing in a memory mapped file.
+
+        :type index_path: str
+        :param capacity: Number of slots, a new file is created if the existing one has a different capacity.
+        """
+        self.index_path = index_path
+        self.capacity = capacity
+        file_size = index_header.size + capacity * index_slot.size
+        is_new = not os.path.isfile(index_path) or os.path.getsize(index_path) != file_size
+        self._file = open(index_path, 'r+b' if not is_new else 'w+b')
+        if is_new:
+            self._file.truncate(file_size)
+        self._map = mmap.mmap(self._file.fileno(), file_size)
+        magic, stored_capacity, self.count, self.segment, self.offset = index_header.unpack_from(self._map, 0)
+        if magic != index_magic or stored_capacity != capacity:
+            self.reset()
+
+    def reset(self):
+        self._map[:] = '\0' * len(self._map)
+        self.count, self.segment, self.offset = 0, 0, 0
+        self.write_header()
+
+    def write_header(self):
+        index_header.pack_into(self._map, 0, index_magic, self.capacity, self.count, self.segment, self.offset)
+
+    def set_position(self, segment, offset):
+        """
+        Records that the index has all the records before this log position.
+        """
+        self.segment, self.offset = segment, offset
+        self.write_header()
+
+    def _slot_offset(self, slot):
+        return index_header.size + slot * index_slot.size
+
+    def probe(self, hash_value):
+        """
+        Yields the locations stored for the hash, followed by None and the first empty slot.
+
+        :rtype: generator of (int, (int, int) or None)
+        """
+        slot = hash_value % self.capacity
+        for _ in xrange(self.capacity):
+            stored_hash, segment, offset = index_slot.unpack_from(self._map, self._slot_offset(slot))
+            if stored_hash == 0:
+                yield slot, None
+                return
+            if stored_hash == hash_value:
+                yield slot, (segment, offset)
+            slot = (slot + 1) % self.capacity
+
+    def put(self, hash_value, segment, offset, slot=None):
+        """
+        Stores location in the given slot, or in the first empty one.
+        """
+        if slot is None:
+            for slot, location in self.probe(hash_value):
+                if location is None:
+                    break
+        stored_hash = index_slot.unpack_from(self._map, self._slot_offset(slot))[0]
+        index_slot.pack_into(self._map, self._slot_offset(slot), hash_value, segment, offset)
+        if stored_hash == 0:
+            self.count += 1
+
+    def is_full(self):
+        return self.count + 1 > self.capacity * max_load_factor
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+
+class LogPersistence(node_store.NodeStorePersistence):
+    store_name = 'Log Persistence'
+
+    def __init__(self, directory, max_segment_bytes=constants.log_max_segment_bytes,
+                 initial_index_capacity=constants.log_initial_index_capacity, sync=False):
+        """
+        put_tree appends the new nodes to the current segment, get_tree is one index probe and one read.
+
+        :param directory: Where segments and index are stored.
+        :param max_segment_bytes: A new segment is started when the current one is bigger than this.
+        :param initial_index_capacity: Slots of a new index. The index doubles when it is half full.
+        :param sync: Whether every put_tree is fsynced before it returns.
+        """
+        node_store.NodeStorePersistence.__init__(self)
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.sync = sync
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        utilities.mkdir_p(directory)
+        segment_numbers = sorted(int(f[len('segment_'):-len('.log')]) for f in os.listdir(directory)
+                                 if f.startswith('segment_') and f.endswith('.log'))
+        self.segment = segment_numbers[-1] if segment_numbers else 0
+        self._writer = open(self.segment_path(self.segment), 'ab')
+        self.index = HashIndex(os.path.join(directory, index_filename), self._find_index_capacity(
+            initial_index_capacity))
+        self._recover()
+        # Recovery may have cut a torn record off the current segment, new records are appended at its new end.
+        self._writer.seek(0, os.SEEK_END)
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, segment_filename_format.format(segment))
+
+    def _find_index_capacity(self, initial_index_capacity):
+        index_path = os.path.join(self.directory, index_filename)
+        if os.path.isfile(index_path):
+            return (os.path.getsize(index_path) - index_header.size) / index_slot.size
+        return initial_index_capacity
+
+    def _recover(self):
+        """
+        Replays the records written after the last position recorded in the index. A torn record at the end of the
+        log, left by a crash during an append, is cut off.
+        """
+        if self.index.segment > self.segment:
+            self.index.reset()
+        for segment in xrange(self.index.segment, self.segment + 1):
+            start_offset = self.index.offset if segment == self.index.segment else 0
+            end_offset = start_offset
+            for key, _, offset, end_offset in self._scan_segment(segment, start_offset):
+                self._index_put(key, segment, offset)
+            if end_offset < os.path.getsize(self.segment_path(segment)):
+                print('Truncating torn record at {} of {}'.format(end_offset, self.segment_path(segment)))
+                with open(self.segment_path(segment), 'r+b') as f:
+                    f.truncate(end_offset)
+            self.index.set_position(segment, end_offset)
+        self.index.flush()
+
+    def _scan_segment(self, segment, start_offset=0):
+        """
+        Yields key, value, offset and end offset of the valid records of a segment.
+        """
+        path = self.segment_path(segment)
+        if not os.path.isfile(path):
+            return
+        with open(path, 'rb') as f:
+            f.seek(start_offset)
+            offset = start_offset
+            while True:
+                header = f.read(record_header.size)
+                if len(header) < record_header.size:
+                    return
+                key_length, value_length, crc = record_header.unpack(header)
+                body = f.read(key_length + value_length)
+                if len(body) < key_length + value_length or zlib.crc32(body) & 0xffffffff != crc:
+                    return
+                end_offset = offset + record_header.size + len(body)
+                yield body[:key_length], body[key_length:], offset, end_offset
+                offset = end_offset
+
+    def _index_put(self, key, segment, offset):
+        if self.index.is_full():
+            self._grow_index()
+        hash_value = key_hash(key)
+        for slot, location in self.index.probe(hash_value):
+            if location is None or self._read_record(*location)[0] == key:
+                self.index.put(hash_value, segment, offset, slot=slot)
+                return
+
+    def _grow_index(self):
+        """
+        Rebuilds the index with double the capacity from the log, or more if the log has records of more keys that
+        are not indexed yet. A key written more than once gets only its latest record.
+        """
+        self._writer.flush()
+        latest_locations = {}
+        for segment in xrange(0, self.segment + 1):
+            for key, _, offset, _ in self._scan_segment(segment):
+                latest_locations[key] = (segment, offset)
+        capacity = self.index.capacity * 2
+        while len(latest_locations) + 1 > capacity * max_load_factor:
+            capacity *= 2
+        self.index.close()
+        os.remove(os.path.join(self.directory, index_filename))
+        self.index = HashIndex(os.path.join(self.directory, index_filename), capacity)
+        for key, (segment, offset) in latest_locations.iteritems():
+            self.index.put(key_hash(key), segment, offset)
+
+    def _reader(self, segment):
+        readers = getattr(self._local, 'readers', None)
+        if readers is None:
+            readers = self._local.readers = {}
+        if segment not in readers:
+            readers[segment] = open(self.segment_path(segment), 'rb')
+        return readers[segment]
+
+    def _read_record(self, segment, offset):
+        """
+        Reads through the reader of the current thread. The index only points to records already flushed.
+
+        :rtype: str, str
+        """
+        reader = self._reader(segment)
+        reader.seek(offset)
+        key_length, value_length, _ = record_header.unpack(reader.read(record_header.size))
+        body = reader.read(key_length + value_length)
+        return body[:key_length], body[key_length:]
+
+    def _with_index(self, function):
+        """
+        Calls function with the index without holding the lock, so that reads do not wait for appends. When the index
+        grows, the old one is closed and function fails on it, it is then called again with the new one under the
+        lock.
+        """
+        # One attribute read, the index being written to meanwhile is fine: its slots point to flushed records only.
+        index = self.index
+        try:
+            return function(index)
+        except ValueError:
+            with self._lock:
+                return function(self.index)
+
+    def read_serialized_node(self, filename, node_name):
+        key = to_log_key(filename, node_name)
+
+        def find_value(index):
+            for _, location in index.probe(key_hash(key)):
+                if location is None:
+                    return None
+                stored_key, value = self._read_record(*location)
+                if stored_key == key:
+                    return value
+            return None
+
+        return self._with_index(find_value)
+
+    def write_serialized_nodes(self, rows):
+        """
+        Appends the nodes to the log, flushes it and then adds them to the index, so that readers, which do not take
+        the lock, only find records they can read.
+        """
+        with self._lock:
+            locations = []
+            for filename, name, serialized_node, _ in rows:
+                if self._writer.tell() > self.max_segment_bytes:
+                    self._writer.close()
+                    self.segment += 1
+                    self._writer = open(self.segment_path(self.segment), 'ab')
+                key = to_log_key(filename, name)
+                body = key + serialized_node
+                offset = self._writer.tell()
+                self._writer.write(record_header.pack(len(key), len(serialized_node), zlib.crc32(body) & 0xffffffff))
+                self._writer.write(body)
+                locations.append((key, self.segment, offset))
+            self._writer.flush()
+            if self.sync:
+                os.fsync(self._writer.fileno())
+            for key, segment, offset in locations:
+                self._index_put(key, segment, offset)
+            self.index.set_position(self.segment, self._writer.tell())
+
+    def get_all_node_links(self):
+        """
+        Every stored node link once. A key written more than once is listed at the record the index points to.
+
+        :rtype: list of str
+        """
+        with self._lock:
+            last_segment = self.segment
+        return [key for segment in xrange(0, last_segment + 1) for key, _, offset, _ in self._scan_segment(segment)
+                if self._is_indexed_record(key, segment, offset)]
+
+    def _is_indexed_record(self, key, segment, offset):
+        """
+        Whether the record at segment and offset is the one stored for key, without reading any record.
+
+        :rtype: bool
+        """
+        return self._with_index(lambda index: any(location == (segment, offset)
+                                                  for _, location in index.probe(key_hash(key))))
+
+    def count_nodes(self):
+        return self.index.count
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+            self.index.close()
+
+    def __repr__(self):
+        return 'LogPersistence({}). Segment {}, nodes {}'.format(self.directory, self.segment, self.index.count)
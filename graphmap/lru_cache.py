@@ -0,0 +1,113 @@
+"""
+Least recently used cache bounded by the total estimated size of the values instead of their count.
+"""
+import threading
+from collections import OrderedDict
+
+_missing = object()
+
+
+class ByteLruCache:
+    def __init__(self, max_bytes, size_function, eviction_callback=None):
+        """
+        A dictionary like cache that evicts least recently used entries when the sum of their sizes is over budget.
+        Safe to use from many threads, every operation holds the lock of the cache.
+
+        :param max_bytes: Budget for the total size of all the values.
+        :type max_bytes: int
+        :param size_function: Function that estimates the size of a value in bytes.
+        :param eviction_callback: Called with the key and the value of every evicted entry, under the lock of the
+            cache.
+        """
+        self.max_bytes = max_bytes
+        self.size_function = size_function
+        self.eviction_callback = eviction_callback
+        self._entries = OrderedDict()  # key -> (value, size in bytes), oldest first
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __getitem__(self, key):
+        value = self.get(key, default=_missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = self.size_function(value)
+        with self._lock:
+            self.pop(key)
+            self._entries[key] = (value, size)
+            self.used_bytes += size
+            self._evict(keep_key=key)
+
+    def get(self, key, default=None):
+        """
+        Gets the value and marks it as most recently used. Counts as hit or miss.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries[key] = entry
+            return entry[0]
+
+    def pop(self, key, default=None):
+        """
+        Removes the key if present and returns its value. Does not count as an eviction.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.used_bytes -= entry[1]
+            return entry[0]
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.used_bytes = 0
+
+    def _evict(self, keep_key):
+        """
+        Removes least recently used entries till the total size is within budget. The just inserted entry is kept
+        even if it alone is bigger than the budget, so that the caller can use it.
+        """
+        while self.used_bytes > self.max_bytes and len(self._entries) > 1:
+            oldest_key = next(iter(self._entries))
+            if oldest_key == keep_key:
+                break
+            value, size = self._entries.pop(oldest_key)
+            self.used_bytes -= size
+            self.evictions += 1
+            if self.eviction_callback is not None:
+                self.eviction_callback(oldest_key, value)
+
+    def stats_dict(self):
+        with self._lock:
+            return {'entries': str(len(self._entries)),
+                    'used bytes': str(self.used_bytes),
+                    'max bytes': str(self.max_bytes),
+                    'hits': str(self.hits),
+                    'misses': str(self.misses),
+                    'evictions': str(self.evictions)}
+
+    def __repr__(self):
+        return 'ByteLruCache(max_bytes={}). Entries {}, used bytes {}, hits {}, misses {}, evictions {}' \
+            .format(self.max_bytes, len(self._entries), self.used_bytes, self.hits, self.misses, self.evictions)
@@ -1,15 +1,41 @@
+import threading
+
+import catalog
+import constants
 import custom_errors
 import imagetree
 import persistence_interface
 import result
 import serializer
+import single_flight
 import standard_nodes
 from graph_helpers import NodeLink
 
 
+def to_key(node_link):
+    if isinstance(node_link, NodeLink):
+        return node_link.get_old_node_link_string()
+    return node_link
+
+
 class MemoryPersistence(persistence_interface.PersistenceInterface):
-    def __init__(self):
-        self.tree_dictionary = {}
+    def __init__(self, stripe_count=constants.memory_persistence_stripe_count):
+        """
+        Trees are kept in dictionaries striped by the hash of their link, each with its own lock. Reads do not take
+        a lock, a single dict lookup is atomic. Writes lock only their stripe, so writers of different links do not
+        wait for each other. The disk load counter has a lock of its own, loads of different links run at once.
+
+        :type stripe_count: int
+        """
+        self._stripes = [{} for _ in xrange(stripe_count)]
+        self._stripe_locks = [threading.Lock() for _ in xrange(stripe_count)]
+        self._load_flight = single_flight.SingleFlight()
+        self.catalog = catalog.MemoryCatalog()
+        self.disk_load_count = 0
+        self._stats_lock = threading.Lock()
+
+    def _stripe_index(self, key):
+        return hash(key) % len(self._stripes)
 
     def put_tree(self, input_tree):
         """
@@ -17,7 +43,35 @@ class MemoryPersistence(persistence_interface.PersistenceInterface):
         :type input_tree: imagetree.ImageTree
         :return:
         """
-        self.tree_dictionary[input_tree.get_link()] = input_tree
+        key = input_tree.get_link()
+        stripe_index = self._stripe_index(key)
+        with self._stripe_locks[stripe_index]:
+            self._stripes[stripe_index][key] = input_tree
+        self.catalog.add(key)
+
+    def put_tree_if_absent(self, input_tree):
+        """
+        Stores the tree unless a tree with the same link is already stored.
+
+        :type input_tree: imagetree.ImageTree
+        :return: The stored tree, which other threads also get.
+        :rtype: imagetree.ImageTree
+        """
+        key = input_tree.get_link()
+        stripe_index = self._stripe_index(key)
+        with self._stripe_locks[stripe_index]:
+            stored_tree = self._stripes[stripe_index].setdefault(key, input_tree)
+        self.catalog.add(key)
+        return stored_tree
+
+    def get_loaded_tree(self, node_link):
+        """
+        Gets the tree if it is in memory, without going to disk.
+
+        :rtype: imagetree.ImageTree or None
+        """
+        key = to_key(node_link)
+        return self._stripes[self._stripe_index(key)].get(key)
 
     def exists(self, node_link):
         """
@@ -26,30 +80,36 @@ class MemoryPersistence(persistence_interface.PersistenceInterface):
         :type node_link: NodeLink
         :return:
         """
-        if isinstance(node_link, NodeLink):
-            key = node_link.get_old_node_link_string()
-        else:
-            key = node_link
-        return key in self.tree_dictionary
+        return self.get_loaded_tree(node_link) is not None
 
     def get_tree(self, requested_node_link):
-        if isinstance(requested_node_link, NodeLink):
-            key = requested_node_link.get_old_node_link_string()
-        else:
-            key = requested_node_link
-        if key in self.tree_dictionary:
-            return result.good(self.tree_dictionary[key])
-        # If not found in memory try disk
+        image_tree = self.get_loaded_tree(requested_node_link)
+        if image_tree is not None:
+            return result.good(image_tree)
+        # Concurrent misses on the same link wait for a single load from disk.
+        return self._load_flight.do(to_key(requested_node_link), lambda: self._load_tree(requested_node_link))
+
+    def _load_tree(self, requested_node_link):
+        image_tree = self.get_loaded_tree(requested_node_link)
+        if image_tree is not None:
+            return result.good(image_tree)
+        with self._stats_lock:
+            self.disk_load_count += 1
         try:
             image_tree = serializer.load_link_new_serializer(str(requested_node_link))
             if image_tree.name != standard_nodes.node_not_found_name:
                 # Todo need a better way, should not rely on name
-                self.put_tree(image_tree)
-                return result.good(image_tree)
+                return result.good(self.put_tree_if_absent(image_tree))
         except custom_errors.NodeNotFoundException as e:
             pass
         return result.fail(code=result.NODE_LINK_NOT_FOUND_ERROR_CODE,
                            message=str(requested_node_link) + ' not found in Memory Persistence')
 
     def get_all_node_links(self):
-        return self.tree_dictionary.keys()
+        return list(self.catalog.iter_node_links())
+
+    def get_catalog(self):
+        return self.catalog
+
+    def count_nodes(self):
+        return sum(len(stripe) for stripe in self._stripes)
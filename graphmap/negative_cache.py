@@ -0,0 +1,95 @@
+"""
+Time bounded memory of things that were looked for and not found, so that repeated lookups of a dead link do not go
+to disk or network every time.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import constants
+
+
+def file_key(filename):
+    return 'file', filename
+
+
+def node_key(filename, node_name):
+    return 'node', filename, node_name
+
+
+class NegativeCache:
+    def __init__(self, ttl_seconds=constants.negative_cache_ttl_seconds,
+                 max_entries=constants.negative_cache_max_entries):
+        """
+        Entries expire ttl_seconds after they were added, so something created later is found again.
+
+        :param ttl_seconds: How long a miss is remembered.
+        :param max_entries: Oldest entries are dropped beyond this count.
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._expiry_times = OrderedDict()  # key -> expiry time, oldest first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._expiry_times)
+
+    def is_missing(self, key):
+        """
+        Whether key was recorded as missing and has not expired yet. Counts as hit or miss.
+
+        :rtype: bool
+        """
+        with self._lock:
+            expiry_time = self._expiry_times.get(key)
+            if expiry_time is not None and expiry_time < time.time():
+                del self._expiry_times[key]
+                self.expirations += 1
+                expiry_time = None
+            if expiry_time is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, key):
+        """
+        Records that key is missing.
+        """
+        with self._lock:
+            self._expiry_times.pop(key, None)
+            self._expiry_times[key] = time.time() + self.ttl_seconds
+            while len(self._expiry_times) > self.max_entries:
+                self._expiry_times.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._expiry_times.pop(key, None)
+
+    def discard_file(self, filename):
+        """
+        Forgets that the file or any of its nodes is missing, used when the file is written.
+
+        :type filename: str
+        """
+        with self._lock:
+            for key in [key for key in self._expiry_times if key[1] == filename]:
+                del self._expiry_times[key]
+
+    def clear(self):
+        with self._lock:
+            self._expiry_times.clear()
+
+    def stats_dict(self):
+        """
+        :rtype: dict
+        """
+        with self._lock:
+            return {'entries': len(self._expiry_times), 'hits': self.hits, 'misses': self.misses,
+                    'expirations': self.expirations}
+
+
+shared_negative_cache = NegativeCache()
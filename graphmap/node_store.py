@@ -0,0 +1,167 @@
+"""
+Base of the persistences that store every node separately, as its tsv line, keyed by filename and node name.
+"""
+import threading
+import weakref
+
+import catalog
+import persistence_interface
+import result
+import serialization.tsv_serializer
+import serializer
+import standard_nodes
+import tree_operator
+import utilities
+
+
+def to_key(node_link):
+    """
+    Splits a node link into filename and node name. Nodes without a file have filename ''.
+
+    :type node_link: graph_helpers.NodeLink or str
+    :rtype: str, str
+    """
+    node_name, filename = utilities.resolve_link(str(node_link))
+    return filename or '', node_name
+
+
+class NodeStorePersistence(persistence_interface.PersistenceInterface):
+    store_name = 'Node Store'
+
+    def __init__(self):
+        """
+        Nodes returned by the store use it as their serializer, and load their children lazily through load_node.
+        """
+        self.image_cache = None
+        self._linked_image_map = weakref.WeakValueDictionary()
+        self._file_serializer = None
+        self._catalog = None
+        self._catalog_lock = threading.Lock()
+
+    def read_serialized_node(self, filename, node_name):
+        """
+        Gets the stored tsv line of a node.
+
+        :type filename: str
+        :type node_name: str
+        :rtype: str or None
+        """
+        raise NotImplementedError('This is an interface, subclass this')
+
+    def write_serialized_nodes(self, rows):
+        """
+        Stores nodes in one batch.
+
+        :param rows: list of tuples of filename, node name, tsv line and list of children links.
+        """
+        raise NotImplementedError('This is an interface, subclass this')
+
+    def exists(self, node_link):
+        """
+        Checks if given node link is stored.
+
+        :type node_link: graph_helpers.NodeLink
+        :rtype: bool
+        """
+        filename, node_name = to_key(node_link)
+        return self.read_serialized_node(filename, node_name) is not None
+
+    def put_tree(self, image_tree):
+        """
+        Stores the tree and all its loaded descendants that are not stored yet. Nodes are immutable, so the
+        descendants of a stored node are not visited.
+
+        :type image_tree: imagetree.ImageTree
+        :rtype: result.Result
+        """
+        rows = []
+        visited_keys = set()
+        nodes_to_visit = [image_tree]
+        while nodes_to_visit:
+            node = nodes_to_visit.pop()
+            key = (node.filename or '', node.name)
+            if key in visited_keys:
+                continue
+            visited_keys.add(key)
+            if node is not image_tree and self.exists(node.get_link()):
+                continue
+            rows.append(key + (node.serialize_node(), node.children_links))
+            nodes_to_visit.extend(node._children)
+        self.write_serialized_nodes(rows)
+        with self._catalog_lock:
+            if self._catalog is not None:
+                self._catalog.add_many(row[:2] for row in rows)
+        return result.good(image_tree.get_link())
+
+    def get_catalog(self):
+        """
+        Built from the stored node links the first time it is asked for, then kept up to date by put_tree.
+
+        :rtype: catalog.MemoryCatalog
+        """
+        with self._catalog_lock:
+            if self._catalog is None:
+                node_catalog = catalog.MemoryCatalog()
+                node_catalog.add_many(catalog.to_catalog_key(node_link) for node_link in self.get_all_node_links())
+                self._catalog = node_catalog
+            return self._catalog
+
+    def get_tree(self, node_link):
+        """
+        Gets tree for the given node_link
+
+        :type node_link: graph_helpers.NodeLink
+        :returns: Result wrapping imagetree.ImageTree
+        :rtype: result.Result
+        """
+        image_tree = self.load_stored_node(str(node_link))
+        if image_tree is None:
+            return result.fail(code=result.NODE_LINK_NOT_FOUND_ERROR_CODE,
+                               message=str(node_link) + ' not found in ' + self.store_name)
+        return result.good(image_tree)
+
+    def load_node(self, link):
+        """
+        Loads a single node, used by the nodes of this persistence to load their children. Links to nodes that are
+        not stored are loaded from their file.
+
+        :type link: str
+        :rtype: imagetree.ImageTree
+        """
+        image_tree = self.load_stored_node(link)
+        if image_tree is not None:
+            return image_tree
+        node_name, filename = utilities.resolve_link(link)
+        # A child link to a node without a file has no '@', so it is read back relative to the parent's file.
+        image_tree = self.load_stored_node(node_name)
+        if image_tree is not None:
+            return image_tree
+        if not filename:
+            return standard_nodes.not_found_node(serializer=self, filename='')
+        if self._file_serializer is None:
+            self._file_serializer = serializer.Serializer()
+        return self._file_serializer.load_node(link)
+
+    def load_linked_image(self, link):
+        """
+        Shared by all the nodes that link to it while it is in use, not pinned for the life of the store.
+        """
+        image_tree = self._linked_image_map.get(link)
+        if image_tree is None:
+            image_tree = self.load_node(link)
+            self._linked_image_map[link] = image_tree
+        return image_tree
+
+    def load_stored_node(self, link):
+        """
+        :rtype: imagetree.ImageTree or None
+        """
+        node_name_with_operator, filename = utilities.resolve_link(link)
+        node_name, operators_list = tree_operator.get_nodename_and_operators_list(node_name_with_operator)
+        serialized_node = self.read_serialized_node(filename or '', node_name)
+        if serialized_node is None:
+            return None
+        unoperated_node = serialization.tsv_serializer.deserialize_to_imagetree_node(line=serialized_node,
+                                                                                     filename=filename,
+                                                                                     serializer=self)
+        return tree_operator.apply_operators(unoperated_node, operators_list)
@@ -1,9 +1,22 @@
-import cStringIO
+import os
 import random
+import shutil
+import tempfile
+import threading
 import time
 import urllib2
 from datetime import datetime
 
+import custom_errors
+import graphmap_main
+import http_client
+import log_persistence
+import memory_persistence
+import serializer
+import sqlite_persistence
+import tree_creator
+from graph_helpers import NodeLink
+
 
 class TileTimeStat:
     def __init__(self, x, y, z, time_taken_ms, http_code, time_of_request):
@@ -71,10 +84,15 @@ def generate_multiple_random_tiles(count, max_lod):
 
 
 class PerfTester:
-    def __init__(self, endpoint=None, verbose=False, node_link=None):
+    def __init__(self, endpoint=None, verbose=False, node_link=None, client=None):
+        """
+        :param client: HTTP client, whose kept alive connections are reused across tiles.
+        :type client: http_client.HttpClient
+        """
         self.end_point = endpoint or 'http://localhost:5555'
         self.verbose = verbose
         self.node_link = node_link
+        self.client = client or http_client.shared_http_client
 
     def tile_url(self, x, y, z):
         tile_url = self.end_point + '/tile/{}/{}/{}'.format(z, x, y)
@@ -85,13 +103,11 @@ class PerfTester:
     def measure_xyz(self, x, y, z):
         url = self.tile_url(x, y, z)
         start_time = time.time()
-        http_code = 200
         time_of_request = datetime.now()
         try:
-            tile_image_io = cStringIO.StringIO(urllib2.urlopen(url).read())
-        except urllib2.HTTPError as e:
-            if e.code == 404:
-                http_code = 404
+            http_code = self.client.request('GET', url).status
+        except urllib2.URLError:
+            http_code = 0
         end_time = time.time()
         time_taken_ms = round((end_time - start_time) * 10 ** 3, 2)
         tile_stat = TileTimeStat(x, y, z, time_taken_ms, http_code, time_of_request)
@@ -138,3 +154,89 @@ def perf_kaii(count=100):
     avg_kaii = kaiimap_performance_tester.perf_test_random_tiles(count, max_lod=20)
     print (avg_kaii)
     avg_kaii.append_to_file()
+
+
+def measure_persistence_throughput(persistence, node_links):
+    """
+    Times put_tree of a new node for every link, then get_tree of every link.
+
+    :return: puts per second, gets per second
+    :rtype: float, float
+    """
+    trees = [tree_creator.create_tree(node_link=node_link, children_links=(), persistence=persistence,
+                                      image_value_link='http://localhost/{}.jpg'.format(node_link.node_name))
+             for node_link in node_links]
+    start_time = time.time()
+    for tree in trees:
+        persistence.put_tree(tree)
+    put_seconds = time.time() - start_time
+    start_time = time.time()
+    for node_link in node_links:
+        persistence.get_tree(node_link)
+    get_seconds = time.time() - start_time
+    return len(node_links) / max(put_seconds, 1e-9), len(node_links) / max(get_seconds, 1e-9)
+
+
+def perf_persistences(count=1000):
+    """
+    Compares put and get throughput of the persistences on count single node trees.
+    Serializer writes one file per node, the node store persistences share one file name.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        persistences = [
+            ('MemoryPersistence', memory_persistence.MemoryPersistence(),
+             [NodeLink('memory_{}'.format(i)) for i in xrange(count)]),
+            ('Serializer', serializer.Serializer(),
+             [NodeLink('file_{}'.format(i), os.path.join(directory, 'file_{}.tsv'.format(i))) for i in xrange(count)]),
+            ('SqlitePersistence', sqlite_persistence.SqlitePersistence(os.path.join(directory, 'nodes.sqlite')),
+             [NodeLink('sqlite_{}'.format(i), 'bench.tsv') for i in xrange(count)]),
+            ('LogPersistence', log_persistence.LogPersistence(os.path.join(directory, 'log')),
+             [NodeLink('log_{}'.format(i), 'bench.tsv') for i in xrange(count)]),
+        ]
+        for name, persistence, node_links in persistences:
+            puts_per_second, gets_per_second = measure_persistence_throughput(persistence, node_links)
+            print('{}: {:.0f} puts per second, {:.0f} gets per second'.format(name, puts_per_second,
+                                                                              gets_per_second))
+    finally:
+        shutil.rmtree(directory)
+
+
+def memory_persistence_workload(persistence, thread_index, node_count):
+    """
+    Puts node_count nodes of its own and reads back every one, also reading the nodes of the other threads.
+
+    :type persistence: memory_persistence.MemoryPersistence
+    :raises custom_errors.NodeNotFoundException: If a node that was put is not found, or another tree is found
+        in its place.
+    """
+    node_links = [NodeLink('thread_{}_node_{}'.format(thread_index, i)) for i in xrange(node_count)]
+    for node_link in node_links:
+        tree = tree_creator.create_tree(node_link=node_link, children_links=(), persistence=persistence,
+                                        image_value_link='http://localhost/{}.jpg'.format(node_link.node_name))
+        persistence.put_tree(tree)
+        if not persistence.exists(node_link):
+            raise custom_errors.NodeNotFoundException('Put node does not exist ' + str(node_link))
+        if persistence.get_tree(node_link).value is not tree:
+            raise custom_errors.NodeNotFoundException('Got back another tree than the one put for ' + str(node_link))
+        persistence.exists(NodeLink('thread_{}_node_{}'.format(thread_index + 1, random.randrange(node_count))))
+
+
+def perf_memory_persistence_threads(thread_counts=(1, 2, 4, 8, 16), node_count=2000):
+    """
+    Operations per second of MemoryPersistence with growing numbers of threads each running
+    memory_persistence_workload.
+    """
+    for thread_count in thread_counts:
+        persistence = memory_persistence.MemoryPersistence()
+        threads = [threading.Thread(target=memory_persistence_workload, args=(persistence, i, node_count))
+                   for i in xrange(thread_count)]
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.time() - start_time
+        lost_count = thread_count * node_count - persistence.count_nodes()
+        print('{} threads: {:.0f} operations per second, {} lost'.format(
+            thread_count, 4 * thread_count * node_count / seconds, lost_count))
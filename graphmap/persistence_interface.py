@@ -6,6 +6,8 @@ class PersistenceInterface:
     """
     This class is responsible for storing and retrieving the image tree.
     """
+    # Trees loaded by a persistence use it as their serializer, which may cache their rendered images.
+    image_cache = None
 
     def exists(self, name):
         raise NotImplementedError('This is an interface, subclass this')
@@ -33,3 +35,11 @@ class PersistenceInterface:
         """
         raise NotImplementedError('This is an interface, subclass this')
 
+    def get_catalog(self):
+        """
+        Gets the index of the stored node links.
+
+        :rtype: catalog.CatalogInterface
+        """
+        raise NotImplementedError('This is an interface, subclass this')
+
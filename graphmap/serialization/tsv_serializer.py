@@ -28,7 +28,7 @@ def deserialize_to_imagetree_node(line, filename, serializer):
         if graphmap.utilities.is_image_file(image_url):
             image_value = graphmap.imagevalue.JpgWebImage(image_url)
         else:
-            image_value = serializer.load_node(link=image_url)
+            image_value = graphmap.imagevalue.NodeLinkImage(link=image_url, serializer=serializer)
     return graphmap.imagetree.ImageTree(name=name, input_image=image_value, children_links=children_names, children=[],
                                               serializer=serializer, filename=filename)
 
@@ -1,10 +1,16 @@
+import weakref
 from urllib2 import HTTPError
 
 from enum import Enum
 
+import catalog
+import constants
 import custom_errors
+import file_cache
 import imagetree
 import imagevalue
+import lru_cache
+import negative_cache
 import result
 import serialization.protbuf_serializer
 import serialization.tsv_serializer
@@ -44,13 +50,15 @@ def save_tree(tree):
     Saves a tree, saves all the nodes.
 
     :type tree: imagetree.ImageTree
-    :rtype: None
+    :return: The saved nodes by filename and node name.
+    :rtype: dict of str and (dict of str and imagetree.ImageTree)
     """
     print('Saving tree ', tree.name)
     filename_nodename_node_dictionary = tree.create_node_dictionary()
     for filename in filename_nodename_node_dictionary.iterkeys():
         list_of_nodes = filename_nodename_node_dictionary[filename].itervalues()
         save_tree_given_node_dictionary(filename, list_of_nodes)
+    return filename_nodename_node_dictionary
 
 
 def save_tree_given_node_dictionary(filename, list_of_nodes):
@@ -71,6 +79,7 @@ def save_tree_given_node_dictionary(filename, list_of_nodes):
     else:
         raise custom_errors.CreationFailedError('Unknown filetype ' + filename)
     utilities.put_contents(serialized_string, filename)
+    negative_cache.shared_negative_cache.discard_file(filename)
 
 
 def save_tree_only_filename(tree, filename):
@@ -95,6 +104,14 @@ def get_filetype(filename):
     return FileType.unknown
 
 
+def estimate_treemap_bytes(tree_map):
+    """
+    :type tree_map: treemap.TreeMap
+    :rtype: int
+    """
+    return tree_map.estimated_bytes()
+
+
 def load_link_new_serializer(link, image_cache=None):
     """
     Loads a link by creating a new Serializer.
@@ -108,13 +125,36 @@ def load_link_new_serializer(link, image_cache=None):
 
 
 class Serializer(PersistenceInterface):
-    def __init__(self, image_cache=None):
+    def __init__(self, image_cache=None, treemap_cache_bytes=constants.treemap_cache_bytes, shared_file_cache=None,
+                 prefetcher=None, missing_cache=None, node_catalog=None):
         """
 
         :type tree: imagetree.ImageTree
         :type image_cache: tile_disk_cache.TileCache
+        :param treemap_cache_bytes: Memory budget for the loaded files. Least recently used files are evicted and
+        are loaded again when needed.
+        :type treemap_cache_bytes: int
+        :param shared_file_cache: Cache of files shared with other serializers, by default the process wide one.
+        :type shared_file_cache: file_cache.FileCache
+        :param prefetcher: If given, files linked from a loaded file are loaded in background.
+        :type prefetcher: link_prefetcher.LinkPrefetcher
+        :param missing_cache: Remembers missing files and nodes, by default the process wide one.
+        :type missing_cache: negative_cache.NegativeCache
+        :param node_catalog: Index of the nodes of the files loaded or saved by this serializer. By default the
+            nodes of a loaded file are listed only while the file is loaded, so that the index is bounded by
+            treemap_cache_bytes. A given catalog keeps them.
+        :type node_catalog: catalog.CatalogInterface
         """
-        self.filename_treemap_map = {}
+        self.prefetcher = prefetcher
+        self._owns_catalog = node_catalog is None
+        self.catalog = node_catalog if node_catalog is not None else catalog.MemoryCatalog()
+        self.missing_cache = missing_cache if missing_cache is not None else negative_cache.shared_negative_cache
+        self.shared_file_cache = shared_file_cache if shared_file_cache is not None else file_cache.shared_file_cache
+        self.filename_treemap_map = lru_cache.ByteLruCache(max_bytes=treemap_cache_bytes,
+                                                           size_function=estimate_treemap_bytes,
+                                                           eviction_callback=self._on_treemap_evicted)
+        # Weak, so that linked nodes are held by the bounded filename_treemap_map and by their users, not pinned here.
+        self.linked_image_map = weakref.WeakValueDictionary()
         self.image_cache = image_cache
 
     def load_from_string(self, node_name, filename, serialized_string):
@@ -131,23 +171,68 @@ class Serializer(PersistenceInterface):
         nodename_with_operator, filename = utilities.resolve_link(link)
         if filename is None:
             return standard_nodes.not_found_node(self, filename='')
-        if not filename in self.filename_treemap_map:
+        nodename, operators_list = tree_operator.get_nodename_and_operators_list(nodename_with_operator)
+        tree_map = self.filename_treemap_map.get(filename)
+        if tree_map is None:
+            if serialized_string is None:
+                # Known misses are answered without touching the file.
+                if self.missing_cache.is_missing(negative_cache.file_key(filename)):
+                    return standard_nodes.not_found_node(self, filename='')
+                if self.missing_cache.is_missing(negative_cache.node_key(filename, nodename)):
+                    return standard_nodes.not_found_node(serializer=self, filename=filename)
             print('Loading node ', nodename_with_operator, ' from file ', filename)
             if serialized_string is None:
                 try:
-                    serialized_string = utilities.get_contents_of_file(filename)
-                except HTTPError:
+                    tree_map = self.load_tree_map(filename)
+                except (IOError, OSError) as e:
+                    # A missing local file, or a missing remote one. Other network errors may be transient.
+                    if utilities.is_web_link(filename) and not isinstance(e, HTTPError):
+                        raise
+                    self.missing_cache.add(negative_cache.file_key(filename))
                     return standard_nodes.not_found_node(self, filename='')
-            self.filename_treemap_map[filename] = self.deserialize_string_to_tree_map(filename,
-                                                                                      serialized_string=serialized_string)
-        nodename, operators_list = tree_operator.get_nodename_and_operators_list(nodename_with_operator)
-        if self.filename_treemap_map[filename].has_node(nodename):
-            unoperated_node = self.filename_treemap_map[filename].get_node(nodename)
+                if self.prefetcher is not None:
+                    self.prefetcher.prefetch_linked_files(tree_map, filename, serializer=self)
+            else:
+                tree_map = self.deserialize_string_to_tree_map(filename, serialized_string=serialized_string)
+                self.filename_treemap_map[filename] = tree_map
+            self.catalog.add_many((filename, node_name) for node_name in tree_map.node_names())
+        if tree_map.has_node(nodename):
+            unoperated_node = tree_map.get_node(nodename)
             return tree_operator.apply_operators(unoperated_node, operators_list)
         else:
             print('Node ', nodename, ' not found in file ', filename, ' returning not found blank node.')
+            self.missing_cache.add(negative_cache.node_key(filename, nodename))
             return standard_nodes.not_found_node(serializer=self, filename=filename)
 
+    def _on_treemap_evicted(self, filename, tree_map):
+        if self._owns_catalog:
+            self.catalog.remove_file(filename)
+
+    def load_tree_map(self, filename):
+        """
+        Parses the file from the shared file cache and keeps it among the files loaded by this serializer.
+
+        :type filename: str
+        :rtype: treemap.TreeMap
+        """
+        tree_map = self.shared_file_cache.get_tree_map(filename, serializer=self)
+        self.filename_treemap_map[filename] = tree_map
+        return tree_map
+
+    def load_linked_image(self, link):
+        """
+        Loads the node used as image value by a imagevalue.NodeLinkImage. Shared by all the nodes that link to it
+        while it is in use.
+
+        :type link: str
+        :rtype: imagetree.ImageTree
+        """
+        image_tree = self.linked_image_map.get(link)
+        if image_tree is None:
+            image_tree = self.load_node(link=link)
+            self.linked_image_map[link] = image_tree
+        return image_tree
+
     def deserialize_string_to_tree_map(self, filename, serialized_string):
         """
         Given a serialized string and a filename from which it was created,
@@ -170,7 +255,10 @@ class Serializer(PersistenceInterface):
             raise Exception('Unknown filetype ' + filename)
 
     def put_tree(self, image_tree):
-        save_tree(image_tree)
+        filename_nodename_node_dictionary = save_tree(image_tree)
+        self.catalog.add_many((filename or '', node_name)
+                              for filename, nodename_node_dictionary in filename_nodename_node_dictionary.iteritems()
+                              for node_name in nodename_node_dictionary)
 
     def get_tree(self, node_link):
         """
@@ -185,7 +273,18 @@ class Serializer(PersistenceInterface):
             return result.fail(result.NODE_LINK_NOT_FOUND_ERROR_CODE, e.message)
 
     def get_all_node_links(self):
-        return (node_name for filename in self.filename_treemap_map for node_name in filename)
+        return list(self.catalog.iter_node_links())
+
+    def get_catalog(self):
+        return self.catalog
+
+    def treemap_cache_stats(self):
+        """
+        Hit, miss and eviction counters of the loaded files.
+
+        :rtype: dict
+        """
+        return self.filename_treemap_map.stats_dict()
 
 
 def create_tree_from_jpg_url(url, name, serializer, filename='create_tree_from_jpg_url'):
@@ -0,0 +1,58 @@
+"""
+Coalescing of concurrent calls that compute the same thing.
+"""
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        """
+        Runs at most one call per key at a time. Callers that ask for a key which is already being computed wait for
+        that call and get its value, or its exception.
+        """
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced_count = 0
+
+    def do(self, key, function):
+        """
+        Calls function() unless a call for the same key is in flight, in which case waits for that one.
+
+        :param key: Any hashable value identifying the work.
+        :param function: Function with no arguments that does the work.
+        :return: Return value of function.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self.coalesced_count += 1
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = function()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value
+
+    def in_flight_count(self):
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,117 @@
+"""
+Persistence of ImageTree nodes in a SQLite database, one row per node.
+"""
+import sqlite3
+import threading
+
+import node_store
+import utilities
+
+schema = [
+    'CREATE TABLE IF NOT EXISTS nodes ('
+    ' filename TEXT NOT NULL,'
+    ' name TEXT NOT NULL,'
+    ' serialized_node TEXT NOT NULL,'
+    ' PRIMARY KEY (filename, name)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS child_links ('
+    ' filename TEXT NOT NULL,'
+    ' name TEXT NOT NULL,'
+    ' child_index INTEGER NOT NULL,'
+    ' child_link TEXT NOT NULL,'
+    ' PRIMARY KEY (filename, name, child_index)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS child_links_by_child_link ON child_links (child_link)',
+]
+
+
+class SqlitePersistence(node_store.NodeStorePersistence):
+    store_name = 'SQLite Persistence'
+
+    def __init__(self, database_filename):
+        """
+        Nodes are rows keyed by (filename, node name), so a lookup is a B-tree search. Children are loaded lazily,
+        one query per node, when they are first accessed.
+
+        The database is in WAL mode, readers are not blocked by a writer. Each thread uses its own connection.
+
+        :type database_filename: str
+        """
+        node_store.NodeStorePersistence.__init__(self)
+        self.database_filename = database_filename
+        self._local = threading.local()
+        connection = self.connection()
+        with connection:
+            for statement in schema:
+                connection.execute(statement)
+
+    def connection(self):
+        """
+        The connection of the current thread.
+
+        :rtype: sqlite3.Connection
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_filename, timeout=30)
+            connection.text_factory = str
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def exists(self, node_link):
+        """
+        Checks if given node link is stored.
+
+        :type node_link: graph_helpers.NodeLink
+        :rtype: bool
+        """
+        filename, node_name = node_store.to_key(node_link)
+        row = self.connection().execute('SELECT 1 FROM nodes WHERE filename = ? AND name = ?',
+                                        (filename, node_name)).fetchone()
+        return row is not None
+
+    def read_serialized_node(self, filename, node_name):
+        row = self.connection().execute('SELECT serialized_node FROM nodes WHERE filename = ? AND name = ?',
+                                        (filename, node_name)).fetchone()
+        return row[0] if row is not None else None
+
+    def write_serialized_nodes(self, rows):
+        """
+        Writes all the nodes in one transaction.
+        """
+        connection = self.connection()
+        with connection:
+            connection.executemany('INSERT OR IGNORE INTO nodes (filename, name, serialized_node) VALUES (?, ?, ?)',
+                                   [(filename, name, serialized_node) for filename, name, serialized_node, _ in rows])
+            connection.executemany('INSERT OR IGNORE INTO child_links (filename, name, child_index, child_link) '
+                                   'VALUES (?, ?, ?, ?)',
+                                   [(filename, name, index, child_link)
+                                    for filename, name, _, children_links in rows
+                                    for index, child_link in enumerate(children_links)])
+
+    def get_parent_links(self, node_link):
+        """
+        Gets the links of the stored nodes that have the given node as a child.
+
+        :type node_link: graph_helpers.NodeLink or str
+        :rtype: list of str
+        """
+        rows = self.connection().execute('SELECT DISTINCT filename, name FROM child_links WHERE child_link = ?',
+                                         (str(node_link),))
+        return [utilities.format_node_address(filename=filename, node_name=name) for filename, name in rows]
+
+    def get_all_node_links(self):
+        rows = self.connection().execute('SELECT filename, name FROM nodes')
+        return [utilities.format_node_address(filename=filename, node_name=name) for filename, name in rows]
+
+    def count_nodes(self):
+        return self.connection().execute('SELECT COUNT(*) FROM nodes').fetchone()[0]
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def __repr__(self):
+        return 'SqlitePersistence({})'.format(self.database_filename)
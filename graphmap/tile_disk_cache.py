@@ -1,16 +1,28 @@
 """
 Disk caching ImageTree get pil image function
 """
-import ntpath
+import cStringIO
+import hashlib
 import os
-import random
 import shutil
-import string
+import threading
+import time
+from collections import OrderedDict
 
+import constants
 import imagetree
+import tree_operator
 import utilities
 from PIL import Image
 
+try:
+    import fcntl
+except ImportError:
+    # Windows, where the index saves of processes sharing a cache directory are not serialized.
+    fcntl = None
+
+index_filename = 'tile_index.tsv'
+
 
 class CacheStats:
     def __init__(self, cache_count, cache_dir, used_space, free_space):
@@ -28,46 +40,317 @@ class CacheStats:
         return CacheStats(0, '.', 0, 0)
 
 
-def save_image_to_disk(file_path, pil_image):
+def encode_image(pil_image, tile_format='JPEG'):
+    """
+    :type pil_image: Image.Image
+    :param tile_format: A PIL format name, JPEG or PNG.
+    :return: Encoded bytes.
+    :rtype: str
+    """
+    image_stream = cStringIO.StringIO()
+    pil_image.save(image_stream, tile_format)
+    return image_stream.getvalue()
+
+
+def decode_image(encoded_image):
+    """
+    :type encoded_image: str
+    :rtype: Image.Image
+    """
+    pil_image = Image.open(cStringIO.StringIO(encoded_image))
+    pil_image.load()
+    return pil_image
+
+
+def save_encoded_image_to_disk(file_path, encoded_image):
+    """
+    Writes to a temporary file renamed into place, so that other processes sharing the cache never read a partial
+    file.
+    """
     directory_to_save = os.path.dirname(file_path)
     if not os.path.isdir(directory_to_save):
         utilities.mkdir_p(directory_to_save)
-    pil_image.save(file_path, "JPEG")
+    utilities.write_file_atomically(file_path, encoded_image)
     print('Saved image to file ', file_path)
 
 
-def to_valid_filename(link):
+def save_image_to_disk(file_path, pil_image):
+    save_encoded_image_to_disk(file_path, encode_image(pil_image))
+
+
+def tile_key(node_link, resolution):
+    """
+    Key of a tile, the same in every process. The node link of an operated tree has its operators in the name, so
+    the operators are part of the key.
+
+    :type node_link: str
+    :type resolution: int
+    :return: Hex digest.
+    :rtype: str
+    """
+    return hashlib.sha1('{}\t{}'.format(node_link, resolution)).hexdigest()
+
+
+def canonical_node_link(node_link):
+    """
+    The link with the operator chain of the node name composed, see tree_operator.canonical_node_name.
+
+    :type node_link: str
+    :rtype: str
+    """
+    node_name, filename = utilities.resolve_link(str(node_link))
+    return utilities.format_node_address(filename=filename, node_name=tree_operator.canonical_node_name(node_name))
+
+
+def tree_tile_key(image_tree, resolution):
+    """
+    Key of the image of a whole tree, the same for all the operator chains that render the same.
+
+    :type image_tree: imagetree.ImageTree
+    :rtype: str
     """
-    Convert a unique root link to unique filename. Should not have non approved characters, but should
-    not map to same name, so hashing.
+    return tile_key(canonical_node_link(image_tree.get_link()), resolution)
+
+
+def encoded_tile_key(node_link, quad_key, resolution, tile_format):
+    """
+    Key of the encoded tile at quad key of a tree.
+
+    :rtype: str
     """
-    link_hash = str(hash(link))[1:10]  # skipping 1 to ignore negative sign
-    valid_chars = "%s%s" % (string.ascii_letters, string.digits)
-    valid_filename = ''.join(i for i in (link + link_hash) if i in valid_chars)
-    return valid_filename
+    return hashlib.sha1('{}\t{}\t{}\t{}'.format(node_link, quad_key, resolution, tile_format)).hexdigest()
+
+
+def tile_key_to_relative_path(key, extension='.jpg'):
+    """
+    Two levels of 256 directories, so that no directory gets too big with tens of millions of tiles.
+
+    :type key: str
+    :rtype: str
+    """
+    return os.path.join(key[0:2], key[2:4], key + extension)
 
 
 class TileCache:
-    def __init__(self, cache_dir, size, verbose=False):
+    def __init__(self, cache_dir, size, verbose=False, max_bytes=constants.tile_cache_max_bytes,
+                 index_save_interval=constants.tile_index_save_interval,
+                 high_watermark=constants.tile_cache_high_watermark, low_watermark=constants.tile_cache_low_watermark,
+                 eviction_batch_size=constants.tile_eviction_batch_size, background_eviction=True):
+        """
+        Disk cache of rendered tiles. An in memory index of the cached files, in least recently used order, answers
+        lookups and stats without touching the disk and picks what to evict. The index is saved in the cache
+        directory, so a restart does not walk the directory.
+
+        Processes sharing cache_dir share the saved index. Each save merges the in memory index with the saved one
+        under a file lock: tiles stored by other processes are adopted, so they are evicted too, and tiles the saved
+        index no longer has, because another process evicted them, are dropped.
+
+        When the cached bytes go over high_watermark of max_bytes, or the count over size, a background thread
+        evicts least recently used tiles in batches until the bytes are under low_watermark of max_bytes and the
+        count is within size. The same thread saves the index every index_save_interval tiles stored or removed. The
+        index is merged and written outside the lock, requests never wait for eviction or for an index save.
+
+        :param size: Maximum number of cached tiles.
+        :param max_bytes: Capacity in bytes of the cached tiles, None for no limit.
+        :param index_save_interval: The index is saved after this many tiles are stored or removed, and on close.
+        :param high_watermark: Fraction of max_bytes above which eviction starts.
+        :param low_watermark: Fraction of max_bytes down to which eviction goes.
+        :param eviction_batch_size: Tiles removed from the index under one hold of the lock.
+        :param background_eviction: Whether eviction and index saves run on a background thread, or inline in the
+            request.
+        """
         self.cache_dir = cache_dir
         self.size = size
-        self.cache_count = 0
+        self.max_bytes = max_bytes
         self.verbose = verbose
+        self.index_save_interval = index_save_interval
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.eviction_batch_size = eviction_batch_size
+        self.background_eviction = background_eviction
+        self._entries = OrderedDict()  # path relative to cache_dir -> (size in bytes, last access time), oldest first
+        self._lock = threading.Lock()
+        self._eviction_requested = threading.Event()
+        self._eviction_thread = None
+        self._index_save_requested = False
+        self._closed = False
+        self._changes_since_save = 0
+        self._saved_paths = set()  # paths in the saved index as of the last load or save
+        self._removed_paths = set()  # paths removed by this process since the last save
+        self._touched_paths = None  # paths added or removed while a save merges the index, None between saves
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
         if not os.path.isdir(self.cache_dir):
             os.mkdir(self.cache_dir)
             print 'Created cache directory %s' \
                   % os.path.join(os.path.abspath(__file__), self.cache_dir)
         else:
-            self.cache_count = self.count_files_in_disk()
+            self.load_index()
             print('Cache dir ', self.cache_dir, ' already exists, current no. of files ', self.cache_count)
 
+    @property
+    def cache_count(self):
+        return len(self._entries)
+
+    def index_path(self):
+        return os.path.join(self.cache_dir, index_filename)
+
+    def read_saved_index(self):
+        """
+        :return: Path relative to cache_dir, size in bytes and last access time of the saved entries, oldest first.
+        :rtype: OrderedDict
+        """
+        saved_entries = OrderedDict()
+        if os.path.isfile(self.index_path()):
+            with open(self.index_path()) as f:
+                for line in f:
+                    relative_path, file_size, last_access = line.rstrip('\n').split('\t')
+                    saved_entries[relative_path] = (int(file_size), float(last_access))
+        return saved_entries
+
+    def load_index(self):
+        """
+        Reads the saved index. Without one, for caches written by older versions, the directory is walked once.
+        """
+        self._entries.clear()
+        self.used_bytes = 0
+        if os.path.isfile(self.index_path()):
+            for relative_path, (file_size, last_access) in self.read_saved_index().iteritems():
+                self._add_entry(relative_path, file_size, last_access)
+            self._saved_paths = set(self._entries)
+            return
+        for directory, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.startswith(index_filename) or filename.endswith('.tmp'):
+                    continue
+                file_path = os.path.join(directory, filename)
+                self._add_entry(os.path.relpath(file_path, self.cache_dir), os.path.getsize(file_path),
+                                os.path.getmtime(file_path))
+        self._entries = OrderedDict(sorted(self._entries.iteritems(), key=lambda item: item[1][1]))
+
+    def save_index(self):
+        """
+        Merges the index with the saved one and writes it, in least recently used order, to a temporary file renamed
+        over the previous one.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        with open(self.index_path() + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                lines = self._merge_saved_index(self.read_saved_index())
+                utilities.write_file_atomically(self.index_path(), ''.join(lines))
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _merge_saved_index(self, saved_entries):
+        """
+        Adopts the saved entries this process does not know of and drops the entries other processes removed.
+
+        The lock is held only to copy the entries, and at the end to swap the merged index in, after re-applying the
+        paths added or removed meanwhile, which go to the recent end.
+
+        :type saved_entries: OrderedDict
+        :return: Lines of the merged index.
+        :rtype: list of str
+        """
+        with self._lock:
+            # A plain dict copy, of the hash table only. The order is rebuilt from the access times.
+            known_entries = dict.copy(self._entries)
+            saved_paths = self._saved_paths
+            removed_paths = self._removed_paths
+            self._removed_paths = set()
+            self._touched_paths = set()
+            self._changes_since_save = 0
+        merged_entries = {}
+        for relative_path, saved_entry in saved_entries.iteritems():
+            if relative_path not in removed_paths:
+                merged_entries[relative_path] = saved_entry
+        for relative_path, (file_size, last_access) in known_entries.iteritems():
+            saved_entry = saved_entries.get(relative_path)
+            if saved_entry is None and relative_path in saved_paths:
+                # Evicted by another process.
+                continue
+            merged_entries[relative_path] = (file_size, max(last_access, saved_entry[1] if saved_entry else 0))
+        entries = OrderedDict(sorted(merged_entries.iteritems(), key=lambda item: item[1][1]))
+        used_bytes = sum(file_size for file_size, _ in merged_entries.itervalues())
+        lines = ['{}\t{}\t{}\n'.format(relative_path, file_size, last_access)
+                 for relative_path, (file_size, last_access) in entries.iteritems()]
+        merged_paths = set(merged_entries)
+        with self._lock:
+            for relative_path in self._touched_paths:
+                merged_entry = entries.pop(relative_path, None)
+                if merged_entry is not None:
+                    used_bytes -= merged_entry[0]
+                current_entry = self._entries.get(relative_path)
+                if current_entry is not None:
+                    entries[relative_path] = current_entry
+                    used_bytes += current_entry[0]
+            self._touched_paths = None
+            # The previous index is freed after the lock is released, freeing a large one takes a while.
+            previous_entries, self._entries = self._entries, entries
+            self.used_bytes = used_bytes
+            self._saved_paths = merged_paths
+        del previous_entries
+        return lines
+
+    def close(self):
+        """
+        Stops the eviction thread, evicts what is still over the budget and saves the index.
+        """
+        eviction_thread = self._eviction_thread
+        if eviction_thread is not None:
+            self._closed = True
+            self._eviction_requested.set()
+            eviction_thread.join()
+            self._eviction_thread = None
+            self._closed = False
+        self.evict()
+        self.save_index()
+
+    def _add_entry(self, relative_path, file_size, last_access):
+        previous_entry = self._entries.pop(relative_path, None)
+        if previous_entry is not None:
+            self.used_bytes -= previous_entry[0]
+        self._entries[relative_path] = (file_size, last_access)
+        self.used_bytes += file_size
+        self._removed_paths.discard(relative_path)
+        if self._touched_paths is not None:
+            self._touched_paths.add(relative_path)
+
+    def _remove_entry(self, relative_path):
+        file_size, _ = self._entries.pop(relative_path)
+        self.used_bytes -= file_size
+        self._removed_paths.add(relative_path)
+        if self._touched_paths is not None:
+            self._touched_paths.add(relative_path)
+
+    def _count_changes(self, change_count=1):
+        """
+        Counts tiles stored or removed, accesses alone do not make the index worth saving.
+
+        :return: Whether the index should be saved.
+        :rtype: bool
+        """
+        self._changes_since_save += change_count
+        return self._changes_since_save >= self.index_save_interval
+
     def cache_burst(self):
         print('Cache burst')
         current_count = self.cache_count
         free_space = self.disk_stats()
         shutil.rmtree(self.cache_dir, ignore_errors=True)
+        utilities.mkdir_p(self.cache_dir)
+        with self._lock:
+            self._entries.clear()
+            self.used_bytes = 0
+            self._saved_paths = set()
+            self._removed_paths = set()
         now_space = self.disk_stats()
-        self.cache_count = 0
         return 'Had ' + str(current_count) + ' images in disk cache.' + 'Previously ' + free_space + '\n' + now_space
 
     def image_tree_args_to_path(self, image_tree, resolution):
@@ -77,19 +360,92 @@ class TileCache:
         :type resolution: int
         :rtype:str
         """
-        return ntpath.join(self.cache_dir, str(resolution),
-                           to_valid_filename(image_tree.filename), to_valid_filename(image_tree.name) + '.jpg')
+        return os.path.join(self.cache_dir, self.image_tree_args_to_relative_path(image_tree, resolution))
+
+    def image_tree_args_to_relative_path(self, image_tree, resolution):
+        return tile_key_to_relative_path(tree_tile_key(image_tree, resolution))
 
     def count_files_in_disk(self):
-        return sum(len(files) for r, d, files in os.walk(self.cache_dir))
+        """
+        Walks the cache directory, the index is not used.
+        """
+        return sum(len([f for f in files if not f.startswith(index_filename) and not f.endswith('.tmp')])
+                   for r, d, files in os.walk(self.cache_dir))
 
-    def remove_random(self):
-        path, dirs, files = os.walk(self.cache_dir).next()
-        chosen_file = random.choice(files)
-        if self.verbose:
-            print('Removing file randomly ', chosen_file)
-        os.remove(chosen_file)
-        self.cache_count -= 1
+    def is_over_budget(self, watermark=None):
+        """
+        :param watermark: Fraction of max_bytes, high_watermark by default.
+        :rtype: bool
+        """
+        if watermark is None:
+            watermark = self.high_watermark
+        return self.cache_count > self.size or (self.max_bytes is not None and
+                                                self.used_bytes > self.max_bytes * watermark)
+
+    def _request_eviction(self):
+        if not self.background_eviction:
+            self.evict()
+            return
+        self._wake_eviction_thread()
+
+    def _request_index_save(self):
+        if not self.background_eviction:
+            self.save_index()
+            return
+        self._index_save_requested = True
+        self._wake_eviction_thread()
+
+    def _wake_eviction_thread(self):
+        with self._lock:
+            if self._eviction_thread is None:
+                self._eviction_thread = threading.Thread(target=self._eviction_loop, name='TileCacheEviction')
+                self._eviction_thread.daemon = True
+                self._eviction_thread.start()
+        self._eviction_requested.set()
+
+    def _eviction_loop(self):
+        while True:
+            self._eviction_requested.wait()
+            self._eviction_requested.clear()
+            if self._closed:
+                return
+            self.evict()
+            if self._index_save_requested:
+                self._index_save_requested = False
+                try:
+                    self.save_index()
+                except (IOError, OSError) as e:
+                    # The merged index is kept in memory, the next save writes it.
+                    print('Save of index {} failed with {}'.format(self.index_path(), e))
+
+    def evict(self):
+        """
+        If the cache is over the high watermark, removes least recently used tiles, a batch at a time, until it is
+        under the low watermark. Files are removed without holding the lock.
+        """
+        if not self.is_over_budget():
+            return
+        while True:
+            with self._lock:
+                batch = []
+                while (len(batch) < self.eviction_batch_size and self._entries and
+                       self.is_over_budget(self.low_watermark)):
+                    relative_path = next(iter(self._entries))
+                    self._remove_entry(relative_path)
+                    batch.append(relative_path)
+                self.evictions += len(batch)
+                should_save = self._count_changes(len(batch))
+            if not batch:
+                if should_save:
+                    self._request_index_save()
+                return
+            for relative_path in batch:
+                if self.verbose:
+                    print('Evicting least recently used file ', relative_path)
+                try:
+                    os.remove(os.path.join(self.cache_dir, relative_path))
+                except OSError:
+                    pass
 
     def disk_stats(self):
         """ Gets the size of cache and free space left"""
@@ -97,7 +453,7 @@ class TileCache:
 
     def stats(self):
         return CacheStats(cache_count=self.cache_count, cache_dir=self.cache_dir,
-                          used_space=utilities.get_used_space_mb(self.cache_dir),
+                          used_space=self.used_bytes / 1024 / 1024,
                           free_space=utilities.get_free_space_mb(self.cache_dir))
 
     def stats_dict(self):
@@ -105,48 +461,119 @@ class TileCache:
         return {'cache count': str(self.cache_count),
                 'cache dir': self.cache_dir,
                 'used space': str(cache_stats.used_space) + ' MB',
-                'free space': str(cache_stats.free_space) + ' MB'}
+                'free space': str(cache_stats.free_space) + ' MB',
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
 
     def has_image(self, image_tree, resolution):
         """
-        Determines whether the cache has image for given tree or not.
+        Determines whether the cache has image for given tree or not. Tiles not in the index may have been stored
+        by another process sharing the directory.
         :type image_tree: imagetree.ImageTree
         :type resolution: int
         :rtype : bool
         """
-        file_path = self.image_tree_args_to_path(image_tree, resolution)
+        relative_path = self.image_tree_args_to_relative_path(image_tree, resolution)
         if self.verbose:
-            print('file path is ', file_path, ' count is ', self.cache_count)
-        return os.path.isfile(file_path)
+            print('file path is ', relative_path, ' count is ', self.cache_count)
+        with self._lock:
+            is_indexed = relative_path in self._entries
+        return is_indexed or os.path.isfile(os.path.join(self.cache_dir, relative_path))
 
     def get_image(self, image_tree, resolution):
         """
-        Gets the image already present in cache.
+        Gets the image from the cache with a single open of its file.
 
         :type image_tree: imagetree.ImageTree
         :type resolution: int
-        :rtype : bool
+        :return: The image, None if it is not cached.
+        :rtype : Image.Image
         """
-        file_path = self.image_tree_args_to_path(image_tree, resolution)
-        pil_image = Image.open(file_path)
-        pil_image.load()
-        return pil_image
+        encoded_image = self.get_encoded_image(image_tree, resolution)
+        return decode_image(encoded_image) if encoded_image is not None else None
+
+    def get_encoded_image(self, image_tree, resolution):
+        """
+        Gets the JPEG bytes of the image, without decoding them.
+
+        :return: The bytes, None if the image is not cached.
+        :rtype: str
+        """
+        return self.get_encoded(tree_tile_key(image_tree, resolution))
+
+    def get_encoded(self, key, node_link='', zoom=None):
+        """
+        Gets the bytes stored for a key with a single open of its file.
+
+        :param key: A tile_key or encoded_tile_key.
+        :param node_link: Root of the tile, for instrumentation, not used by this cache.
+        :param zoom: Zoom level of the tile, for instrumentation, not used by this cache.
+        :return: The bytes, None if the key is not cached.
+        :rtype: str
+        """
+        relative_path = tile_key_to_relative_path(key)
+        try:
+            with open(os.path.join(self.cache_dir, relative_path), 'rb') as f:
+                encoded_image = f.read()
+        except IOError:
+            with self._lock:
+                self.misses += 1
+                should_save = False
+                if relative_path in self._entries:
+                    self._remove_entry(relative_path)
+                    should_save = self._count_changes()
+            if should_save:
+                self._request_index_save()
+            return None
+        with self._lock:
+            self.hits += 1
+            # Files written before a crash that lost the index, or by another process, are adopted.
+            is_adopted = relative_path not in self._entries
+            self._add_entry(relative_path, len(encoded_image), time.time())
+            should_save = is_adopted and self._count_changes()
+        if should_save:
+            self._request_index_save()
+        return encoded_image
 
     def put_image(self, pil_image, image_tree, resolution):
         """
-        Determines whether the cache has image for given tree or not.
+        Saves the image and evicts least recently used images if the cache is over its bounds.
         :type  pil_image: Image.Image
         :type image_tree: imagetree.ImageTree
         :type resolution: int
-        :rtype : bool
+        :rtype : Image.Image
         """
-        file_path = self.image_tree_args_to_path(image_tree, resolution)
-        save_image_to_disk(file_path, pil_image)
-        self.cache_count += 1
-        if self.cache_count > self.size:
-            self.remove_random()
+        self.put_encoded_image(encode_image(pil_image), image_tree, resolution)
         return pil_image
 
+    def put_encoded_image(self, encoded_image, image_tree, resolution):
+        """
+        Saves JPEG bytes of an image.
+
+        :type encoded_image: str
+        """
+        self.put_encoded(tree_tile_key(image_tree, resolution), encoded_image, image_tree.get_link(), resolution)
+
+    def put_encoded(self, key, encoded_image, node_link='', resolution=0):
+        """
+        Saves bytes for a key, stored as they are.
+
+        :param key: A tile_key or encoded_tile_key.
+        :type encoded_image: str
+        :param node_link: Link of the tree the bytes were rendered from, not used by this cache.
+        :param resolution: Resolution of the tile, not used by this cache.
+        """
+        relative_path = tile_key_to_relative_path(key)
+        save_encoded_image_to_disk(os.path.join(self.cache_dir, relative_path), encoded_image)
+        with self._lock:
+            self._add_entry(relative_path, len(encoded_image), time.time())
+            should_save = self._count_changes()
+        if self.is_over_budget():
+            self._request_eviction()
+        if should_save:
+            self._request_index_save()
+
     def __repr__(self):
-        return 'TileCache(cache_dir={}, size={}, verbose={}). Cache Count is {}' \
-            .format(self.cache_dir, self.size, self.verbose, self.cache_count)
+        return 'TileCache(cache_dir={}, size={}, max_bytes={}, verbose={}). Cache Count is {}, {} bytes' \
+            .format(self.cache_dir, self.size, self.max_bytes, self.verbose, self.cache_count, self.used_bytes)
@@ -0,0 +1,129 @@
+"""
+Memory tier of encoded tiles in front of the disk TileCache.
+"""
+import threading
+
+import constants
+import lru_cache
+import tile_disk_cache
+
+
+def hit_ratio(hits, misses):
+    lookups = hits + misses
+    return float(hits) / lookups if lookups else 0.0
+
+
+class TieredTileCache:
+    def __init__(self, disk_cache, max_memory_bytes=constants.tile_memory_cache_bytes):
+        """
+        Keeps the JPEG bytes of recently used tiles in memory, bounded by their total size. A memory miss goes to
+        the disk cache, and a disk hit is promoted to memory. Used wherever a TileCache is.
+
+        :type disk_cache: tile_disk_cache.TileCache or tile_pack_cache.SqliteTileCache
+        :type max_memory_bytes: int
+        """
+        self.disk_cache = disk_cache
+        self.memory_cache = lru_cache.ByteLruCache(max_bytes=max_memory_bytes, size_function=len)
+        self._lock = threading.Lock()
+
+    def _key(self, image_tree, resolution):
+        return tile_disk_cache.tree_tile_key(image_tree, resolution)
+
+    def has_image(self, image_tree, resolution):
+        """
+        :type image_tree: imagetree.ImageTree
+        :type resolution: int
+        :rtype: bool
+        """
+        with self._lock:
+            if self._key(image_tree, resolution) in self.memory_cache:
+                return True
+        return self.disk_cache.has_image(image_tree, resolution)
+
+    def get_encoded_image(self, image_tree, resolution):
+        """
+        Gets the JPEG bytes of the tile, from memory if possible.
+
+        :return: The bytes, None if the tile is in neither tier.
+        :rtype: str
+        """
+        return self.get_encoded(self._key(image_tree, resolution))
+
+    def get_encoded(self, key, node_link='', zoom=None):
+        """
+        :param key: A tile_disk_cache.tile_key or encoded_tile_key.
+        :param node_link: Root of the tile and zoom its level, passed to the disk cache for instrumentation.
+        :return: The stored bytes, None if the key is in neither tier.
+        :rtype: str
+        """
+        with self._lock:
+            encoded_image = self.memory_cache.get(key)
+        if encoded_image is not None:
+            return encoded_image
+        encoded_image = self.disk_cache.get_encoded(key, node_link=node_link, zoom=zoom)
+        if encoded_image is not None:
+            with self._lock:
+                self.memory_cache[key] = encoded_image
+        return encoded_image
+
+    def get_image(self, image_tree, resolution):
+        """
+        :return: The decoded tile, None if the tile is in neither tier.
+        :rtype: Image.Image
+        """
+        encoded_image = self.get_encoded_image(image_tree, resolution)
+        return tile_disk_cache.decode_image(encoded_image) if encoded_image is not None else None
+
+    def put_encoded_image(self, encoded_image, image_tree, resolution):
+        """
+        Stores the JPEG bytes in both tiers.
+
+        :type encoded_image: str
+        """
+        self.put_encoded(self._key(image_tree, resolution), encoded_image, image_tree.get_link(), resolution)
+
+    def put_encoded(self, key, encoded_image, node_link='', resolution=0):
+        """
+        Stores bytes for a key in both tiers.
+        """
+        self.disk_cache.put_encoded(key, encoded_image, node_link=node_link, resolution=resolution)
+        with self._lock:
+            self.memory_cache[key] = encoded_image
+
+    def put_image(self, pil_image, image_tree, resolution):
+        """
+        Encodes the tile once and stores it in both tiers.
+
+        :type pil_image: Image.Image
+        :rtype: Image.Image
+        """
+        self.put_encoded_image(tile_disk_cache.encode_image(pil_image), image_tree, resolution)
+        return pil_image
+
+    def cache_burst(self):
+        with self._lock:
+            self.memory_cache.clear()
+        return self.disk_cache.cache_burst()
+
+    def close(self):
+        self.disk_cache.close()
+
+    def stats_dict(self):
+        """
+        Stats of the disk cache, and hit ratios and sizes of each tier.
+
+        :rtype: dict
+        """
+        stats = self.disk_cache.stats_dict()
+        with self._lock:
+            memory_stats = self.memory_cache.stats_dict()
+            memory_hit_ratio = hit_ratio(self.memory_cache.hits, self.memory_cache.misses)
+        stats['memory hit ratio'] = memory_hit_ratio
+        stats['disk hit ratio'] = hit_ratio(self.disk_cache.hits, self.disk_cache.misses)
+        for name, value in memory_stats.iteritems():
+            stats['memory ' + name] = value
+        return stats
+
+    def __repr__(self):
+        return 'TieredTileCache({}, memory {} of {} bytes)'.format(self.disk_cache, self.memory_cache.used_bytes,
+                                                                   self.memory_cache.max_bytes)
@@ -0,0 +1,265 @@
+"""
+Latency histograms and hit and miss counters of a tile cache, grouped by zoom level and by root file.
+"""
+import bisect
+import collections
+import json
+import threading
+import time
+
+import tile_disk_cache
+import utilities
+
+# Upper bounds of the latency buckets in milliseconds, the last bucket has no bound.
+latency_bucket_bounds_ms = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+operations = ('has', 'get', 'put')
+# Number of files reported by most misses.
+thrashing_file_count = 10
+
+
+def filename_of_link(node_link):
+    """
+    :type node_link: str
+    :return: The file of the link, '' for links without a file.
+    :rtype: str
+    """
+    if not node_link:
+        return ''
+    return utilities.resolve_link(str(node_link))[1] or ''
+
+
+class LatencyHistogram:
+    def __init__(self, bounds_ms=latency_bucket_bounds_ms):
+        """
+        Counts of latencies in fixed buckets, so that recording is a bisect and an increment.
+
+        :param bounds_ms: Sorted upper bounds of the buckets in milliseconds.
+        """
+        self.bounds_ms = bounds_ms
+        self.counts = [0] * (len(bounds_ms) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+
+    def record(self, milliseconds):
+        self.counts[bisect.bisect_left(self.bounds_ms, milliseconds)] += 1
+        self.count += 1
+        self.total_ms += milliseconds
+
+    def mean_ms(self):
+        return self.total_ms / self.count if self.count else 0.0
+
+    def percentile_ms(self, fraction):
+        """
+        Upper bound of the bucket holding the given fraction of the latencies.
+
+        :type fraction: float
+        :rtype: float
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.bounds_ms[bucket] if bucket < len(self.bounds_ms) else float('inf')
+        return float('inf')
+
+    def to_dict(self):
+        return {'count': self.count,
+                'mean ms': self.mean_ms(),
+                'p50 ms': self.percentile_ms(0.5),
+                'p90 ms': self.percentile_ms(0.9),
+                'p99 ms': self.percentile_ms(0.99),
+                'buckets': [[bound, bucket_count] for bound, bucket_count
+                            in zip(list(self.bounds_ms) + ['inf'], self.counts)]}
+
+
+class TileCacheMetrics:
+    def __init__(self):
+        """
+        Counters and latency histograms of the operations on a tile cache. Safe to use from many threads.
+        """
+        self._lock = threading.Lock()
+        self.latencies = dict((operation, LatencyHistogram()) for operation in operations)
+        self.hits = 0
+        self.misses = 0
+        self.hits_by_zoom = collections.Counter()
+        self.misses_by_zoom = collections.Counter()
+        self.hits_by_filename = collections.Counter()
+        self.misses_by_filename = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def record_has(self, seconds):
+        with self._lock:
+            self.latencies['has'].record(seconds * 1000)
+
+    def record_get(self, seconds, encoded_image, filename='', zoom=None):
+        """
+        :param encoded_image: What the cache returned, None for a miss.
+        :param filename: Root file of the tile.
+        :param zoom: Zoom level of the tile, None when it is not known.
+        """
+        with self._lock:
+            self.latencies['get'].record(seconds * 1000)
+            if encoded_image is None:
+                self.misses += 1
+                self.misses_by_filename[filename] += 1
+                if zoom is not None:
+                    self.misses_by_zoom[zoom] += 1
+            else:
+                self.hits += 1
+                self.bytes_out += len(encoded_image)
+                self.hits_by_filename[filename] += 1
+                if zoom is not None:
+                    self.hits_by_zoom[zoom] += 1
+
+    def record_put(self, seconds, encoded_image):
+        with self._lock:
+            self.latencies['put'].record(seconds * 1000)
+            self.bytes_in += len(encoded_image)
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def thrashing_filenames(self, count=thrashing_file_count):
+        """
+        :return: The files with the most misses, and their misses.
+        :rtype: list of (str, int)
+        """
+        with self._lock:
+            return self.misses_by_filename.most_common(count)
+
+    def to_dict(self):
+        """
+        All the metrics, for export.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit ratio': self.hit_ratio(),
+                    'bytes in': self.bytes_in,
+                    'bytes out': self.bytes_out,
+                    'latency': dict((operation, histogram.to_dict())
+                                    for operation, histogram in self.latencies.iteritems()),
+                    'hits by zoom': dict(self.hits_by_zoom),
+                    'misses by zoom': dict(self.misses_by_zoom),
+                    'hits by filename': dict(self.hits_by_filename),
+                    'misses by filename': dict(self.misses_by_filename)}
+
+    def stats_dict(self, prefix=''):
+        """
+        Summary of the metrics as strings, like the stats_dict of the caches.
+
+        :rtype: dict
+        """
+        stats = {prefix + 'hit ratio': '{:.3f}'.format(self.hit_ratio()),
+                 prefix + 'bytes in': str(self.bytes_in),
+                 prefix + 'bytes out': str(self.bytes_out),
+                 prefix + 'thrashing files': ', '.join('{} ({} misses)'.format(filename, misses)
+                                                       for filename, misses in self.thrashing_filenames())}
+        with self._lock:
+            for operation, histogram in self.latencies.iteritems():
+                stats[prefix + operation + ' latency'] = 'count {}, mean {:.2f} ms, p50 {} ms, p99 {} ms'.format(
+                    histogram.count, histogram.mean_ms(), histogram.percentile_ms(0.5),
+                    histogram.percentile_ms(0.99))
+            for zoom in sorted(set(self.hits_by_zoom) | set(self.misses_by_zoom)):
+                stats[prefix + 'zoom {} hits/misses'.format(zoom)] = '{}/{}'.format(self.hits_by_zoom[zoom],
+                                                                                    self.misses_by_zoom[zoom])
+        return stats
+
+
+class InstrumentedTileCache:
+    def __init__(self, cache, name='tile cache'):
+        """
+        Measures the operations on cache, which can be any tile cache. Wrap each tier to get per tier metrics,
+        e.g. InstrumentedTileCache(TieredTileCache(InstrumentedTileCache(disk_cache, 'disk')), 'tiered'). A
+        WriteBehindTileCache goes outside, so that puts are measured when they are written.
+
+        Other attributes, like hits and evictions, are those of cache.
+
+        :param name: Prefix of the metrics in stats_dict.
+        """
+        self.cache = cache
+        self.name = name
+        self.metrics = TileCacheMetrics()
+
+    def __getattr__(self, name):
+        if name == 'cache':
+            raise AttributeError(name)
+        return getattr(self.cache, name)
+
+    def has_image(self, image_tree, resolution):
+        start_time = time.time()
+        has_image = self.cache.has_image(image_tree, resolution)
+        self.metrics.record_has(time.time() - start_time)
+        return has_image
+
+    def get_encoded_image(self, image_tree, resolution):
+        start_time = time.time()
+        encoded_image = self.cache.get_encoded_image(image_tree, resolution)
+        self.metrics.record_get(time.time() - start_time, encoded_image, filename=image_tree.filename or '')
+        return encoded_image
+
+    def get_encoded(self, key, node_link='', zoom=None):
+        start_time = time.time()
+        encoded_image = self.cache.get_encoded(key, node_link=node_link, zoom=zoom)
+        self.metrics.record_get(time.time() - start_time, encoded_image, filename=filename_of_link(node_link),
+                                zoom=zoom)
+        return encoded_image
+
+    def get_image(self, image_tree, resolution):
+        encoded_image = self.get_encoded_image(image_tree, resolution)
+        return tile_disk_cache.decode_image(encoded_image) if encoded_image is not None else None
+
+    def put_encoded_image(self, encoded_image, image_tree, resolution):
+        start_time = time.time()
+        self.cache.put_encoded_image(encoded_image, image_tree, resolution)
+        self.metrics.record_put(time.time() - start_time, encoded_image)
+
+    def put_encoded(self, key, encoded_image, node_link='', resolution=0):
+        start_time = time.time()
+        self.cache.put_encoded(key, encoded_image, node_link=node_link, resolution=resolution)
+        self.metrics.record_put(time.time() - start_time, encoded_image)
+
+    def put_image(self, pil_image, image_tree, resolution):
+        self.put_encoded_image(tile_disk_cache.encode_image(pil_image), image_tree, resolution)
+        return pil_image
+
+    def cache_burst(self):
+        return self.cache.cache_burst()
+
+    def close(self):
+        self.cache.close()
+
+    def stats_dict(self):
+        stats = self.cache.stats_dict()
+        stats.update(self.metrics.stats_dict(prefix=self.name + ' '))
+        return stats
+
+    def export(self):
+        """
+        Metrics of this cache and of the instrumented caches it wraps.
+
+        :rtype: dict
+        """
+        exported = {'name': self.name,
+                    'evictions': getattr(self.cache, 'evictions', None),
+                    'metrics': self.metrics.to_dict()}
+        for inner_cache in [getattr(self.cache, attribute, None) for attribute in ['cache', 'disk_cache']]:
+            if isinstance(inner_cache, InstrumentedTileCache):
+                exported['inner'] = inner_cache.export()
+        return exported
+
+    def export_json(self):
+        """
+        :rtype: str
+        """
+        return json.dumps(self.export(), sort_keys=True)
+
+    def __repr__(self):
+        return 'InstrumentedTileCache({}, {})'.format(self.name, self.cache)
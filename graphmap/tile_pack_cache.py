@@ -0,0 +1,320 @@
+"""
+Tile cache stored in a single SQLite file, in the spirit of MBTiles, instead of one file per tile.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+import constants
+import tile_disk_cache
+import utilities
+from tile_disk_cache import CacheStats
+
+schema = [
+    'CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE IF NOT EXISTS tiles ('
+    ' tile_key TEXT PRIMARY KEY,'
+    ' node_link TEXT NOT NULL,'
+    ' resolution INTEGER NOT NULL,'
+    ' tile_data BLOB NOT NULL,'
+    ' size INTEGER NOT NULL,'
+    ' last_access REAL NOT NULL) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS tiles_by_last_access ON tiles (last_access)',
+]
+
+
+class SqliteTileCache:
+    def __init__(self, database_filename, size, max_bytes=None,
+                 access_flush_interval=constants.tile_access_flush_interval,
+                 high_watermark=constants.tile_cache_high_watermark, low_watermark=constants.tile_cache_low_watermark,
+                 background_eviction=True):
+        """
+        Same interface as tile_disk_cache.TileCache. Tiles are rows keyed by tile_disk_cache.tile_key, with the node
+        link and resolution they were rendered for. Eviction deletes the least recently accessed rows, and SQLite
+        reuses their pages.
+
+        Access times of hits are kept in memory and written in one transaction every access_flush_interval hits,
+        so that reads do not write.
+
+        Writes of this process are serialized, and the count and bytes are updated in the transaction that changes
+        them. Eviction first recounts them from the table, which also takes in the tiles of other processes.
+
+        Eviction starts when the count goes over size or the bytes over high_watermark of max_bytes, and deletes
+        least recently accessed tiles until the count is within size and the bytes are under low_watermark of
+        max_bytes.
+
+        :param size: Maximum number of cached tiles.
+        :param max_bytes: Maximum total size of the cached tiles, None for no limit.
+        :param high_watermark: Fraction of max_bytes above which eviction starts.
+        :param low_watermark: Fraction of max_bytes down to which eviction goes.
+        :param background_eviction: Whether eviction runs on a background thread, or inline in the puts.
+        """
+        self.database_filename = database_filename
+        self.size = size
+        self.max_bytes = max_bytes
+        self.access_flush_interval = access_flush_interval
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.background_eviction = background_eviction
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._eviction_requested = threading.Event()
+        self._eviction_thread = None
+        self._closed = False
+        self._accessed = {}  # tile key -> last access time not written yet
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        connection = self.connection()
+        with connection:
+            for statement in schema:
+                connection.execute(statement)
+            connection.execute("INSERT OR IGNORE INTO metadata (name, value) VALUES ('format', 'jpg')")
+        self.cache_count, self.used_bytes = connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tiles').fetchone()
+
+    def connection(self):
+        """
+        The connection of the current thread.
+
+        :rtype: sqlite3.Connection
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_filename, timeout=30)
+            connection.text_factory = str
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def has_image(self, image_tree, resolution):
+        """
+        :type image_tree: imagetree.ImageTree
+        :type resolution: int
+        :rtype: bool
+        """
+        key = tile_disk_cache.tree_tile_key(image_tree, resolution)
+        return self.connection().execute('SELECT 1 FROM tiles WHERE tile_key = ?', (key,)).fetchone() is not None
+
+    def get_encoded_image(self, image_tree, resolution):
+        """
+        :return: JPEG bytes, None if the tile is not cached.
+        :rtype: str
+        """
+        return self.get_encoded(tile_disk_cache.tree_tile_key(image_tree, resolution))
+
+    def get_encoded(self, key, node_link='', zoom=None):
+        """
+        :param key: A tile_disk_cache.tile_key or encoded_tile_key.
+        :param node_link: Root of the tile, for instrumentation, not used by this cache.
+        :param zoom: Zoom level of the tile, for instrumentation, not used by this cache.
+        :return: The stored bytes, None if the key is not cached.
+        :rtype: str
+        """
+        row = self.connection().execute('SELECT tile_data FROM tiles WHERE tile_key = ?', (key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._accessed[key] = time.time()
+            should_flush = len(self._accessed) >= self.access_flush_interval
+        if should_flush:
+            self.flush_access_times()
+        return str(row[0])
+
+    def get_image(self, image_tree, resolution):
+        """
+        :return: The image, None if it is not cached.
+        :rtype: Image.Image
+        """
+        encoded_image = self.get_encoded_image(image_tree, resolution)
+        return tile_disk_cache.decode_image(encoded_image) if encoded_image is not None else None
+
+    def put_image(self, pil_image, image_tree, resolution):
+        """
+        :type pil_image: Image.Image
+        :rtype: Image.Image
+        """
+        self.put_encoded_image(tile_disk_cache.encode_image(pil_image), image_tree, resolution)
+        return pil_image
+
+    def put_encoded_image(self, encoded_image, image_tree, resolution):
+        self.put_encoded_images([(encoded_image, image_tree, resolution)])
+
+    def put_encoded(self, key, encoded_image, node_link='', resolution=0):
+        """
+        Stores bytes for a key.
+
+        :param key: A tile_disk_cache.tile_key or encoded_tile_key.
+        :param node_link: Link of the tree the bytes were rendered from.
+        """
+        self.put_encoded_rows([(key, node_link, resolution, encoded_image)])
+
+    def put_encoded_images(self, tiles):
+        """
+        Stores many tiles in one transaction, then evicts if over the bounds.
+
+        :param tiles: list of tuples of JPEG bytes, image tree and resolution.
+        """
+        self.put_encoded_rows([(tile_disk_cache.tree_tile_key(image_tree, resolution), image_tree.get_link(),
+                                resolution, encoded_image) for encoded_image, image_tree, resolution in tiles])
+
+    def put_encoded_rows(self, tiles):
+        """
+        :param tiles: list of tuples of key, node link, resolution and bytes.
+        """
+        now = time.time()
+        rows = [(key, node_link, resolution, sqlite3.Binary(encoded_image), len(encoded_image), now)
+                for key, node_link, resolution, encoded_image in tiles]
+        unique_rows = dict((row[0], row[4]) for row in rows)
+        connection = self.connection()
+        with self._write_lock:
+            with connection:
+                replaced_count, replaced_bytes = 0, 0
+                for key in unique_rows:
+                    replaced = connection.execute('SELECT size FROM tiles WHERE tile_key = ?', (key,)).fetchone()
+                    if replaced is not None:
+                        replaced_count, replaced_bytes = replaced_count + 1, replaced_bytes + replaced[0]
+                connection.executemany('INSERT OR REPLACE INTO tiles (tile_key, node_link, resolution, tile_data, '
+                                       'size, last_access) VALUES (?, ?, ?, ?, ?, ?)', rows)
+                with self._lock:
+                    self.cache_count += len(unique_rows) - replaced_count
+                    self.used_bytes += sum(unique_rows.itervalues()) - replaced_bytes
+        if self.is_over_budget():
+            self._request_eviction()
+
+    def is_over_budget(self):
+        return self.cache_count > self.size or (self.max_bytes is not None and
+                                                self.used_bytes > self.max_bytes * self.high_watermark)
+
+    def _request_eviction(self):
+        if not self.background_eviction:
+            self.evict()
+            return
+        with self._lock:
+            if self._eviction_thread is None:
+                self._eviction_thread = threading.Thread(target=self._eviction_loop, name='SqliteTileCacheEviction')
+                self._eviction_thread.daemon = True
+                self._eviction_thread.start()
+        self._eviction_requested.set()
+
+    def _eviction_loop(self):
+        while True:
+            self._eviction_requested.wait()
+            self._eviction_requested.clear()
+            if self._closed:
+                self.close_connection()
+                return
+            self.evict()
+
+    def evict(self):
+        """
+        Recounts the tiles. If the cache is over the high watermark, reads the least recently accessed tiles in one
+        query, until enough are read to bring the cache under the low watermark, and deletes them.
+        """
+        if not self.is_over_budget():
+            return
+        self.flush_access_times()
+        connection = self.connection()
+        with self._write_lock:
+            with connection:
+                cache_count, used_bytes = connection.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tiles').fetchone()
+                with self._lock:
+                    self.cache_count, self.used_bytes = cache_count, used_bytes
+                if not self.is_over_budget():
+                    return
+                excess_count = cache_count - self.size
+                excess_bytes = used_bytes - self.max_bytes * self.low_watermark if self.max_bytes is not None else 0
+                evicted_keys, evicted_bytes = [], 0
+                cursor = connection.execute('SELECT tile_key, size FROM tiles ORDER BY last_access')
+                for key, size in cursor:
+                    if len(evicted_keys) >= excess_count and evicted_bytes >= excess_bytes:
+                        break
+                    evicted_keys.append((key,))
+                    evicted_bytes += size
+                cursor.close()
+                connection.executemany('DELETE FROM tiles WHERE tile_key = ?', evicted_keys)
+                with self._lock:
+                    self.cache_count -= len(evicted_keys)
+                    self.used_bytes -= evicted_bytes
+                    self.evictions += len(evicted_keys)
+
+    def flush_access_times(self):
+        """
+        Writes the access times of the hits since the last flush.
+        """
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        if accessed:
+            connection = self.connection()
+            with connection:
+                connection.executemany('UPDATE tiles SET last_access = ? WHERE tile_key = ?',
+                                       [(last_access, key) for key, last_access in accessed.iteritems()])
+
+    def cache_burst(self):
+        print('Cache burst')
+        current_count = self.cache_count
+        connection = self.connection()
+        with self._write_lock:
+            with connection:
+                connection.execute('DELETE FROM tiles')
+            with self._lock:
+                self._accessed.clear()
+                self.cache_count, self.used_bytes = 0, 0
+        connection.execute('VACUUM')
+        return 'Had ' + str(current_count) + ' images in pack cache. ' + self.disk_stats()
+
+    def count_files_in_disk(self):
+        return self.connection().execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+
+    def close(self):
+        """
+        Stops the eviction thread, evicts what is still over the bounds and closes the connection of this thread.
+        """
+        eviction_thread = self._eviction_thread
+        if eviction_thread is not None:
+            self._closed = True
+            self._eviction_requested.set()
+            eviction_thread.join()
+            self._eviction_thread = None
+            self._closed = False
+        self.evict()
+        self.flush_access_times()
+        self.close_connection()
+
+    def close_connection(self):
+        """
+        Closes the connection of the current thread, SQLite connections are used only by the thread that opened them.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def disk_stats(self):
+        return self.stats().__str__()
+
+    def stats(self):
+        return CacheStats(cache_count=self.cache_count, cache_dir=self.database_filename,
+                          used_space=self.used_bytes / 1024 / 1024,
+                          free_space=utilities.get_free_space_mb(os.path.dirname(os.path.abspath(
+                              self.database_filename))))
+
+    def stats_dict(self):
+        cache_stats = self.stats()
+        return {'cache count': str(self.cache_count),
+                'cache dir': self.database_filename,
+                'used space': str(cache_stats.used_space) + ' MB',
+                'free space': str(cache_stats.free_space) + ' MB',
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def __repr__(self):
+        return 'SqliteTileCache(database_filename={}, size={}). Cache Count is {}' \
+            .format(self.database_filename, self.size, self.cache_count)
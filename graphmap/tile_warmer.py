@@ -0,0 +1,182 @@
+"""
+Pre-populates a tile cache, so that the first requests after a deploy do not pay the full render cost. Tiles are
+rendered and encoded by a pool of processes and stored by the calling process, which owns the cache.
+"""
+import collections
+import multiprocessing
+import time
+
+import constants
+import serializer
+import tile_disk_cache
+import utilities
+from PIL import Image
+
+# Tree of the worker process, loaded once by _init_worker.
+_worker_tree = None
+
+
+def tiles_in_zoom_range(min_z, max_z, limit=None):
+    """
+    Yields the tiles of each zoom level from min_z to max_z, lower zoom levels first, since every view passes
+    through them.
+
+    :param limit: Maximum number of tiles, None for all.
+    :rtype: generator of (int, int, int)
+    """
+    count = 0
+    for z in xrange(min_z, max_z + 1):
+        for y in xrange(2 ** z):
+            for x in xrange(2 ** z):
+                if limit is not None and count >= limit:
+                    return
+                count += 1
+                yield x, y, z
+
+
+def read_tile_requests(tsv_filename):
+    """
+    Counts the successful requests of each tile in a file written by perf_tester.AverageTimeStats.append_to_file.
+
+    :rtype: collections.Counter
+    """
+    request_counts = collections.Counter()
+    with open(tsv_filename) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 6 or not fields[1].isdigit() or fields[5] != '200':
+                continue
+            request_counts[(int(fields[1]), int(fields[2]), int(fields[3]))] += 1
+    return request_counts
+
+
+def hottest_tiles(request_counts, limit=None):
+    """
+    :type request_counts: collections.Counter
+    :return: Tiles, most requested first.
+    :rtype: list of (int, int, int)
+    """
+    return [tile for tile, _ in request_counts.most_common(limit)]
+
+
+class WarmReport:
+    def __init__(self, tile_count, skipped_count, seconds):
+        self.tile_count = tile_count
+        self.skipped_count = skipped_count
+        self.seconds = seconds
+
+    @property
+    def tiles_per_second(self):
+        return self.tile_count / self.seconds if self.seconds > 0 else 0.0
+
+    def __repr__(self):
+        return 'WarmReport({} tiles warmed, {} skipped, in {:.1f} s, {:.1f} tiles per second)'.format(
+            self.tile_count, self.skipped_count, self.seconds, self.tiles_per_second)
+
+
+def _init_worker(node_link):
+    global _worker_tree
+    _worker_tree = serializer.load_link_new_serializer(node_link)
+
+
+def _render_tile(args):
+    """
+    Renders a tile with the tree of the worker.
+
+    :param args: x, y, z, resolution and tile format.
+    :return: The key of the tile, the link of the node that renders it and the encoded bytes.
+    :rtype: str, str, str
+    """
+    x, y, z, resolution, tile_format = args
+    source_node, relative_quad_key = _worker_tree.tile_source(utilities.xyz_to_quadkey(x, y, z))
+    source_link = tile_disk_cache.canonical_node_link(source_node.get_link())
+    pil_image = Image.fromarray(source_node.get_np_array_at_quad_key(resolution=resolution,
+                                                                     quad_key=relative_quad_key))
+    return (tile_disk_cache.encoded_tile_key(source_link, relative_quad_key, resolution, tile_format), source_link,
+            tile_disk_cache.encode_image(pil_image, tile_format))
+
+
+class TileWarmer:
+    def __init__(self, node_link, image_cache, resolution=constants.default_tile_resolution, tile_format='JPEG',
+                 process_count=constants.tile_warmer_process_count,
+                 progress_interval=constants.tile_warmer_progress_interval, verbose=True):
+        """
+        Stores tiles of node_link in image_cache under the keys ImageTree.get_encoded_tile reads.
+
+        Tiles deeper than constants.z_limit_caching are not warmed, and at most constants.cache_populate_limit
+        tiles, and no more than the cache holds, are warmed in one call.
+
+        :type node_link: str
+        :param image_cache: A TileCache, SqliteTileCache or TieredTileCache.
+        :param process_count: Rendering processes, 0 to render in this process.
+        :param progress_interval: Progress is printed every progress_interval tiles.
+        """
+        self.node_link = str(node_link)
+        self.image_cache = image_cache
+        self.resolution = resolution
+        self.tile_format = tile_format
+        self.process_count = process_count
+        self.progress_interval = progress_interval
+        self.verbose = verbose
+
+    def tile_limit(self):
+        return min(constants.cache_populate_limit, constants.cache_limit,
+                   getattr(self.image_cache, 'size', constants.cache_limit))
+
+    def warm_zoom_range(self, min_z, max_z):
+        """
+        :rtype: WarmReport
+        """
+        return self.warm_tiles(tiles_in_zoom_range(min_z, min(max_z, constants.z_limit_caching),
+                                                   limit=self.tile_limit()))
+
+    def warm_from_requests(self, tsv_filename, top_count=None):
+        """
+        Warms the most requested tiles of a perf_tester time stats file.
+
+        :param top_count: Number of tiles, None for as many as the limits allow.
+        :rtype: WarmReport
+        """
+        limit = self.tile_limit() if top_count is None else min(top_count, self.tile_limit())
+        return self.warm_tiles(hottest_tiles(read_tile_requests(tsv_filename), limit=limit))
+
+    def warm_tiles(self, tiles):
+        """
+        Renders the tiles that are within the limits and stores them in the cache.
+
+        :type tiles: iterable of (int, int, int)
+        :rtype: WarmReport
+        """
+        limit = self.tile_limit()
+        jobs, skipped_count = [], 0
+        for x, y, z in tiles:
+            if z > constants.z_limit_caching or len(jobs) >= limit:
+                skipped_count += 1
+                continue
+            jobs.append((x, y, z, self.resolution, self.tile_format))
+        start_time = time.time()
+        if self.process_count > 0:
+            pool = multiprocessing.Pool(self.process_count, initializer=_init_worker, initargs=(self.node_link,))
+            try:
+                tile_count = self._store_tiles(pool.imap_unordered(_render_tile, jobs, chunksize=16), len(jobs),
+                                               start_time)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            _init_worker(self.node_link)
+            tile_count = self._store_tiles((_render_tile(job) for job in jobs), len(jobs), start_time)
+        report = WarmReport(tile_count, skipped_count, time.time() - start_time)
+        if self.verbose:
+            print(report)
+        return report
+
+    def _store_tiles(self, rendered_tiles, total_count, start_time):
+        tile_count = 0
+        for key, source_link, encoded_tile in rendered_tiles:
+            self.image_cache.put_encoded(key, encoded_tile, node_link=source_link, resolution=self.resolution)
+            tile_count += 1
+            if self.verbose and tile_count % self.progress_interval == 0:
+                print('Warmed {} of {} tiles, {:.1f} tiles per second'.format(
+                    tile_count, total_count, tile_count / max(time.time() - start_time, 1e-9)))
+        return tile_count
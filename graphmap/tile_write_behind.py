@@ -0,0 +1,183 @@
+"""
+Write-behind inserts in front of a tile cache, so that a cold tile is returned as soon as it is rendered.
+"""
+import threading
+from Queue import Queue
+
+import constants
+import tile_disk_cache
+
+
+class WriteBehindTileCache:
+    def __init__(self, cache, worker_count=constants.write_behind_worker_count,
+                 max_pending=constants.write_behind_max_pending):
+        """
+        put_image queues the tile and returns. Background threads encode the queued tiles and store them in cache,
+        whose disk writes go to a temporary file renamed over the tile. Until then lookups are answered from the
+        queued tiles.
+
+        A tile already queued is not queued again. When max_pending tiles are queued, more puts are dropped and
+        those tiles are rendered again on their next request.
+
+        :param cache: A TileCache, SqliteTileCache or TieredTileCache.
+        :param worker_count: Number of writing threads.
+        :param max_pending: Maximum number of tiles queued or being written.
+        """
+        self.cache = cache
+        self.worker_count = worker_count
+        self.max_pending = max_pending
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._pending = {}  # tile key -> (pil image or None, encoded bytes or None, node link, resolution)
+        self._workers = []
+        self.queued_count = 0
+        self.written_count = 0
+        self.deduplicated_count = 0
+        self.dropped_count = 0
+        self.failed_count = 0
+
+    def _key(self, image_tree, resolution):
+        return tile_disk_cache.tree_tile_key(image_tree, resolution)
+
+    def _pending_encoded(self, key):
+        """
+        Encodes a queued image once, the bytes are kept with it for the lookups and the write that follow.
+
+        :return: The bytes, None if the tile is not queued.
+        :rtype: str
+        """
+        with self._lock:
+            pending_entry = self._pending.get(key)
+        if pending_entry is None:
+            return None
+        pil_image, encoded_image, node_link, resolution = pending_entry
+        if encoded_image is None:
+            encoded_image = tile_disk_cache.encode_image(pil_image)
+            with self._lock:
+                if self._pending.get(key) is pending_entry:
+                    self._pending[key] = (pil_image, encoded_image, node_link, resolution)
+        return encoded_image
+
+    def has_image(self, image_tree, resolution):
+        """
+        :type image_tree: imagetree.ImageTree
+        :type resolution: int
+        :rtype: bool
+        """
+        with self._lock:
+            if self._key(image_tree, resolution) in self._pending:
+                return True
+        return self.cache.has_image(image_tree, resolution)
+
+    def get_image(self, image_tree, resolution):
+        """
+        :return: The image, None if it is neither queued nor cached.
+        :rtype: Image.Image
+        """
+        with self._lock:
+            pending_entry = self._pending.get(self._key(image_tree, resolution))
+        if pending_entry is not None:
+            pil_image, encoded_image, _, _ = pending_entry
+            return pil_image if pil_image is not None else tile_disk_cache.decode_image(encoded_image)
+        return self.cache.get_image(image_tree, resolution)
+
+    def get_encoded_image(self, image_tree, resolution):
+        """
+        :return: JPEG bytes, None if the tile is neither queued nor cached.
+        :rtype: str
+        """
+        return self.get_encoded(self._key(image_tree, resolution))
+
+    def get_encoded(self, key, node_link='', zoom=None):
+        """
+        :param key: A tile_disk_cache.tile_key or encoded_tile_key.
+        :param node_link: Root of the tile and zoom its level, passed to cache for instrumentation.
+        :rtype: str
+        """
+        encoded_image = self._pending_encoded(key)
+        if encoded_image is not None:
+            return encoded_image
+        return self.cache.get_encoded(key, node_link=node_link, zoom=zoom)
+
+    def put_image(self, pil_image, image_tree, resolution):
+        """
+        Queues the tile to be encoded and stored.
+
+        :type pil_image: Image.Image
+        :rtype: Image.Image
+        """
+        self._schedule(self._key(image_tree, resolution), (pil_image, None, image_tree.get_link(), resolution))
+        return pil_image
+
+    def put_encoded_image(self, encoded_image, image_tree, resolution):
+        self._schedule(self._key(image_tree, resolution), (None, encoded_image, image_tree.get_link(), resolution))
+
+    def put_encoded(self, key, encoded_image, node_link='', resolution=0):
+        self._schedule(key, (None, encoded_image, node_link, resolution))
+
+    def _schedule(self, key, pending_entry):
+        """
+        :rtype: bool
+        """
+        with self._lock:
+            if key in self._pending:
+                self.deduplicated_count += 1
+                return False
+            if len(self._pending) >= self.max_pending:
+                self.dropped_count += 1
+                return False
+            self._pending[key] = pending_entry
+            self._queue.put(key)
+            self.queued_count += 1
+            if len(self._workers) < self.worker_count:
+                worker = threading.Thread(target=self._work, name='tile_write_behind_' + str(len(self._workers)))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        return True
+
+    def _work(self):
+        while True:
+            key = self._queue.get()
+            try:
+                with self._lock:
+                    _, _, node_link, resolution = self._pending[key]
+                self.cache.put_encoded(key, self._pending_encoded(key), node_link=node_link, resolution=resolution)
+                with self._lock:
+                    self.written_count += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed_count += 1
+                print('Write of tile {} failed with {}'.format(key, e))
+            finally:
+                with self._lock:
+                    del self._pending[key]
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Blocks till all queued tiles are stored.
+        """
+        self._queue.join()
+
+    def cache_burst(self):
+        self.flush()
+        return self.cache.cache_burst()
+
+    def close(self):
+        self.flush()
+        self.cache.close()
+
+    def stats_dict(self):
+        stats = self.cache.stats_dict()
+        with self._lock:
+            stats.update({'write behind queued': str(self.queued_count),
+                          'write behind written': str(self.written_count),
+                          'write behind deduplicated': str(self.deduplicated_count),
+                          'write behind dropped': str(self.dropped_count),
+                          'write behind failed': str(self.failed_count),
+                          'write behind pending': str(len(self._pending))})
+        return stats
+
+    def __repr__(self):
+        return 'WriteBehindTileCache({}, {} pending)'.format(self.cache, len(self._pending))
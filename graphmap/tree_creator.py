@@ -191,8 +191,8 @@ def create_tree(node_link, children_links, persistence, image_value_link):
     :param image_value_link:
     :rtype: imagetree.ImageTree
     """
-    jpge_image_value = imagevalue.JpgWebImage(image_value_link)
+    jpge_image_value = imagevalue.JpgWebImage(image_value_link) if image_value_link else ()
     created_tree = imagetree.ImageTree(name=node_link.node_name, filename=node_link.filename,
-                                       children_links=children_links, input_image=jpge_image_value,
+                                       children_links=list(children_links), input_image=jpge_image_value,
                                        serializer=persistence)
     return created_tree
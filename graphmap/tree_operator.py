@@ -150,6 +150,93 @@ def string_to_operator(operator_string):
     return string_to_operator_map[operator_string]
 
 
+def string_to_transform(operator_string):
+    """
+    Transform of an operator string, either an operator like rot90 or a composed transform like [2, 0, 3, 1] as
+    named by apply_operators.
+
+    :type operator_string: str
+    :return: The transform, None if operator_string is not an operator.
+    :rtype: list of int
+    """
+    if operator_string in string_to_operator_map:
+        return operator_to_transform_map[string_to_operator_map[operator_string]]
+    if operator_string.startswith('[') and operator_string.endswith(']'):
+        try:
+            transform = [int(i) for i in operator_string[1:-1].split(',')]
+        except ValueError:
+            return None
+        if sorted(transform) == transforms.identity_transform:
+            return transform
+    return None
+
+
+def get_nodename_and_transform(nodename_with_operator):
+    """
+    Gets the node name and the operator chain composed into one transform, as apply_operators composes it.
+
+    :type nodename_with_operator: str
+    :rtype: str, list of int
+    """
+    nodename = nodename_with_operator
+    transforms_list = []
+    while constants.operator_separator in nodename:
+        operator_string, rest = nodename.split(constants.operator_separator, 1)
+        transform = string_to_transform(operator_string)
+        if transform is None:
+            break
+        transforms_list.append(transform)
+        nodename = rest
+    final_transform = transforms.identity_transform[:]
+    for transform in transforms_list[::-1]:
+        final_transform = apply_transform(final_transform, transform)
+    return nodename, final_transform
+
+
+def canonical_node_name(nodename_with_operator):
+    """
+    Name with the operator chain composed into one transform, in the form apply_operators names trees. Names of
+    trees that render the same, like rot90#rot90#name and rot180#name, are equal, and name if the chain is the
+    identity.
+
+    :type nodename_with_operator: str
+    :rtype: str
+    """
+    nodename, final_transform = get_nodename_and_transform(nodename_with_operator)
+    if final_transform == transforms.identity_transform:
+        return nodename
+    return str(final_transform) + constants.operator_separator + nodename
+
+
+def inverse_transform(transform):
+    """
+    :type transform: list of int
+    :rtype: list of int
+    """
+    inverse = [0] * len(transform)
+    for index, source_index in enumerate(transform):
+        inverse[source_index] = index
+    return inverse
+
+
+def untransformed_tree(operated_tree):
+    """
+    The tree an operator chain was applied to, and the composed transform, for trees whose pixels are those of
+    the untransformed tree with its quadrants permuted. That is the case when the operated tree has no image of
+    its own, since transform_tree permutes only the children.
+
+    :type operated_tree: imagetree.ImageTree
+    :return: The untransformed tree and the transform, None and None if the tree is not such a view.
+    :rtype: imagetree.ImageTree, list of int
+    """
+    if operated_tree.is_leaf() or operated_tree.is_set():
+        return None, None
+    nodename, final_transform = get_nodename_and_transform(operated_tree.name)
+    if final_transform == transforms.identity_transform:
+        return None, None
+    return transform_tree(operated_tree, inverse_transform(final_transform), nodename), final_transform
+
+
 def get_nodename_and_operators_list(nodename_with_operator):
     """
     Gets the node name and list of operators.
@@ -1,9 +1,13 @@
 import time
 
+import imagevalue
 import serializer
 import utilities
 import serialization.protbuf_serializer
 
+# Approximate memory taken by a deserialized ImageTree node, its pixel and lists, excluding the strings.
+node_overhead_bytes = 1500
+
 
 class TreeMap:
     def __init__(self, name_to_image_tree_node_map):
@@ -26,6 +30,41 @@ class TreeMap:
         """
         return self.name_to_image_tree_node_map[node_name]
 
+    def node_names(self):
+        """
+        Names of the nodes, without the empty one that a trailing newline of a tsv file produces.
+
+        :rtype: list of str
+        """
+        return [name for name in self.name_to_image_tree_node_map if name]
+
+    def estimated_bytes(self):
+        """
+        Estimates the memory used by all the nodes in this map.
+
+        :rtype: int
+        """
+        return sum(node_overhead_bytes + len(name) + sum(len(link) for link in node._children_links)
+                   for name, node in self.name_to_image_tree_node_map.iteritems())
+
+    def get_linked_filenames(self, own_filename):
+        """
+        Gets the other files that the nodes in this map link to, as children or as image value.
+
+        :param own_filename: The file this map was loaded from.
+        :rtype: set of str
+        """
+        linked_filenames = set()
+        for node in self.name_to_image_tree_node_map.itervalues():
+            links = list(node._children_links)
+            if isinstance(node.get_image_value(), imagevalue.NodeLinkImage):
+                links.append(node.get_image_value().link)
+            for link in links:
+                _, filename = utilities.resolve_link(link)
+                if filename and filename != own_filename:
+                    linked_filenames.add(filename)
+        return linked_filenames
+
     @classmethod
     def create_from_file(cls, filename, serializer):
         """
@@ -5,11 +5,12 @@ import os
 import platform
 import random
 import string
-import urllib2
+import tempfile
 from StringIO import StringIO
 
 import alpha_conversion
 import constants
+import http_client
 import numpy as np
 from PIL import Image
 
@@ -85,15 +86,30 @@ def get_contents_of_file(filename):
             return f.read()
     if not is_web_link(filename):
         raise Exception('Could not find file locally and it does not seem to be a url', filename)
-    request = urllib2.Request(filename)
-    request.add_header('Accept-encoding', 'gzip')
-    response = urllib2.urlopen(request)
-    buf = StringIO(response.read())
-    if is_gzip(filename):
-        f = gzip.GzipFile(fileobj=buf)
-        return f.read()
+    contents, _, _ = get_contents_of_url_if_modified(filename)
+    return contents
+
+
+def get_contents_of_url_if_modified(url, etag=None, last_modified=None):
+    """
+    Downloads the contents of url unless the server says it has not changed since given etag or last modified date.
+
+    :type url: str
+    :param etag: ETag header of the previously downloaded contents.
+    :param last_modified: Last-Modified header of the previously downloaded contents.
+    :return: contents, or None if not modified, followed by the new etag and last modified headers.
+    :rtype: str, str, str
+    :raises urllib2.HTTPError: If the server answers with an error.
+    """
+    response = http_client.shared_http_client.get_if_modified(url, etag=etag, last_modified=last_modified,
+                                                              headers={'Accept-Encoding': 'gzip'})
+    if response is None:
+        return None, etag, last_modified
+    if is_gzip(url) or response.headers.get('content-encoding') == 'gzip':
+        contents = gzip.GzipFile(fileobj=StringIO(response.body)).read()
     else:
-        return buf.read()
+        contents = response.body
+    return contents, response.headers.get('etag'), response.headers.get('last-modified')
 
 
 def proper_shape(imarray):
@@ -164,6 +180,38 @@ def mkdir_p(path):
             raise
 
 
+def write_file_atomically(file_path, contents):
+    """
+    Writes to a temporary file of its own in the directory of file_path, then renames it over file_path. Concurrent
+    writers, threads or processes, never share a temporary file and the last rename wins. The temporary file is
+    removed if the write fails.
+
+    :type file_path: str
+    :type contents: str
+    """
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.', suffix='.tmp')
+    renamed = False
+    try:
+        with os.fdopen(file_descriptor, 'wb') as f:
+            f.write(contents)
+        # mkstemp creates the file readable by its owner only, other users of a shared cache read it too.
+        os.chmod(temporary_path, 0644)
+        try:
+            os.rename(temporary_path, file_path)
+            renamed = True
+        except (IOError, OSError) as e:
+            # Where rename does not replace an existing file, another writer already stored it. Any other error,
+            # such as a full disk, is the caller's to handle.
+            if e.errno != errno.EEXIST or not os.path.exists(file_path):
+                raise
+    finally:
+        if not renamed:
+            try:
+                os.remove(temporary_path)
+            except (IOError, OSError):
+                pass
+
+
 def get_free_space_mb(dirname):
     """Return folder/drive free space (in megabytes).
 
@@ -235,14 +283,12 @@ def is_web_link(filename):
 
 
 def url_exists(url):
-    import urllib2
-    try:
-        urllib2.urlopen(url)
-        return True
-    except urllib2.HTTPError:
-        return False
-    except urllib2.URLError:
-        return False
+    """
+    Checks with a HEAD request on a pooled connection, the contents are not downloaded.
+
+    :rtype: bool
+    """
+    return http_client.shared_http_client.exists(url)
 
 
 def file_exists(filename):
@@ -1,13 +1,23 @@
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 from .context import graphmap
 
+from graphmap import async_graphmap
+from graphmap import async_persistence
+from graphmap import catalog
 from graphmap import constants
 from graphmap import graphmap_main
 from graphmap import imagetree
 from graphmap import imagevalue
+from graphmap import log_persistence
 from graphmap import memory_persistence
 from graphmap import result
+from graphmap import perf_tester
 from graphmap import serializer
+from graphmap import sqlite_persistence
 from graphmap import utilities
 from graphmap.constants import seattle_skyline_url
 from graphmap.graph_helpers import NodeLink
@@ -253,6 +263,266 @@ class GetImageAtQuadKey(unittest.TestCase):
                 self.assertTrue(utilities.pil_images_equal(expected_same_image, expected_same_images[0]))
 
 
+class AsyncGraphMapTests(unittest.TestCase):
+    def test_create_connect_and_get_child(self):
+        gm = async_graphmap.AsyncGraphMap(async_persistence.AsyncMemoryPersistence())
+        first_node_link = NodeLink('agm_first')
+        second_node_link = NodeLink('agm_second')
+        create_futures = [gm.create_node(root_node_link=node_link, image_value_link=wiki_image_url)
+                          for node_link in [first_node_link, second_node_link]]
+        self.assertTrue(all(future.result(timeout=10).is_success() for future in create_futures))
+        self.assertTrue(gm.node_exists(first_node_link).result(timeout=10))
+        repeat_create_result = gm.create_node(root_node_link=first_node_link).result(timeout=10)
+        self.assertEqual(result.NAME_ALREADY_EXISTS, repeat_create_result.code)
+        quad_key = '013'
+        new_root_result = gm.connect_child(root_node_link=first_node_link, quad_key=quad_key,
+                                           child_node_link=second_node_link).result(timeout=10)
+        self.assertTrue(new_root_result.is_success(), new_root_result.message)
+        child_name_result = gm.get_child_name(new_root_result.value, quad_key=quad_key).result(timeout=10)
+        self.assertEqual(second_node_link, child_name_result.value)
+
+    def test_root_does_not_exist(self):
+        gm = async_graphmap.AsyncGraphMap(async_persistence.AsyncMemoryPersistence())
+        image_result = gm.get_image_at_quad_key(NodeLink('agm_missing'), resolution=64, quad_key='').result(timeout=10)
+        self.assertEqual(result.NODE_LINK_NOT_FOUND_ERROR_CODE, image_result.code)
+
+
+class SqlitePersistenceTests(unittest.TestCase):
+    def setUp(self):
+        database_file, self.database_filename = tempfile.mkstemp(suffix='.sqlite')
+        os.close(database_file)
+
+    def tearDown(self):
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.isfile(self.database_filename + suffix):
+                os.remove(self.database_filename + suffix)
+
+    def test_connect_child_and_reopen(self):
+        gm = graphmap_main.GraphMap(sqlite_persistence.SqlitePersistence(self.database_filename))
+        first_node_link = NodeLink('sql_first', 'sql_persistence_test.tsv')
+        second_node_link = NodeLink('sql_second', 'sql_persistence_test.tsv')
+        gm.create_node(root_node_link=first_node_link, image_value_link=wiki_image_url)
+        gm.create_node(root_node_link=second_node_link, image_value_link=seattle_skyline_url)
+        quad_key = '0132'
+        new_root_result = gm.connect_child(root_node_link=first_node_link, quad_key=quad_key,
+                                           child_node_link=second_node_link)
+        self.assertTrue(new_root_result.is_success(), new_root_result.message)
+        reopened = sqlite_persistence.SqlitePersistence(self.database_filename)
+        reopened_gm = graphmap_main.GraphMap(reopened)
+        self.assertTrue(reopened_gm.node_exists(new_root_result.value))
+        self.assertEqual(second_node_link,
+                         reopened_gm.get_child_name(new_root_result.value, quad_key=quad_key).value)
+        new_root = new_root_result.value
+        parent_link = utilities.format_node_address(new_root.filename, new_root.node_name + quad_key[:-1])
+        self.assertEqual([parent_link], reopened.get_parent_links(second_node_link))
+        # Two created nodes, the new root and four children per quad key level, one of which is the second node.
+        self.assertEqual(2 + 1 + 4 * len(quad_key) - 1, reopened.count_nodes())
+        for node_link in [first_node_link, second_node_link, new_root_result.value]:
+            self.assertIn(str(node_link), reopened_gm.get_all_node_links())
+
+    def test_page_through_catalog(self):
+        gm = graphmap_main.GraphMap(sqlite_persistence.SqlitePersistence(self.database_filename))
+        first_node_link = NodeLink('sql_page_first', 'sql_page_test.tsv')
+        gm.create_node(root_node_link=first_node_link, image_value_link=wiki_image_url)
+        gm.create_node(root_node_link=NodeLink('sql_page_second', 'sql_page_test.tsv'),
+                       image_value_link=seattle_skyline_url)
+        self.assertEqual(2, gm.count_nodes())
+        # Nodes put after the catalog is built are added to it.
+        gm.connect_child(root_node_link=first_node_link, quad_key='01',
+                         child_node_link=NodeLink('sql_page_second', 'sql_page_test.tsv'))
+        reopened = sqlite_persistence.SqlitePersistence(self.database_filename)
+        expected_node_links = sorted(reopened.get_all_node_links(),
+                                     key=lambda node_link: catalog.to_catalog_key(node_link))
+        self.assertEqual(expected_node_links, list(gm.iter_node_links()))
+        reopened_gm = graphmap_main.GraphMap(reopened)
+        self.assertEqual(len(expected_node_links), reopened_gm.count_nodes())
+        paged_node_links, start_after = reopened_gm.get_node_links_page(page_size=2)
+        while start_after is not None:
+            page, start_after = reopened_gm.get_node_links_page(page_size=2, start_after=start_after)
+            self.assertLessEqual(len(page), 2)
+            paged_node_links.extend(page)
+        self.assertEqual(expected_node_links, paged_node_links)
+
+    def test_missing_node(self):
+        gm = graphmap_main.GraphMap(sqlite_persistence.SqlitePersistence(self.database_filename))
+        self.assertFalse(gm.node_exists(NodeLink('sql_missing')))
+        child_name_result = gm.get_child_name(root_node_link=NodeLink('sql_missing'), quad_key='0')
+        self.assertEqual(result.NODE_LINK_NOT_FOUND_ERROR_CODE, child_name_result.code)
+
+
+class LogPersistenceTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_connect_child_and_reopen(self):
+        persistence = log_persistence.LogPersistence(self.directory, max_segment_bytes=300, initial_index_capacity=4)
+        gm = graphmap_main.GraphMap(persistence)
+        first_node_link = NodeLink('log_first', 'log_persistence_test.tsv')
+        second_node_link = NodeLink('log_second', 'log_persistence_test.tsv')
+        gm.create_node(root_node_link=first_node_link, image_value_link=wiki_image_url)
+        gm.create_node(root_node_link=second_node_link, image_value_link=seattle_skyline_url)
+        quad_key = '0132'
+        new_root_result = gm.connect_child(root_node_link=first_node_link, quad_key=quad_key,
+                                           child_node_link=second_node_link)
+        self.assertTrue(new_root_result.is_success(), new_root_result.message)
+        persistence.close()
+        reopened_gm = graphmap_main.GraphMap(log_persistence.LogPersistence(self.directory))
+        self.assertEqual(second_node_link,
+                         reopened_gm.get_child_name(new_root_result.value, quad_key=quad_key).value)
+        self.assertEqual(2 + 1 + 4 * len(quad_key) - 1, reopened_gm.persistence.count_nodes())
+        self.assertFalse(reopened_gm.node_exists(NodeLink('log_missing', 'log_persistence_test.tsv')))
+
+    def test_recovers_after_crash(self):
+        persistence = log_persistence.LogPersistence(self.directory)
+        gm = graphmap_main.GraphMap(persistence)
+        node_link = NodeLink('log_crash', 'log_persistence_test.tsv')
+        gm.create_node(root_node_link=node_link, image_value_link=wiki_image_url)
+        persistence.close()
+        with open(persistence.segment_path(persistence.segment), 'ab') as f:
+            f.write('\x00\x00\x00\x09torn')
+        os.remove(os.path.join(self.directory, log_persistence.index_filename))
+        recovered = log_persistence.LogPersistence(self.directory)
+        self.assertTrue(recovered.exists(node_link))
+        self.assertEqual(1, recovered.count_nodes())
+        gm = graphmap_main.GraphMap(recovered)
+        after_crash_link = NodeLink('log_after_crash', 'log_persistence_test.tsv')
+        self.assertTrue(gm.create_node(root_node_link=after_crash_link, image_value_link=wiki_image_url).is_success())
+        self.assertEqual(2, len(recovered.get_all_node_links()))
+        recovered.close()
+        reopened = log_persistence.LogPersistence(self.directory)
+        self.assertEqual([True, True], [reopened.exists(link) for link in [node_link, after_crash_link]])
+        self.assertEqual('log_after_crash', reopened.get_tree(after_crash_link).value.name)
+        reopened.close()
+
+    def test_grown_index_keeps_latest_record_of_each_key(self):
+        persistence = log_persistence.LogPersistence(self.directory, initial_index_capacity=4)
+        for version in range(3):
+            persistence.write_serialized_nodes([('grow.tsv', 'a', 'a {}'.format(version), None)])
+        persistence.write_serialized_nodes([('grow.tsv', name, name, None) for name in ['b', 'c']])
+        self.assertEqual(8, persistence.index.capacity)
+        self.assertEqual(3, persistence.count_nodes())
+        self.assertEqual('a 2', persistence.read_serialized_node('grow.tsv', 'a'))
+        persistence.close()
+
+    def test_reads_do_not_wait_for_writes(self):
+        persistence = log_persistence.LogPersistence(self.directory)
+        persistence.write_serialized_nodes([('read.tsv', 'a', 'a line', None)])
+        read_values = []
+        with persistence._lock:
+            reader = threading.Thread(target=lambda: read_values.append(
+                persistence.read_serialized_node('read.tsv', 'a')))
+            reader.start()
+            reader.join(5)
+        self.assertEqual(['a line'], read_values)
+        persistence.close()
+
+    def test_concurrent_reads_while_the_index_grows(self):
+        persistence = log_persistence.LogPersistence(self.directory, max_segment_bytes=2000, initial_index_capacity=4)
+        persistence.write_serialized_nodes([('grow.tsv', 'first', 'first line', None)])
+        errors = []
+        writes_done = threading.Event()
+
+        def read():
+            try:
+                while not writes_done.is_set():
+                    if persistence.read_serialized_node('grow.tsv', 'first') != 'first line':
+                        errors.append('first not found')
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        for i in range(500):
+            persistence.write_serialized_nodes([('grow.tsv', str(i), 'line {}'.format(i), None)])
+        writes_done.set()
+        for reader in readers:
+            reader.join()
+        self.assertEqual([], errors)
+        self.assertEqual(1024, persistence.index.capacity)
+        self.assertEqual('line 499', persistence.read_serialized_node('grow.tsv', '499'))
+        persistence.close()
+
+    def test_rewritten_node_is_listed_once(self):
+        persistence = log_persistence.LogPersistence(self.directory, max_segment_bytes=10)
+        for version in range(3):
+            persistence.write_serialized_nodes([('rewrite.tsv', 'a', 'a {}'.format(version), None)])
+        persistence.write_serialized_nodes([('rewrite.tsv', 'b', 'b', None)])
+        self.assertEqual(3, persistence.segment)
+        self.assertEqual(['a@rewrite.tsv', 'b@rewrite.tsv'], sorted(persistence.get_all_node_links()))
+        self.assertEqual(2, graphmap_main.GraphMap(persistence).count_nodes())
+        persistence.close()
+
+
+class MemoryPersistenceConcurrencyTests(unittest.TestCase):
+    def test_concurrent_put_get_exists(self):
+        persistence = memory_persistence.MemoryPersistence(stripe_count=4)
+        thread_count, nodes_per_thread = 8, 200
+        errors = []
+
+        def work(thread_index):
+            try:
+                perf_tester.memory_persistence_workload(persistence, thread_index, nodes_per_thread)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(thread_count * nodes_per_thread, persistence.count_nodes())
+        self.assertEqual(thread_count * nodes_per_thread, len(set(persistence.get_all_node_links())))
+
+    def test_concurrent_misses_load_once(self):
+        filename = 'stampede_test.tsv'
+        utilities.put_contents('stampede' + '\t' * 8 + seattle_skyline_url + '\n', filename)
+        persistence = memory_persistence.MemoryPersistence()
+        start = threading.Event()
+        loaded_trees = []
+
+        def load():
+            start.wait()
+            loaded_trees.append(persistence.get_tree(NodeLink('stampede', filename)).value)
+
+        threads = [threading.Thread(target=load) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        os.remove(filename)
+        self.assertEqual(1, persistence.disk_load_count)
+        self.assertEqual(16, len(loaded_trees))
+        self.assertTrue(all(tree is loaded_trees[0] for tree in loaded_trees))
+
+    def test_concurrent_misses_on_different_links_are_all_counted(self):
+        filename = 'stampede_many_test.tsv'
+        link_count = 32
+        utilities.put_contents(''.join('stampede' + str(i) + '\t' * 8 + seattle_skyline_url + '\n'
+                                       for i in range(link_count)), filename)
+        persistence = memory_persistence.MemoryPersistence()
+        start = threading.Event()
+
+        def load(i):
+            start.wait()
+            persistence.get_tree(NodeLink('stampede' + str(i), filename))
+
+        threads = [threading.Thread(target=load, args=(i,)) for i in range(link_count)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        os.remove(filename)
+        self.assertEqual(link_count, persistence.disk_load_count)
+        self.assertEqual(link_count, persistence.count_nodes())
+
+
 class IntegrationTests(unittest.TestCase):
     def test_getting_started_sample(self):
         G, created_node_link_result = self.create_sample()
@@ -275,6 +545,28 @@ class IntegrationTests(unittest.TestCase):
                                                    child_node_link=mt_tacoma_node_link)
         return G, created_node_link_result
 
+    def test_page_count_and_prefix(self):
+        G, root_node_link_result = self.create_sample()
+        node_links = list(G.iter_node_links())
+        self.assertEqual(sorted(G.get_all_node_links()), sorted(node_links))
+        self.assertEqual(len(node_links), G.count_nodes())
+        first_page, start_after = G.get_node_links_page(page_size=2)
+        second_page, _ = G.get_node_links_page(page_size=len(node_links), start_after=start_after)
+        self.assertEqual(node_links, first_page + second_page)
+        self.assertEqual(['seattle'], list(G.iter_node_links(prefix='sea')))
+        self.assertEqual(1, G.count_nodes(filename='', prefix='ta'))
+
+    def test_file_catalog_reopens(self):
+        catalog_file, catalog_filename = tempfile.mkstemp(suffix='.tsv')
+        os.close(catalog_file)
+        file_catalog = catalog.FileCatalog(catalog_filename)
+        file_catalog.add_many([('b.tsv', 'x'), ('a.tsv', 'y'), ('a.tsv', 'x'), ('a.tsv', 'x')])
+        reopened = catalog.FileCatalog(catalog_filename)
+        os.remove(catalog_filename)
+        self.assertEqual(['x@a.tsv', 'y@a.tsv', 'x@b.tsv'], list(reopened.iter_node_links()))
+        self.assertEqual(2, reopened.count(filename='a.tsv'))
+        self.assertEqual(['y@a.tsv'], list(reopened.iter_node_links(filename='a.tsv', start_after='x@a.tsv')))
+
     def test_list_all_nodes(self):
         G, root_node_link_result = self.create_sample()
         node_name_list = G.get_all_node_links()
@@ -1,20 +1,44 @@
+import BaseHTTPServer
+import SocketServer
+import cStringIO
 import copy
+import gc
+import json
 import os
+import shutil
+import socket
+import tempfile
+import threading
 import time
 import unittest
+import urllib2
+from collections import OrderedDict
 
 import numpy as np
 from PIL import Image
 
 from graphmap import alpha_conversion
 from graphmap import azure_image_tree
+from graphmap import catalog
 from graphmap import constants
+from graphmap import file_cache
+from graphmap import graph_helpers
+from graphmap import http_client
+from graphmap import image_disk_cache
 from graphmap import imagetree
 from graphmap import imagevalue
+from graphmap import link_prefetcher
+from graphmap import memory_persistence
+from graphmap import negative_cache
 from graphmap import serializer
 from graphmap import standard_nodes
 from graphmap import standard_pixel
 from graphmap import tile_disk_cache
+from graphmap import tile_memory_cache
+from graphmap import tile_metrics
+from graphmap import tile_pack_cache
+from graphmap import tile_warmer
+from graphmap import tile_write_behind
 from graphmap import tree_creator
 from graphmap import tree_operator
 from graphmap import treegenerator
@@ -119,6 +143,163 @@ class TestImageTree(unittest.TestCase):
         self.assertEqual(loaded_tree, tree)
         os.remove(second_filename)
 
+    def test_evicted_file_reloads(self):
+        filenames = ['evict_first.tsv', 'evict_second.tsv']
+        for filename in filenames:
+            serializer.save_tree(TestImageTree.create_one_high_tree(filename=filename))
+        one_file_budget = serializer.Serializer().load_node(
+            utilities.format_node_address(filenames[0], 'father')).serializer.filename_treemap_map.used_bytes
+        small_serializer = serializer.Serializer(treemap_cache_bytes=one_file_budget)
+        for filename in filenames + filenames[:1]:
+            loaded_tree = small_serializer.load_node(utilities.format_node_address(filename, 'father'))
+            self.assertEqual(TestImageTree.father_pixel, tuple(loaded_tree.get_np_array(1).flatten()))
+        treemap_cache = small_serializer.filename_treemap_map
+        self.assertEqual(3, treemap_cache.misses)
+        self.assertEqual(2, treemap_cache.evictions)
+        self.assertLessEqual(treemap_cache.used_bytes, one_file_budget)
+        for filename in filenames:
+            os.remove(filename)
+
+    def test_serializers_share_loaded_file(self):
+        filename = 'shared_file.tsv'
+        serializer.save_tree(TestImageTree.create_one_high_tree(filename=filename))
+        link = utilities.format_node_address(filename, 'father')
+        shared_cache = file_cache.FileCache()
+        first_serializer = serializer.Serializer(shared_file_cache=shared_cache)
+        second_serializer = serializer.Serializer(shared_file_cache=shared_cache)
+        first_tree = first_serializer.load_node(link)
+        second_tree = second_serializer.load_node(link)
+        self.assertEqual(first_tree, second_tree)
+        self.assertEqual(1, shared_cache.raw_cache.misses)
+        # Each serializer gets nodes of its own, whose children are loaded through it.
+        for loading_serializer, loaded_tree in [(first_serializer, first_tree), (second_serializer, second_tree)]:
+            self.assertIs(loading_serializer, loaded_tree.serializer)
+            for child in loaded_tree.get_children():
+                self.assertIs(loading_serializer, child.serializer)
+        self.assertEqual(1, second_serializer.filename_treemap_map.misses)
+        os.remove(filename)
+        serializer.save_tree(TestImageTree.create_one_high_tree(filename=filename))
+        os.utime(filename, (0, 0))
+        reloaded_tree = serializer.Serializer(shared_file_cache=shared_cache).load_node(link)
+        self.assertIsNot(first_tree, reloaded_tree)
+        self.assertEqual(first_tree, reloaded_tree)
+        os.remove(filename)
+
+    def test_prefetch_linked_files(self):
+        child_filename = 'prefetch_child.tsv'
+        root_filename = 'prefetch_root.tsv'
+        serializer.save_tree(TestImageTree.create_one_high_tree(filename=child_filename))
+        children_links = [utilities.format_node_address(child_filename, name) for name in
+                          ['father', 'son', 'son2', 'daughter']]
+        utilities.put_contents('root\t\t\t\t' + '\t'.join(children_links) + '\n', root_filename)
+        shared_cache = file_cache.FileCache()
+        prefetcher = link_prefetcher.LinkPrefetcher(worker_count=2)
+        prefetching_serializer = serializer.Serializer(shared_file_cache=shared_cache, prefetcher=prefetcher)
+        root_tree = prefetching_serializer.load_node(utilities.format_node_address(root_filename, 'root'))
+        prefetcher.wait()
+        self.assertEqual(1, prefetcher.loaded_count)
+        self.assertIn(child_filename, shared_cache.raw_cache)
+        self.assertIn(child_filename, prefetching_serializer.filename_treemap_map)
+        treemap_misses = prefetching_serializer.filename_treemap_map.misses
+        self.assertEqual('father', root_tree.get_children()[0].name)
+        self.assertEqual(treemap_misses, prefetching_serializer.filename_treemap_map.misses)
+        os.remove(child_filename)
+        os.remove(root_filename)
+
+    def test_prefetch_counters_add_up_with_many_workers(self):
+        class LinklessTreeMap:
+            def get_linked_filenames(self, filename):
+                return []
+
+        class PrefetchingSerializer:
+            filename_treemap_map = {}
+
+            def load_tree_map(self, filename):
+                if filename.endswith('00'):
+                    raise IOError('Missing ' + filename)
+                return LinklessTreeMap()
+
+        file_count = 2000
+        prefetcher = link_prefetcher.LinkPrefetcher(worker_count=8, max_queued=file_count)
+        for i in range(1, file_count + 1):
+            prefetcher.schedule('counted_{}'.format(i), serializer=PrefetchingSerializer(), depth=1)
+        prefetcher.wait()
+        stats = prefetcher.stats_dict()
+        self.assertEqual(str(file_count), stats['scheduled'])
+        self.assertEqual(str(file_count / 100), stats['failed'])
+        self.assertEqual(str(file_count - file_count / 100), stats['loaded'])
+        self.assertEqual('0', stats['pending'])
+
+    def test_missing_node_is_remembered(self):
+        filename = 'negative_cache_test.tsv'
+        serializer.save_tree(TestImageTree.create_one_high_tree(filename=filename))
+        missing_cache = negative_cache.NegativeCache(ttl_seconds=60)
+        missing_link = utilities.format_node_address(filename, 'nobody')
+        for _ in range(3):
+            loaded_tree = serializer.Serializer(missing_cache=missing_cache).load_node(missing_link)
+            self.assertEqual(standard_nodes.node_not_found_name, loaded_tree.name)
+        self.assertEqual(2, missing_cache.hits)
+        missing_cache.ttl_seconds = -1
+        missing_cache.add(negative_cache.node_key(filename, 'nobody'))
+        self.assertFalse(missing_cache.is_missing(negative_cache.node_key(filename, 'nobody')))
+        self.assertEqual(1, missing_cache.expirations)
+        os.remove(filename)
+
+    def test_missing_local_file_is_remembered(self):
+        missing_cache = negative_cache.NegativeCache(ttl_seconds=60)
+        missing_link = utilities.format_node_address('no_such_file_test.tsv', 'nobody')
+        persistence = memory_persistence.MemoryPersistence()
+        original_cache = negative_cache.shared_negative_cache
+        serializer_of_test = serializer.Serializer(missing_cache=missing_cache)
+        for _ in range(3):
+            self.assertEqual(standard_nodes.node_not_found_name, serializer_of_test.load_node(missing_link).name)
+        self.assertEqual(2, missing_cache.hits)
+        self.assertTrue(missing_cache.is_missing(negative_cache.file_key('no_such_file_test.tsv')))
+        negative_cache.shared_negative_cache = missing_cache
+        try:
+            for _ in range(2):
+                self.assertFalse(persistence.get_tree(graph_helpers.NodeLink('nobody', 'no_such_file_test.tsv'))
+                                 .is_success())
+        finally:
+            negative_cache.shared_negative_cache = original_cache
+
+    def test_get_all_node_links_of_loaded_file(self):
+        filename = 'catalog_test.tsv'
+        tree = TestImageTree.create_one_high_tree(filename=filename)
+        file_serializer = serializer.Serializer()
+        file_serializer.put_tree(tree)
+        expected_links = [utilities.format_node_address(filename, name)
+                          for name in sorted(['father'] + TestImageTree.children_names)]
+        self.assertEqual(expected_links, file_serializer.get_all_node_links())
+        loading_serializer = serializer.Serializer()
+        loading_serializer.load_node(utilities.format_node_address(filename, 'father'))
+        self.assertEqual(expected_links, loading_serializer.get_all_node_links())
+        os.remove(filename)
+
+    def test_catalog_lists_loaded_files_while_they_are_loaded(self):
+        filenames = ['catalog_evict_first.tsv', 'catalog_evict_second.tsv']
+        for filename in filenames:
+            serializer.save_tree(TestImageTree.create_one_high_tree(filename=filename))
+        one_file_budget = serializer.Serializer().load_node(
+            utilities.format_node_address(filenames[0], 'father')).serializer.filename_treemap_map.used_bytes
+        small_serializer = serializer.Serializer(treemap_cache_bytes=one_file_budget)
+        given_catalog_serializer = serializer.Serializer(treemap_cache_bytes=one_file_budget,
+                                                         node_catalog=catalog.MemoryCatalog())
+        for filename in filenames:
+            small_serializer.load_node(utilities.format_node_address(filename, 'father'))
+            given_catalog_serializer.load_node(utilities.format_node_address(filename, 'father'))
+        self.assertEqual([filenames[1]], small_serializer.get_catalog().filenames())
+        self.assertEqual(1 + len(TestImageTree.children_names), small_serializer.get_catalog().count())
+        self.assertEqual(sorted(filenames), given_catalog_serializer.get_catalog().filenames())
+        for filename in filenames:
+            os.remove(filename)
+
+    def test_immutable_filename(self):
+        self.assertTrue(file_cache.is_immutable_filename('https://a.com/user/b/start.ver_10.tsv'))
+        self.assertTrue(file_cache.is_immutable_filename('start.ver_0.tsv.gz'))
+        self.assertFalse(file_cache.is_immutable_filename('https://a.com/firstnodes/fruits.tsv'))
+        self.assertFalse(file_cache.is_immutable_filename('https://a.ver_1.com/fruits.tsv'))
+
     def test_get_child_leaf(self):
         leaf = imagetree.ImageTree(children=[], name='test_leaf', input_image=(), children_links=[],
                                    serializer=serializer.Serializer(), filename='')
@@ -268,15 +449,50 @@ class TestImageTree(unittest.TestCase):
         operated_tree = tree_operator.apply_operators(sample_tree, operation_list)
         self.assertEqual(operated_tree, sample_tree)
 
+    def test_canonical_node_name(self):
+        self.assertEqual('jiji', tree_operator.canonical_node_name('rot90#rot90#rot180#jiji'))
+        self.assertEqual(tree_operator.canonical_node_name('rot180#jiji'),
+                         tree_operator.canonical_node_name('rot90#rot90#jiji'))
+        self.assertEqual('[2, 0, 3, 1]#jiji', tree_operator.canonical_node_name('rot90#jiji'))
+        self.assertEqual('[2, 0, 3, 1]#jiji', tree_operator.canonical_node_name('[2, 0, 3, 1]#jiji'))
+        self.assertEqual('a#b', tree_operator.canonical_node_name('a#b'))
+
+    def test_operated_view_reuses_untransformed_tiles(self):
+        sample_serializer = serializer.Serializer()
+        colors = [(10, 0, 0), (0, 20, 0), (0, 0, 30), (40, 40, 40)]
+        children = [imagetree.ImageTree(name='child' + str(i), children_links=[], input_image=color,
+                                        serializer=sample_serializer, children=[], filename='view.tsv')
+                    for i, color in enumerate(colors)]
+        base_tree = imagetree.ImageTree(name='base', children_links=[child.name for child in children],
+                                        input_image=(), children=children, serializer=sample_serializer,
+                                        filename='view.tsv')
+        operated_tree = tree_operator.operate_tree(base_tree, tree_operator.Operation.Rotate90)
+        rendered_array = operated_tree.render(4, np.zeros((4, 4, 3), dtype=np.uint8))
+        self.assertTrue(np.array_equal(rendered_array, operated_tree.get_np_array(4)))
+        self.assertEqual(colors[2], tuple(operated_tree.get_np_array(4)[0, 0]))
+        source_tree, relative_quad_key = operated_tree.tile_source('03')
+        self.assertEqual(('base', '23'), (source_tree.name, relative_quad_key))
+        self.assertTrue(np.array_equal(np.array(base_tree.get_pil_image_at_quadkey(4, '23')),
+                                       np.array(operated_tree.get_pil_image_at_quadkey(4, '03'))))
+        cache_dir = tempfile.mkdtemp()
+        disk_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=10)
+        sample_serializer.image_cache = disk_cache
+        operated_tree.get_pil_image(8)
+        base_tree.get_pil_image(8)
+        self.assertEqual(1, disk_cache.cache_count)
+        self.assertEqual(1, disk_cache.hits)
+        sample_serializer.image_cache = None
+        disk_cache.cache_burst()
+        os.rmdir(cache_dir)
+
     @unittest.skip('Not using cache now')
     def test_image_tree_args_to_path(self):
         sample_tree = TestImageTree.create_one_high_tree()
         cache_dir = 'test_args_cache_imagtree'
         cacher = tile_disk_cache.TileCache(cache_dir, size=10)
         save_path = cacher.image_tree_args_to_path(sample_tree, resolution=512)
-        self.assertTrue(save_path.startswith(os.path.join(cache_dir, '512',
-                                                          tile_disk_cache.to_valid_filename(sample_tree.filename),
-                                                          sample_tree.name)), save_path)
+        key = tile_disk_cache.tile_key(sample_tree.get_link(), resolution=512)
+        self.assertEqual(os.path.join(cache_dir, key[:2], key[2:4], key + '.jpg'), save_path)
         os.removedirs(cache_dir)
 
 
@@ -307,6 +523,602 @@ class ImageTreeCacheTests(unittest.TestCase):
         self.assertEqual(image_cache.count_files_in_disk(), 0)
         self.assertEqual(image_cache.cache_count, 0)
 
+    def test_least_recently_used_tile_is_evicted(self):
+        test_tree = TestImageTree.create_one_high_tree()
+        cache_dir = tempfile.mkdtemp()
+        image_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=2, background_eviction=False)
+        test_tree.serializer.image_cache = image_cache
+        for resolution in [4, 8]:
+            test_tree.get_pil_image(resolution=resolution)
+        self.assertIsNotNone(image_cache.get_image(test_tree, 4))
+        test_tree.get_pil_image(resolution=16)
+        self.assertEqual(2, image_cache.cache_count)
+        self.assertEqual(2, image_cache.count_files_in_disk())
+        self.assertEqual(1, image_cache.evictions)
+        self.assertFalse(image_cache.has_image(test_tree, 8))
+        self.assertTrue(image_cache.has_image(test_tree, 4))
+        image_cache.close()
+        reopened = tile_disk_cache.TileCache(cache_dir=cache_dir, size=2)
+        self.assertEqual(2, reopened.cache_count)
+        self.assertEqual(image_cache.used_bytes, reopened.used_bytes)
+        self.assertIsNotNone(reopened.get_image(test_tree, 16))
+        self.assertIsNone(reopened.get_image(test_tree, 8))
+        test_tree.serializer.image_cache = None
+        reopened.cache_burst()
+        self.assertEqual(0, reopened.count_files_in_disk())
+        os.rmdir(cache_dir)
+
+    def test_background_eviction_goes_down_to_low_watermark(self):
+        cache_dir = tempfile.mkdtemp()
+        image_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=100, max_bytes=1000, high_watermark=0.9,
+                                                low_watermark=0.5, eviction_batch_size=2)
+        for i in range(9):
+            image_cache.put_encoded(str(i) * 40, 'x' * 100)
+        self.assertIsNone(image_cache._eviction_thread)
+        image_cache.put_encoded('9' * 40, 'x' * 100)
+        deadline = time.time() + 5
+        while image_cache.used_bytes > 500 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(500, image_cache.used_bytes)
+        self.assertEqual(5, image_cache.evictions)
+        self.assertIsNone(image_cache.get_encoded('0' * 40))
+        self.assertIsNotNone(image_cache.get_encoded('9' * 40))
+        image_cache.close()
+        self.assertIsNone(image_cache._eviction_thread)
+        self.assertEqual(5, image_cache.count_files_in_disk())
+        image_cache.cache_burst()
+        os.rmdir(cache_dir)
+
+    def test_processes_sharing_a_cache_merge_their_indexes(self):
+        cache_dir = tempfile.mkdtemp()
+        first_cache, second_cache = [tile_disk_cache.TileCache(cache_dir=cache_dir, size=10, background_eviction=False)
+                                     for _ in range(2)]
+        first_cache.put_encoded('1' * 40, 'x' * 10)
+        second_cache.put_encoded('2' * 40, 'y' * 20)
+        first_cache.save_index()
+        second_cache.save_index()
+        first_cache.save_index()
+        self.assertEqual(2, len(first_cache.read_saved_index()))
+        self.assertEqual((2, 30), (first_cache.cache_count, first_cache.used_bytes))
+        second_cache.size = 1
+        second_cache.put_encoded('3' * 40, 'z' * 30)
+        self.assertEqual(2, second_cache.evictions)
+        second_cache.save_index()
+        first_cache.save_index()
+        self.assertEqual(['3' * 40 + '.jpg'], [os.path.basename(path) for path in first_cache.read_saved_index()])
+        self.assertEqual((1, 30), (first_cache.cache_count, first_cache.used_bytes))
+        self.assertEqual(1, first_cache.count_files_in_disk())
+        first_cache.cache_burst()
+        os.rmdir(cache_dir)
+
+    def test_index_is_saved_off_the_request_thread(self):
+        cache_dir = tempfile.mkdtemp()
+        image_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=10, index_save_interval=2)
+        saving_threads = []
+        save_index = image_cache.save_index
+        image_cache.save_index = lambda: (saving_threads.append(threading.current_thread().name), save_index())
+        for i in range(2):
+            image_cache.put_encoded(str(i) * 40, 'x' * 10)
+        deadline = time.time() + 5
+        while not os.path.isfile(image_cache.index_path()) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(['TileCacheEviction'], saving_threads)
+        self.assertEqual(2, len(open(image_cache.index_path()).readlines()))
+        image_cache.close()
+        image_cache.cache_burst()
+        os.rmdir(cache_dir)
+
+    def test_index_is_saved_after_stores_not_lookups(self):
+        cache_dir = tempfile.mkdtemp()
+        image_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=10, index_save_interval=2,
+                                                background_eviction=False)
+        image_cache.put_encoded('a' * 40, 'x' * 10)
+        for _ in range(5):
+            self.assertEqual('x' * 10, image_cache.get_encoded('a' * 40))
+        self.assertFalse(os.path.isfile(image_cache.index_path()))
+        image_cache.put_encoded('b' * 40, 'y' * 10)
+        self.assertEqual(2, len(open(image_cache.index_path()).readlines()))
+        image_cache.cache_burst()
+        os.rmdir(cache_dir)
+
+    def test_entries_changed_during_an_index_merge_are_kept(self):
+        cache_dir = tempfile.mkdtemp()
+        image_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=10, background_eviction=False)
+        image_cache.put_encoded('a' * 40, 'x' * 10)
+        image_cache.put_encoded('b' * 40, 'y' * 20)
+        image_cache.save_index()
+        saved_entries = image_cache.read_saved_index()
+        test = self
+
+        class ChangedDuringMerge(OrderedDict):
+            def iteritems(self):
+                # Runs after the entries are copied, while the merge does not hold the lock.
+                image_cache.put_encoded('c' * 40, 'z' * 5)
+                os.remove(os.path.join(cache_dir, tile_disk_cache.tile_key_to_relative_path('a' * 40)))
+                test.assertIsNone(image_cache.get_encoded('a' * 40))
+                return OrderedDict.iteritems(self)
+
+        image_cache.read_saved_index = lambda: ChangedDuringMerge(saved_entries)
+        image_cache.save_index()
+        self.assertEqual(['b' * 40, 'c' * 40], sorted(os.path.basename(relative_path)[:-len('.jpg')]
+                                                      for relative_path in image_cache._entries))
+        self.assertEqual(25, image_cache.used_bytes)
+        del image_cache.read_saved_index
+        image_cache.save_index()
+        self.assertEqual(2, len(open(image_cache.index_path()).readlines()))
+        image_cache.cache_burst()
+        os.rmdir(cache_dir)
+
+    def test_lookups_are_not_blocked_by_an_index_save(self):
+        cache_dir = tempfile.mkdtemp()
+        image_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=10 ** 6, max_bytes=None,
+                                                background_eviction=False)
+        image_cache.put_encoded('a' * 40, 'x' * 10)
+        with image_cache._lock:
+            for i in xrange(100000):
+                image_cache._add_entry(tile_disk_cache.tile_key_to_relative_path('{:040x}'.format(i)), 100, i)
+        saving_thread = threading.Thread(target=image_cache.save_index)
+        start_time = time.time()
+        saving_thread.start()
+        lookup_seconds = []
+        while saving_thread.is_alive():
+            lookup_start_time = time.time()
+            self.assertEqual('x' * 10, image_cache.get_encoded('a' * 40))
+            lookup_seconds.append(time.time() - lookup_start_time)
+        save_seconds = time.time() - start_time
+        self.assertLess(max(lookup_seconds), save_seconds / 4)
+        self.assertEqual(100001, image_cache.cache_count)
+        image_cache.cache_burst()
+        os.rmdir(cache_dir)
+
+    def test_concurrent_writes_of_one_tile_do_not_tear(self):
+        cache_dir = tempfile.mkdtemp()
+        image_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=10, background_eviction=False)
+        payloads = [str(i) * 10000 for i in range(10)]
+        errors = []
+
+        def put(payload):
+            try:
+                image_cache.put_encoded('a' * 40, payload)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=put, args=(payload,)) for payload in payloads * 3]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertIn(image_cache.get_encoded('a' * 40), payloads)
+        self.assertEqual(1, image_cache.count_files_in_disk())
+        image_cache.close()
+        self.assertEqual([], [f for _, _, files in os.walk(cache_dir) for f in files if f.endswith('.tmp')])
+        image_cache.cache_burst()
+        os.rmdir(cache_dir)
+
+    def test_failed_atomic_write_raises_and_leaves_no_temporary_file(self):
+        directory = tempfile.mkdtemp()
+        # Renaming a file over a non-empty directory fails, unlike a rename over a file another writer stored.
+        file_path = os.path.join(directory, 'tile')
+        os.mkdir(file_path)
+        open(os.path.join(file_path, 'inside'), 'w').close()
+        with self.assertRaises(OSError):
+            utilities.write_file_atomically(file_path, 'contents')
+        self.assertEqual(['tile'], os.listdir(directory))
+        shutil.rmtree(directory)
+
+    def test_memory_tier_serves_hot_tiles(self):
+        test_tree = TestImageTree.create_one_high_tree()
+        cache_dir = tempfile.mkdtemp()
+        disk_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=10)
+        tiered_cache = tile_memory_cache.TieredTileCache(disk_cache)
+        test_tree.serializer.image_cache = tiered_cache
+        first_image = test_tree.get_pil_image(resolution=8)
+        for _ in range(3):
+            self.assertEqual(first_image.size, test_tree.get_pil_image(resolution=8).size)
+        self.assertEqual(0, disk_cache.hits)
+        self.assertEqual(3, tiered_cache.memory_cache.hits)
+        promoting_cache = tile_memory_cache.TieredTileCache(disk_cache)
+        self.assertIsNotNone(promoting_cache.get_encoded_image(test_tree, 8))
+        self.assertIsNotNone(promoting_cache.get_encoded_image(test_tree, 8))
+        stats = promoting_cache.stats_dict()
+        self.assertEqual(0.5, stats['memory hit ratio'])
+        self.assertEqual(0.5, stats['disk hit ratio'])
+        test_tree.serializer.image_cache = None
+        tiered_cache.cache_burst()
+        os.rmdir(cache_dir)
+
+    def test_tile_key_is_stable_and_sharded(self):
+        key = tile_disk_cache.tile_key('fruits@fruits.tsv', 256)
+        self.assertEqual('4f1681ebf442eb74739695db74c8c3152af08937', key)
+        self.assertNotEqual(key, tile_disk_cache.tile_key('fruits@fruits.tsv', 512))
+        self.assertNotEqual(tile_disk_cache.tile_key('a_b@c', 256), tile_disk_cache.tile_key('ab@c', 256))
+        self.assertEqual(os.path.join('4f', '16', key + '.jpg'), tile_disk_cache.tile_key_to_relative_path(key))
+
+    def test_pack_cache_batch_put_and_evict(self):
+        test_tree = TestImageTree.create_one_high_tree()
+        pack_file, pack_filename = tempfile.mkstemp(suffix='.mbtiles')
+        os.close(pack_file)
+        pack_cache = tile_pack_cache.SqliteTileCache(pack_filename, size=2, background_eviction=False)
+        encoded_tiles = [(tile_disk_cache.encode_image(test_tree.get_pil_image(resolution)), test_tree, resolution)
+                         for resolution in [4, 8]]
+        pack_cache.put_encoded_images(encoded_tiles)
+        self.assertEqual(2, pack_cache.cache_count)
+        self.assertEqual((4, 4), pack_cache.get_image(test_tree, 4).size)
+        test_tree.serializer.image_cache = pack_cache
+        test_tree.get_pil_image(resolution=16)
+        test_tree.serializer.image_cache = None
+        self.assertFalse(pack_cache.has_image(test_tree, 8))
+        self.assertTrue(pack_cache.has_image(test_tree, 4))
+        self.assertEqual(1, pack_cache.evictions)
+        pack_cache.close()
+        reopened = tile_pack_cache.SqliteTileCache(pack_filename, size=2)
+        self.assertEqual(2, reopened.cache_count)
+        self.assertEqual(pack_cache.used_bytes, reopened.used_bytes)
+        reopened.cache_burst()
+        self.assertEqual(0, reopened.count_files_in_disk())
+        reopened.close()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.isfile(pack_filename + suffix):
+                os.remove(pack_filename + suffix)
+
+    def test_pack_cache_evicts_bytes_down_to_the_low_watermark(self):
+        pack_file, pack_filename = tempfile.mkstemp(suffix='.mbtiles')
+        os.close(pack_file)
+        pack_cache = tile_pack_cache.SqliteTileCache(pack_filename, size=100, max_bytes=100, high_watermark=0.95,
+                                                     low_watermark=0.5, background_eviction=False)
+        for i in range(9):
+            pack_cache.put_encoded('{:040d}'.format(i), 'x' * 10)
+            # Distinct access times, oldest first.
+            pack_cache.connection().execute('UPDATE tiles SET last_access = ? WHERE tile_key = ?',
+                                            (i, '{:040d}'.format(i)))
+            pack_cache.connection().commit()
+        self.assertEqual(0, pack_cache.evictions)
+        pack_cache.put_encoded('{:040d}'.format(9), 'x' * 10)
+        self.assertEqual(5, pack_cache.evictions)
+        self.assertEqual((5, 50), (pack_cache.cache_count, pack_cache.used_bytes))
+        self.assertIsNone(pack_cache.get_encoded('{:040d}'.format(4)))
+        self.assertIsNotNone(pack_cache.get_encoded('{:040d}'.format(5)))
+        pack_cache.put_encoded('{:040d}'.format(10), 'x' * 10)
+        self.assertEqual(5, pack_cache.evictions)
+        pack_cache.close()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.isfile(pack_filename + suffix):
+                os.remove(pack_filename + suffix)
+
+    def test_pack_cache_counters_match_table_under_concurrent_puts(self):
+        pack_file, pack_filename = tempfile.mkstemp(suffix='.mbtiles')
+        os.close(pack_file)
+        pack_cache = tile_pack_cache.SqliteTileCache(pack_filename, size=3)
+        errors = []
+
+        def put(thread_index):
+            try:
+                for i in range(20):
+                    pack_cache.put_encoded(str(i % 5) * 40, 'x' * (10 + thread_index))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=put, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pack_cache.close()
+        self.assertEqual([], errors)
+        self.assertEqual(3, pack_cache.cache_count)
+        connection = pack_cache.connection()
+        self.assertEqual((pack_cache.cache_count, pack_cache.used_bytes),
+                         connection.execute('SELECT COUNT(*), SUM(size) FROM tiles').fetchone())
+        pack_cache.close()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.isfile(pack_filename + suffix):
+                os.remove(pack_filename + suffix)
+
+    def test_encoded_tile_is_encoded_once(self):
+        test_tree = TestImageTree.create_one_high_tree()
+        uncached_tile = test_tree.get_encoded_tile(0, 0, 1, resolution=8, tile_format='PNG')
+        self.assertEqual((8, 8), tile_disk_cache.decode_image(uncached_tile).size)
+        cache_dir = tempfile.mkdtemp()
+        disk_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=10)
+        test_tree.serializer.image_cache = disk_cache
+        first_tile = test_tree.get_encoded_tile(0, 0, 1, resolution=8)
+        self.assertEqual(1, disk_cache.cache_count)
+        self.assertEqual(first_tile, test_tree.get_encoded_tile(0, 0, 1, resolution=8))
+        self.assertEqual(1, disk_cache.hits)
+        self.assertNotEqual(first_tile, test_tree.get_encoded_tile(0, 0, 1, resolution=8, tile_format='PNG'))
+        self.assertEqual(2, disk_cache.cache_count)
+        test_tree.serializer.image_cache = None
+        disk_cache.cache_burst()
+        os.rmdir(cache_dir)
+
+    def test_versions_sharing_a_subtree_share_tiles(self):
+        shared_tree = TestImageTree.create_one_high_tree()
+        cache_dir = tempfile.mkdtemp()
+        disk_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=10)
+        shared_tree.serializer.image_cache = disk_cache
+        versions = []
+        for version_name in ['version1', 'version2']:
+            other_children = [imagetree.ImageTree(name=version_name + str(i), children_links=[], input_image=(i, i, i),
+                                                  serializer=shared_tree.serializer, children=[],
+                                                  filename=shared_tree.filename) for i in range(3)]
+            versions.append(imagetree.ImageTree(name=version_name, children_links=[shared_tree.name] + [
+                child.name for child in other_children], input_image=(), children=[shared_tree] + other_children,
+                                                serializer=shared_tree.serializer, filename=shared_tree.filename))
+        self.assertEqual((shared_tree, '1'), versions[0].tile_source('01'))
+        first_tile = versions[0].get_encoded_tile(1, 0, 2, resolution=8)
+        self.assertEqual(first_tile, versions[1].get_encoded_tile(1, 0, 2, resolution=8))
+        self.assertEqual(1, disk_cache.hits)
+        self.assertEqual(1, disk_cache.cache_count)
+        versions[1].get_encoded_tile(1, 1, 1, resolution=8)
+        self.assertEqual(2, disk_cache.cache_count)
+        shared_tree.serializer.image_cache = None
+        disk_cache.cache_burst()
+        os.rmdir(cache_dir)
+
+    def test_warmed_tiles_are_served_from_cache(self):
+        filename = 'warm_test.tsv'
+        serializer.save_tree(TestImageTree.create_one_high_tree(filename=filename))
+        node_link = utilities.format_node_address(filename, 'father')
+        stats_file, stats_filename = tempfile.mkstemp(suffix='.tsv')
+        with os.fdopen(stats_file, 'w') as f:
+            f.write('End Point\tx\ty\tz\ttime taken in ms\thttp code\ttime of request\n')
+            f.writelines('local\t{}\t{}\t{}\t5.0\t{}\t20170101-000000\n'.format(x, y, z, code)
+                         for x, y, z, code in [(1, 0, 1, 200), (1, 0, 1, 200), (0, 0, 1, 200), (1, 1, 1, 404)])
+        self.assertEqual([(1, 0, 1), (0, 0, 1)], tile_warmer.hottest_tiles(tile_warmer.read_tile_requests(
+            stats_filename)))
+        cache_dir = tempfile.mkdtemp()
+        disk_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=3)
+        warmer = tile_warmer.TileWarmer(node_link, disk_cache, resolution=8, process_count=2, verbose=False)
+        self.assertEqual(3, warmer.warm_zoom_range(0, 5).tile_count)
+        report = tile_warmer.TileWarmer(node_link, disk_cache, resolution=8, process_count=0,
+                                        verbose=False).warm_from_requests(stats_filename, top_count=1)
+        self.assertEqual(1, report.tile_count)
+        loaded_tree = serializer.load_link_new_serializer(node_link, image_cache=disk_cache)
+        for x, y, z in [(0, 0, 0), (0, 0, 1), (1, 0, 1)]:
+            self.assertIsNotNone(loaded_tree.get_encoded_tile(x, y, z, resolution=8))
+        self.assertEqual(3, disk_cache.hits)
+        disk_cache.cache_burst()
+        os.rmdir(cache_dir)
+        os.remove(stats_filename)
+        os.remove(filename)
+
+    def test_write_behind_returns_before_tile_is_stored(self):
+        test_tree = TestImageTree.create_one_high_tree()
+        cache_dir = tempfile.mkdtemp()
+        disk_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=10)
+        write_allowed = threading.Event()
+        disk_put_encoded = disk_cache.put_encoded
+        disk_cache.put_encoded = lambda *args, **kwargs: (write_allowed.wait(), disk_put_encoded(*args, **kwargs))
+        write_behind_cache = tile_write_behind.WriteBehindTileCache(disk_cache, worker_count=1, max_pending=2)
+        test_tree.serializer.image_cache = write_behind_cache
+        first_image = test_tree.get_pil_image(resolution=8)
+        self.assertIs(first_image, test_tree.get_pil_image(resolution=8))
+        self.assertEqual(0, disk_cache.cache_count)
+        write_behind_cache.put_image(first_image, test_tree, 8)
+        test_tree.get_pil_image(resolution=4)
+        test_tree.get_pil_image(resolution=16)
+        self.assertEqual(1, write_behind_cache.deduplicated_count)
+        self.assertEqual(1, write_behind_cache.dropped_count)
+        write_allowed.set()
+        write_behind_cache.flush()
+        self.assertEqual(2, disk_cache.cache_count)
+        self.assertEqual((8, 8), disk_cache.get_image(test_tree, 8).size)
+        self.assertEqual('0', write_behind_cache.stats_dict()['write behind pending'])
+        test_tree.serializer.image_cache = None
+        write_behind_cache.cache_burst()
+        os.rmdir(cache_dir)
+
+    def test_write_behind_encodes_a_queued_image_once(self):
+        test_tree = TestImageTree.create_one_high_tree()
+        cache_dir = tempfile.mkdtemp()
+        disk_cache = tile_disk_cache.TileCache(cache_dir=cache_dir, size=10)
+        write_allowed = threading.Event()
+        disk_put_encoded = disk_cache.put_encoded
+        disk_cache.put_encoded = lambda *args, **kwargs: (write_allowed.wait(), disk_put_encoded(*args, **kwargs))
+        write_behind_cache = tile_write_behind.WriteBehindTileCache(disk_cache, worker_count=1)
+        # The only worker waits on the write of the first tile, the second one stays queued.
+        write_behind_cache.put_encoded('a' * 40, 'x' * 10)
+        encoded_images = []
+        original_encode_image = tile_disk_cache.encode_image
+        tile_disk_cache.encode_image = lambda pil_image: (encoded_images.append(pil_image),
+                                                          original_encode_image(pil_image))[1]
+        try:
+            pil_image = Image.new('RGB', size=(8, 8), color=(10, 20, 30))
+            write_behind_cache.put_image(pil_image, test_tree, 8)
+            encoded_image = write_behind_cache.get_encoded_image(test_tree, 8)
+            for _ in range(3):
+                self.assertEqual(encoded_image, write_behind_cache.get_encoded_image(test_tree, 8))
+            self.assertIs(pil_image, write_behind_cache.get_image(test_tree, 8))
+            write_allowed.set()
+            write_behind_cache.flush()
+        finally:
+            tile_disk_cache.encode_image = original_encode_image
+        self.assertEqual([pil_image], encoded_images)
+        self.assertEqual(encoded_image, disk_cache.get_encoded_image(test_tree, 8))
+        self.assertEqual('2', write_behind_cache.stats_dict()['write behind written'])
+        write_behind_cache.cache_burst()
+        os.rmdir(cache_dir)
+
+    def test_instrumented_tiers_record_hits_and_latency(self):
+        test_tree = TestImageTree.create_one_high_tree()
+        cache_dir = tempfile.mkdtemp()
+        disk_cache = tile_metrics.InstrumentedTileCache(tile_disk_cache.TileCache(cache_dir=cache_dir, size=10),
+                                                        name='disk')
+        tiered_cache = tile_metrics.InstrumentedTileCache(tile_memory_cache.TieredTileCache(disk_cache),
+                                                          name='tiered')
+        test_tree.serializer.image_cache = tiered_cache
+        for _ in range(3):
+            test_tree.get_encoded_tile(0, 0, 1, resolution=8)
+        test_tree.get_pil_image(resolution=8)
+        tiered_metrics = tiered_cache.metrics.to_dict()
+        self.assertEqual(2, tiered_metrics['hits'])
+        self.assertEqual({1: 2}, tiered_metrics['hits by zoom'])
+        self.assertEqual({1: 1}, tiered_metrics['misses by zoom'])
+        self.assertEqual({test_tree.filename: 2}, tiered_metrics['misses by filename'])
+        self.assertEqual(4, tiered_metrics['latency']['get']['count'])
+        self.assertEqual(2, disk_cache.metrics.misses)
+        self.assertEqual(tiered_cache.metrics.bytes_in, disk_cache.metrics.bytes_in)
+        stats = tiered_cache.stats_dict()
+        self.assertEqual('0.500', stats['tiered hit ratio'])
+        self.assertEqual(str(disk_cache.metrics.bytes_in), stats['disk bytes in'])
+        self.assertEqual('2/1', stats['tiered zoom 1 hits/misses'])
+        exported = json.loads(tiered_cache.export_json())
+        self.assertEqual('disk', exported['inner']['name'])
+        self.assertEqual(0, exported['inner']['evictions'])
+        test_tree.serializer.image_cache = None
+        tiered_cache.cache_burst()
+        os.rmdir(cache_dir)
+
+    def test_decoded_images_survive_restart(self):
+        url = 'http://example.com/wide.jpg'
+        fetched_urls = []
+
+        def fetch(fetched_url):
+            fetched_urls.append(fetched_url)
+            return Image.new('RGB', size=(8, 4), color=(10, 20, 30))
+
+        cache_dir = tempfile.mkdtemp()
+        original_fetch = imagevalue.fetch_image_from_url
+        imagevalue.fetch_image_from_url = fetch
+        try:
+            disk_cache = imagevalue.use_decoded_image_disk_cache(cache_dir)
+            rendered_array = imagevalue.JpgWebImage(url).get_np_array(4)
+            proper_shape = imagevalue.JpgWebImage(url).get_pil_image_at_full_resolution_proper_shape()
+            self.assertEqual([url], fetched_urls)
+            imagevalue.clear_image_cache()
+            restarted_cache = imagevalue.use_decoded_image_disk_cache(cache_dir)
+            self.assertEqual(disk_cache.used_bytes, restarted_cache.used_bytes)
+            restarted_image = imagevalue.JpgWebImage(url)
+            self.assertTrue(np.array_equal(rendered_array, restarted_image.get_np_array(4)))
+            self.assertEqual(proper_shape.size, restarted_image.get_pil_image_at_full_resolution_proper_shape().size)
+            restarted_image.get_np_array(2)
+            self.assertEqual([url], fetched_urls)
+            self.assertEqual(2, restarted_cache.hits)
+            self.assertIsInstance(restarted_cache.get_array(url), np.memmap)
+        finally:
+            imagevalue.fetch_image_from_url = original_fetch
+            imagevalue.decoded_image_disk_cache = None
+            imagevalue.clear_image_cache()
+        restarted_cache.clear()
+
+    def test_decoded_image_cache_evicts_least_recently_used(self):
+        cache_dir = tempfile.mkdtemp()
+        im_array = np.zeros((16, 16, 3), dtype=np.uint8)
+        disk_cache = image_disk_cache.DecodedImageCache(cache_dir, max_bytes=10 ** 6, background_eviction=False)
+        for age, url in enumerate(['third', 'second', 'first']):
+            disk_cache.put_array(url, im_array)
+            os.utime(disk_cache._path(url, None), (time.time() - age - 1, time.time() - age - 1))
+        file_size = disk_cache.used_bytes / 3
+        disk_cache.max_bytes = file_size * 3
+        disk_cache.low_watermark = 0.7
+        self.assertIsNotNone(disk_cache.get_array('first'))
+        disk_cache.put_array('fourth', im_array)
+        self.assertEqual(2, disk_cache.evictions)
+        self.assertEqual(2 * file_size, disk_cache.used_bytes)
+        self.assertFalse(disk_cache.has_array('second'))
+        self.assertTrue(disk_cache.has_array('first'))
+        self.assertTrue(disk_cache.has_array('fourth'))
+        disk_cache.clear()
+
+    def test_decoded_image_cache_evicts_off_the_render_thread(self):
+        cache_dir = tempfile.mkdtemp()
+        im_array = np.zeros((16, 16, 3), dtype=np.uint8)
+        disk_cache = image_disk_cache.DecodedImageCache(cache_dir, max_bytes=10 ** 6, low_watermark=0.5)
+        disk_cache.put_array('first', im_array)
+        file_size = disk_cache.used_bytes
+        disk_cache.max_bytes = file_size * 5 / 2
+        walking_threads = []
+        cache_dir_files = disk_cache._cache_dir_files
+        disk_cache._cache_dir_files = lambda: (walking_threads.append(threading.current_thread().name),
+                                               cache_dir_files())[1]
+        disk_cache.put_array('second', im_array)
+        self.assertEqual([], walking_threads)
+        disk_cache.put_array('third', im_array)
+        deadline = time.time() + 5
+        while disk_cache.evictions < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        disk_cache.close()
+        self.assertEqual(['DecodedImageCacheEviction'], walking_threads)
+        self.assertEqual(file_size, disk_cache.used_bytes)
+        disk_cache.clear()
+        shutil.rmtree(cache_dir)
+
+    def test_decoded_image_cache_counts_replaced_files_once_and_removes_stale_temporary_files(self):
+        cache_dir = tempfile.mkdtemp()
+        im_array = np.zeros((16, 16, 3), dtype=np.uint8)
+        disk_cache = image_disk_cache.DecodedImageCache(cache_dir, max_bytes=10 ** 6)
+        disk_cache.put_array('replaced', im_array)
+        file_size = disk_cache.used_bytes
+        disk_cache.put_array('replaced', im_array)
+        self.assertEqual(file_size, disk_cache.used_bytes)
+        stale_path = disk_cache._path('stale', None) + '.1.1' + image_disk_cache.temporary_extension
+        fresh_path = disk_cache._path('fresh', None) + '.1.1' + image_disk_cache.temporary_extension
+        for temporary_path in [stale_path, fresh_path]:
+            if not os.path.isdir(os.path.dirname(temporary_path)):
+                os.makedirs(os.path.dirname(temporary_path))
+            with open(temporary_path, 'wb') as f:
+                f.write('partial')
+        stale_time = time.time() - disk_cache.temporary_file_grace_seconds - 1
+        os.utime(stale_path, (stale_time, stale_time))
+        disk_cache.evict()
+        self.assertFalse(os.path.isfile(stale_path))
+        self.assertTrue(os.path.isfile(fresh_path))
+        self.assertEqual(file_size, disk_cache.used_bytes)
+        self.assertTrue(disk_cache.has_array('replaced'))
+        shutil.rmtree(cache_dir)
+
+    def test_image_cache_weighs_decoded_bytes(self):
+        sizes = {'http://example.com/square.jpg': (16, 16), 'http://example.com/wide.jpg': (16, 8)}
+        original_fetch = imagevalue.fetch_image_from_url
+        imagevalue.fetch_image_from_url = lambda url: Image.new('RGB', size=sizes[url], color=(10, 20, 30))
+        original_max_bytes = imagevalue.image_cache.max_bytes
+        imagevalue.clear_image_cache()
+        try:
+            square_image = imagevalue.JpgWebImage('http://example.com/square.jpg')
+            self.assertIs(square_image.pil_image, square_image.get_pil_image_at_full_resolution_proper_shape())
+            self.assertIs(square_image.pil_image, square_image.get_pil_image_at_full_resolution_proper_shape())
+            self.assertEqual(16 * 16 * 3, imagevalue.image_cache.used_bytes)
+            wide_image = imagevalue.JpgWebImage('http://example.com/wide.jpg')
+            self.assertEqual((16, 16), wide_image.get_pil_image_at_full_resolution_proper_shape().size)
+            self.assertEqual((16 * 16 + 16 * 8 + 16 * 16) * 3, imagevalue.image_cache.used_bytes)
+            stats = imagevalue.image_cache_stats_dict()
+            self.assertEqual('1', stats['image cache proper hits'])
+            self.assertEqual('2', stats['image cache proper misses'])
+            imagevalue.image_cache.max_bytes = 16 * 16 * 3 + 4 * 4 * 3
+            wide_image.get_np_array(4)
+            self.assertEqual(16 * 16 * 3 + 4 * 4 * 3, imagevalue.image_cache.used_bytes)
+            self.assertNotIn(('full', 'http://example.com/square.jpg'), imagevalue.image_cache)
+            self.assertIn(('proper', 'http://example.com/wide.jpg'), imagevalue.image_cache)
+        finally:
+            imagevalue.fetch_image_from_url = original_fetch
+            imagevalue.image_cache.max_bytes = original_max_bytes
+            imagevalue.clear_image_cache()
+
+    def test_trees_sharing_an_image_url_render_independently(self):
+        url = 'http://example.com/red.jpg'
+        red, blue = (255, 0, 0), (0, 0, 255)
+        original_fetch = imagevalue.fetch_image_from_url
+        imagevalue.fetch_image_from_url = lambda fetched_url: Image.new('RGB', size=(8, 8), color=red)
+        imagevalue.clear_image_cache()
+        try:
+            sample_serializer = serializer.Serializer()
+            blue_children = [imagetree.ImageTree(name='blue' + str(i), children_links=[], input_image=blue,
+                                                 serializer=sample_serializer, children=[], filename='shared.tsv')
+                             for i in range(4)]
+            parent_tree = imagetree.ImageTree(name='parent', children_links=['blue' + str(i) for i in range(4)],
+                                              input_image=imagevalue.JpgWebImage(url), serializer=sample_serializer,
+                                              children=blue_children, filename='shared.tsv')
+            leaf_tree = imagetree.ImageTree(name='leaf', children_links=[], input_image=imagevalue.JpgWebImage(url),
+                                            serializer=sample_serializer, children=[], filename='shared.tsv')
+            self.assertEqual(red, tuple(leaf_tree.get_np_array(4)[0, 0]))
+            self.assertEqual(blue, tuple(parent_tree.get_np_array(4)[0, 0]))
+            self.assertEqual(red, tuple(leaf_tree.get_np_array(4)[0, 0]))
+            self.assertFalse(imagevalue.image_cache[('array', url, 4)].flags.writeable)
+        finally:
+            imagevalue.fetch_image_from_url = original_fetch
+            imagevalue.clear_image_cache()
+
 
 class ProtobufSerializationTest(unittest.TestCase):
     def test_visit(self):
@@ -358,6 +1170,82 @@ class InteGrationTest(unittest.TestCase):
         self.assertGreater(created_tree.count_nodes(), 50)
 
 
+class ThreadingHttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class RecordingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = []
+    image_bytes = ''
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        RecordingHandler.requests.append((self.command, self.path, self.client_address[1]))
+        if self.path == '/missing.jpg':
+            status, body = 404, ''
+        elif self.headers.getheader('If-None-Match') == '"v1"':
+            status, body = 304, ''
+        else:
+            status, body = 200, RecordingHandler.image_bytes
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpClientTests(unittest.TestCase):
+    def setUp(self):
+        image_stream = cStringIO.StringIO()
+        Image.new('RGB', (4, 4), color='red').save(image_stream, 'JPEG')
+        RecordingHandler.image_bytes = image_stream.getvalue()
+        RecordingHandler.requests = []
+        self.server = ThreadingHttpServer(('127.0.0.1', 0), RecordingHandler)
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        http_client.shared_http_client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_one_request_per_fetch_on_one_connection(self):
+        self.assertEqual((4, 4), imagevalue._fetch_image_from_url(self.base_url + '/red.jpg').size)
+        self.assertEqual((256, 266), imagevalue._fetch_image_from_url(self.base_url + '/missing.jpg').size)
+        self.assertTrue(utilities.url_exists(self.base_url + '/red.jpg'))
+        self.assertFalse(utilities.url_exists(self.base_url + '/missing.jpg'))
+        contents, etag, _ = utilities.get_contents_of_url_if_modified(self.base_url + '/red.jpg')
+        self.assertEqual(RecordingHandler.image_bytes, contents)
+        self.assertIsNone(utilities.get_contents_of_url_if_modified(self.base_url + '/red.jpg', etag=etag)[0])
+        self.assertEqual([('GET', '/red.jpg'), ('GET', '/missing.jpg'), ('HEAD', '/red.jpg'),
+                          ('HEAD', '/missing.jpg'), ('GET', '/red.jpg'), ('GET', '/red.jpg')],
+                         [(method, path) for method, path, _ in RecordingHandler.requests])
+        self.assertEqual(1, len(set(port for _, _, port in RecordingHandler.requests)))
+
+    def test_closed_idle_connection_is_replaced(self):
+        client = http_client.HttpClient()
+        self.assertEqual(200, client.get(self.base_url + '/red.jpg').status)
+        for connections in client._idle_connections.itervalues():
+            for connection in connections:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(200, client.get(self.base_url + '/red.jpg').status)
+        self.assertEqual(2, client.connection_count)
+        self.assertRaises(urllib2.HTTPError, client.get, self.base_url + '/missing.jpg')
+        client.close()
+
+
 class ImageTests(unittest.TestCase):
     wiki_image_url = 'https://upload.wikimedia.org/wikipedia/commons/thumb/0/05/Wikipedia%27s_W_%28Linux_Libertine%29.svg/128px-Wikipedia%27s_W_%28Linux_Libertine%29.svg.png'
 
@@ -407,6 +1295,34 @@ class ImageTests(unittest.TestCase):
         rendered_array = np.array(rendered)
         self.assertNotEqual(np.sum(rendered_array), 0)
 
+    def test_deserialize_tsv_node_link_image_is_lazy(self):
+        linked_filename = 'linked_image.tsv'
+        serializer.save_tree(TestImageTree.create_one_high_tree(filename=linked_filename))
+        serialized_string = 'first\t\t\t\t\t\t\t\t' + utilities.format_node_address(linked_filename, 'father') + '\n'
+        test_serializer = serializer.Serializer()
+        deserialized_tree = test_serializer.load_from_string(node_name='first', filename='lazy_link.tsv',
+                                                             serialized_string=serialized_string)
+        self.assertIsInstance(deserialized_tree.get_image_value(), imagevalue.NodeLinkImage)
+        self.assertNotIn(linked_filename, test_serializer.filename_treemap_map)
+        self.assertEqual(TestImageTree.father_pixel, tuple(deserialized_tree.get_np_array(1).flatten()))
+        self.assertIn(linked_filename, test_serializer.filename_treemap_map)
+        os.remove(linked_filename)
+
+    def test_linked_images_are_not_pinned(self):
+        linked_filename = 'linked_image_weak.tsv'
+        serializer.save_tree(TestImageTree.create_one_high_tree(filename=linked_filename))
+        link = utilities.format_node_address(linked_filename, 'father')
+        test_serializer = serializer.Serializer(shared_file_cache=file_cache.FileCache())
+        linked_tree = test_serializer.load_linked_image(link)
+        self.assertIs(linked_tree, test_serializer.load_linked_image(link))
+        del linked_tree
+        test_serializer.filename_treemap_map.clear()
+        test_serializer.shared_file_cache.clear()
+        gc.collect()
+        self.assertEqual(0, len(test_serializer.linked_image_map))
+        self.assertEqual('father', test_serializer.load_linked_image(link).name)
+        os.remove(linked_filename)
+
     def test_pil_image_at_quadkey(self):
         deserialized_tree = self.create_image_url_tree()
         rendered = deserialized_tree.get_pil_image_at_quadkey(64, '3')